@@ -0,0 +1,203 @@
+import os
+import xml.etree.ElementTree as ET
+from journal import Journal
+from generaciones import GeneracionesSnapshot
+from persistencia_xml import escribir_snapshot, LectorSnapshot
+
+
+# Compactación del journal: se reescribe el snapshot cuando el journal pesa al menos PROPORCION_COMPACTACION
+# veces el snapshot (así reescribirlo cuesta a lo sumo lo que ya se escribió en el journal) y como
+# mínimo UMBRAL_COMPACTACION bytes, para que con pocos datos no se compacte en cada lote.
+UMBRAL_COMPACTACION = 8 << 20
+PROPORCION_COMPACTACION = 1.0
+
+
+class ErrorPersistencia(Exception):
+    """ No se pudo escribir el estado; lo que ya estaba persistido sigue intacto. """
+    pass
+
+
+class Almacenamiento:
+    """
+    Interfaz de persistencia del Datalake.
+    El Datalake mantiene los modelos en memoria y registra cada mutación como
+    {"seq": n, "op": "...", "datos": {...}}; cada implementación decide cómo guardarlas.
+    """
+
+    ruta = None
+
+    def cargar(self, datalake, diferir_facturas=False):
+        """
+        Carga el estado guardado en los modelos del datalake y fija datalake.secuencia.
+        Con diferir_facturas puede devolver una función que completa la carga de las facturas
+        más tarde; si todo quedó cargado devuelve None.
+        """
+        raise NotImplementedError
+
+    def recuperar(self, datalake):
+        """ Reaplica cambios guardados después del estado base (p. ej. un journal). """
+        pass
+
+    def guardar(self, datalake, cambios):
+        """ Persiste un lote de mutaciones registradas. Lanza ErrorPersistencia si falla. """
+        raise NotImplementedError
+
+    def guardar_completo(self, datalake):
+        """ Reescribe todo el estado en memoria. Lanza ErrorPersistencia si falla. """
+        raise NotImplementedError
+
+    def compactar(self, datalake):
+        """ Reorganiza lo persistido (p. ej. snapshot + vaciar journal). Opcional. """
+        pass
+
+    def reset(self, datalake):
+        """ Borra lo persistido y deja guardado el estado (vacío) del datalake. """
+        self.guardar_completo(datalake)
+
+
+class AlmacenamientoXML(Almacenamiento):
+    """
+    Snapshot XML versionado (db_persistente.xml) y, opcionalmente, un journal de solo-anexado:
+    cada lote de mutaciones se anexa al log y el snapshot solo se reescribe al compactar.
+    """
+
+    def __init__(self, db_file="db_persistente.xml", modo_journal=False, umbral_compactacion=UMBRAL_COMPACTACION,
+                 generaciones_conservadas=3, proporcion_compactacion=PROPORCION_COMPACTACION):
+        self.ruta = db_file
+        self.generaciones = GeneracionesSnapshot(db_file, conservar=generaciones_conservadas)
+        self.journal = Journal(os.path.splitext(db_file)[0] + ".journal") if modo_journal else None
+        self.umbral_compactacion = umbral_compactacion # Bytes mínimos del journal para compactar
+        self.proporcion_compactacion = proporcion_compactacion
+
+    def cargar(self, datalake, diferir_facturas=False):
+        encontrado = False
+        for ruta in self.generaciones.candidatos():
+            encontrado = True
+            try:
+                # Añadir manejo de archivo vacío
+                if os.path.getsize(ruta) == 0:
+                    print(f"Archivo {ruta} está vacío. Iniciando en blanco.")
+                    return None
+
+                lector = LectorSnapshot(ruta)
+                # Las facturas (la parte más grande y menos usada) pueden quedar para después
+                pausado = lector.leer(detener_en='listaFacturas' if diferir_facturas else None)
+                datalake.secuencia = lector.secuencia
+                datalake.recursos = lector.recursos
+                datalake.categorias = lector.categorias
+                datalake.clientes = lector.clientes
+                datalake.huellas_archivos = lector.archivos
+                datalake.ingresos_diarios = lector.ingresos_diarios # Ya cubren las facturas que faltan por leer
+                datalake.facturas = lector.facturas # El lector sigue añadiendo aquí al continuar
+                print(f"Datos cargados exitosamente desde {ruta}")
+                return lector.leer if pausado else None
+
+            except ET.ParseError as e:
+                print(f"Error al parsear {ruta}: {e}. Archivo corrupto, se intenta la generación anterior.")
+            except FileNotFoundError:
+                 print(f"Archivo {ruta} no encontrado.")
+            except Exception as e:
+                print(f"Error INESPERADO al cargar {ruta} ({type(e).__name__}): {e}.")
+                import traceback
+                traceback.print_exc()
+            # Los archivos no se borran: quedan para revisión manual
+            datalake.recursos, datalake.categorias, datalake.clientes, datalake.facturas = [], [], [], []
+            datalake.huellas_archivos = set()
+            datalake.ingresos_diarios = None
+            datalake.secuencia = 0
+
+        if not encontrado:
+            print(f"Archivo {self.ruta} no encontrado. Iniciando en blanco.")
+            return None
+        print("No se encontró ningún snapshot válido. Iniciando en blanco.")
+        return None
+
+    def recuperar(self, datalake):
+        """ Aplica sobre el snapshot cargado los registros del journal que este aún no incluye. """
+        if not self.journal:
+            return
+        aplicados = 0
+        for registro in self.journal.leer():
+            if registro['seq'] <= datalake.secuencia:
+                continue # Ya incluido en el snapshot (caída entre escribir el snapshot y vaciar el journal)
+            try:
+                datalake._aplicar(registro['op'], registro['datos'])
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                print(f"Advertencia: registro {registro.get('seq')} del journal inválido ({e}). Omitiendo.")
+            datalake.secuencia = registro['seq']
+            aplicados += 1
+        if aplicados:
+            print(f"{aplicados} cambios recuperados desde {self.journal.ruta}")
+
+    def guardar(self, datalake, cambios):
+        # Sin journal cada lote reescribe el snapshot completo
+        if not self.journal:
+            self.guardar_completo(datalake)
+            return
+        try:
+            self.journal.agregar(cambios)
+        except OSError as e:
+            print(f"Error CRÍTICO al escribir en el journal {self.journal.ruta}: {e}. Guardando snapshot completo.")
+            self.guardar_completo(datalake)
+            return
+        if self._debe_compactar():
+            self.compactar(datalake)
+
+    def _debe_compactar(self):
+        """ Se mide en bytes, no en registros: un lote grande de consumos no debe compactar él solo. """
+        try:
+            tamano_snapshot = os.path.getsize(self.ruta)
+        except OSError:
+            tamano_snapshot = 0
+        return self.journal.bytes >= max(self.umbral_compactacion, self.proporcion_compactacion * tamano_snapshot)
+
+    def guardar_completo(self, datalake):
+        """
+        Guarda el estado actual como una generación nueva del snapshot (temporal + fsync + rename).
+        Si falla lanza ErrorPersistencia y la generación anterior sigue siendo la vigente.
+        """
+        # CORRECCIÓN: Asegurar que el directorio exista ANTES de intentar escribir
+        try:
+             # Si ruta es solo nombre (sin directorio), dirname será '', lo cual es válido para os.makedirs
+            dir_path = os.path.dirname(self.ruta)
+            if dir_path: # Solo crear si hay un directorio especificado
+                os.makedirs(dir_path, exist_ok=True)
+        except OSError as e:
+            raise ErrorPersistencia(f"No se pudo crear el directorio para {self.ruta}: {e}") from e
+
+        # Bajo el lock del Datalake solo se copia el estado (termina antes la carga de facturas si sigue
+        # pendiente); serializar, sincronizar y renombrar va fuera, sin bloquear lecturas ni escrituras
+        estado = datalake._estado_para_snapshot()
+
+        # Escribir el archivo XML formateado, en streaming sobre el archivo (sin árbol ni minidom)
+        try:
+            self.generaciones.escribir(lambda archivo: escribir_snapshot(estado, archivo), estado.secuencia)
+        except Exception as e:
+            print(f"Error CRÍTICO al intentar guardar en {self.ruta}: {e}")
+            import traceback
+            traceback.print_exc()
+            raise ErrorPersistencia(f"No se pudo guardar el snapshot en {self.ruta}: {e}") from e
+
+    def compactar(self, datalake):
+        """ Escribe un snapshot con todo el estado y vacía el journal. """
+        if not self.journal:
+            return
+        # Solo se vacía el log si el snapshot quedó escrito, si no los registros seguirían siendo necesarios.
+        # Los cambios aún pendientes ya están en el snapshot y al reproducirlos se omiten por su secuencia.
+        try:
+            self.guardar_completo(datalake)
+        except ErrorPersistencia as e:
+            print(f"Compactación cancelada, el journal se conserva: {e}")
+            return
+        self.journal.truncar()
+
+    def reset(self, datalake):
+        if os.path.exists(self.ruta):
+            # Las generaciones anteriores se conservan como respaldo hasta que roten
+            os.remove(self.ruta) # Borra el archivo
+            print(f"Archivo {self.ruta} eliminado.")
+        # Asegura que al reiniciar se cree el archivo vacío si no existe
+        self.guardar_completo(datalake)
+        # El snapshot vacío ya refleja el reset, el journal anterior ya no aplica
+        if self.journal:
+            self.journal.truncar()
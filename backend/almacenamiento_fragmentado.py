@@ -0,0 +1,321 @@
+import os
+import zlib
+import xml.etree.ElementTree as ET
+from almacenamiento import Almacenamiento, ErrorPersistencia
+from generaciones import GeneracionesSnapshot
+from journal import Journal
+from persistencia_xml import (
+    EscritorXML, LectorSnapshot, escribir_recursos, escribir_categorias, escribir_clientes, escribir_archivos,
+    escribir_ingresos_diarios, escribir_facturas
+)
+from ingresos_diarios import IngresosDiarios
+
+CATALOGO = "catalogo"
+JOURNAL = "cambios.journal"
+
+
+def fragmento_de(nit, fragmentos):
+    """ Fragmento al que pertenece un NIT (crc32 es estable entre ejecuciones, a diferencia de hash()). """
+    return zlib.crc32(str(nit).encode('utf-8')) % fragmentos
+
+
+class AlmacenamientoFragmentado(Almacenamiento):
+    """
+    Snapshot XML repartido en varios archivos dentro de un directorio:
+      catalogo.xml          recursos y categorías (con sus configuraciones)
+      clientes_NNN.xml      clientes, instancias, consumos y facturas de los NIT del fragmento NNN
+      cambios.journal       el lote que se está guardando (ver guardar)
+    Cada lote de mutaciones reescribe completos los archivos que tocó (casi siempre el catálogo o el
+    fragmento de un cliente): guardar cuesta lo que pesan esos archivos, del orden de 1/fragmentos de
+    los datos por fragmento, no lo que pesa el cambio.
+    Cada archivo se escribe de forma atómica y versionada con GeneracionesSnapshot, pero un lote que toca
+    varios archivos no se escribe de forma atómica: por eso antes se anexa al journal y al cargar se
+    reaplican los registros que el archivo correspondiente aún no incluye (según su secuencia).
+    El orden de clientes y facturas se conserva dentro de cada fragmento, no entre fragmentos.
+    """
+
+    def __init__(self, directorio="db_persistente", fragmentos=16, origen=None, generaciones_conservadas=2):
+        self.ruta = directorio
+        self.fragmentos = fragmentos
+        self.origen = origen # Snapshot de un solo archivo a importar si el directorio aún no existe
+        self.generaciones_conservadas = generaciones_conservadas
+        self._archivos = {} # nombre -> GeneracionesSnapshot
+        self.journal = Journal(os.path.join(directorio, JOURNAL))
+        # Secuencia de los archivos leídos al cargar (catálogo y la del fragmento de cada NIT), para
+        # decidir en recuperar qué registros del journal faltan. _recuperados son los archivos que
+        # recuperar modificó y el próximo guardado debe incluir antes de vaciar el journal.
+        self._secuencia_catalogo = 0
+        self._secuencia_por_nit = {}
+        self._recuperados = set()
+        self._reescribir_todo = False # Tras importar o cambiar la cantidad de fragmentos
+        # Índices por fragmento (ver _actualizar_indices): número -> clientes / facturas, en el orden
+        # del Datalake, y sus rollups de ingresos. _indexados son las listas indexadas y cuántos
+        # elementos de cada una ya entraron.
+        self._clientes_por_fragmento = {}
+        self._facturas_por_fragmento = {}
+        self._ingresos_por_fragmento = {}
+        self._indexados = None
+
+    def _generaciones(self, nombre):
+        if nombre not in self._archivos:
+            self._archivos[nombre] = GeneracionesSnapshot(
+                os.path.join(self.ruta, nombre + ".xml"), conservar=self.generaciones_conservadas)
+        return self._archivos[nombre]
+
+    def _nombre_fragmento(self, n):
+        return f"clientes_{n:03d}"
+
+    def _fragmentos_en_disco(self):
+        """ Números de los fragmentos presentes en el directorio (pueden ser más que self.fragmentos). """
+        numeros = set()
+        if os.path.isdir(self.ruta):
+            for archivo in os.listdir(self.ruta):
+                partes = archivo.split(".")
+                if partes[0].startswith("clientes_") and partes[0][9:].isdigit():
+                    numeros.add(int(partes[0][9:]))
+        return sorted(numeros)
+
+    # --- Carga ---
+    def _leer(self, nombre, detener_en=None):
+        """ Lee un archivo del directorio probando sus generaciones. Devuelve (lector, pausado) o (None, False). """
+        for ruta in self._generaciones(nombre).candidatos():
+            try:
+                if os.path.getsize(ruta) == 0:
+                    return None, False
+                lector = LectorSnapshot(ruta)
+                return lector, lector.leer(detener_en=detener_en)
+            except ET.ParseError as e:
+                print(f"Error al parsear {ruta}: {e}. Archivo corrupto, se intenta la generación anterior.")
+            except OSError as e:
+                print(f"Error al leer {ruta}: {e}.")
+        return None, False
+
+    def cargar(self, datalake, diferir_facturas=False):
+        if not os.path.exists(os.path.join(self.ruta, CATALOGO + ".xml")):
+            if self.origen and os.path.exists(self.origen):
+                return self._importar(datalake)
+            print(f"Directorio {self.ruta} sin datos. Iniciando en blanco.")
+            return None
+
+        catalogo, _ = self._leer(CATALOGO)
+        if catalogo:
+            datalake.recursos = catalogo.recursos
+            datalake.categorias = catalogo.categorias
+            datalake.huellas_archivos = catalogo.archivos
+            datalake.secuencia = catalogo.secuencia
+            self._secuencia_catalogo = catalogo.secuencia
+
+        clientes, facturas, pausados = [], [], []
+        ingresos = IngresosDiarios() # Suma de los rollups de cada fragmento
+        for n in self._fragmentos_en_disco():
+            lector, pausado = self._leer(self._nombre_fragmento(n),
+                                         detener_en='listaFacturas' if diferir_facturas else None)
+            if not lector:
+                continue
+            datalake.secuencia = max(datalake.secuencia, lector.secuencia)
+            self._secuencia_por_nit.update((c.nit, lector.secuencia) for c in lector.clientes)
+            if n >= self.fragmentos or any(fragmento_de(c.nit, self.fragmentos) != n for c in lector.clientes):
+                self._reescribir_todo = True # Cambió la cantidad de fragmentos: redistribuir
+            clientes.extend(lector.clientes)
+            facturas.extend(lector.facturas)
+            if lector.ingresos_diarios is None:
+                ingresos = None # Fragmento escrito sin rollups: se reconstruyen desde las facturas
+            elif ingresos is not None:
+                ingresos.combinar(lector.ingresos_diarios)
+            if pausado:
+                pausados.append(lector)
+        datalake.clientes = clientes
+        datalake.facturas = facturas
+        datalake.ingresos_diarios = ingresos
+        print(f"Datos cargados exitosamente desde {self.ruta} ({len(self._fragmentos_en_disco())} fragmentos)")
+
+        if not pausados:
+            return None
+
+        def completar():
+            for lector in pausados:
+                lector.leer()
+                facturas.extend(lector.facturas) # Pausado al inicio de la lista: aún no tenía facturas
+        return completar
+
+    def _importar(self, datalake):
+        """ Carga el snapshot de un solo archivo (origen) para repartirlo en fragmentos. """
+        try:
+            lector = LectorSnapshot(self.origen)
+            lector.leer()
+        except (ET.ParseError, OSError) as e:
+            print(f"Error al importar {self.origen}: {e}. Iniciando en blanco.")
+            return None
+        datalake.secuencia = lector.secuencia
+        datalake.recursos, datalake.categorias = lector.recursos, lector.categorias
+        datalake.clientes, datalake.facturas = lector.clientes, lector.facturas
+        datalake.huellas_archivos = lector.archivos
+        datalake.ingresos_diarios = lector.ingresos_diarios
+        self._secuencia_catalogo = lector.secuencia
+        self._secuencia_por_nit = {c.nit: lector.secuencia for c in lector.clientes}
+        self._reescribir_todo = True
+        print(f"Datos importados desde {self.origen}; se repartirán en {self.fragmentos} fragmentos en {self.ruta}")
+        return None
+
+    def recuperar(self, datalake):
+        """
+        Reaplica los registros del journal que no alcanzaron a escribirse: los de un lote cortado entre
+        un archivo y otro, o los de un lote que falló. Cada registro se compara con la secuencia del
+        archivo que lo guarda; un lote reintentado aparece más de una vez y solo cuenta la primera.
+        """
+        aplicados, ultima = 0, 0
+        for registro in self.journal.leer():
+            if registro['seq'] <= ultima:
+                continue # Repetido por un reintento
+            ultima = registro['seq']
+            if self._nit_de(registro) is None:
+                secuencia_archivo = self._secuencia_catalogo
+            else:
+                secuencia_archivo = self._secuencia_por_nit.get(self._nit_de(registro), 0)
+            if registro['seq'] <= secuencia_archivo:
+                continue
+            try:
+                datalake._aplicar(registro['op'], registro['datos'])
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                print(f"Advertencia: registro {registro.get('seq')} del journal inválido ({e}). Omitiendo.")
+            datalake.secuencia = max(datalake.secuencia, registro['seq'])
+            self._recuperados |= self._sucios([registro])
+            aplicados += 1
+        self._secuencia_por_nit = {}
+        if aplicados:
+            print(f"{aplicados} cambios recuperados desde {self.journal.ruta}")
+        # Completar una importación o redistribución
+        if self._reescribir_todo:
+            self.guardar_completo(datalake)
+
+    # --- Escritura ---
+    @staticmethod
+    def _nit_de(registro):
+        """ NIT del cliente al que pertenece un registro, o None si va en el catálogo. """
+        op, datos = registro['op'], registro['datos']
+        if op in ('recurso', 'categoria', 'configuracion', 'archivo'):
+            return None
+        if op == 'factura':
+            return datos['factura']['nit_cliente']
+        return datos['nit'] # cliente, instancia, consumo
+
+    def _sucios(self, cambios):
+        """ Archivos que modifica un lote de mutaciones. """
+        sucios = set()
+        for registro in cambios:
+            nit = self._nit_de(registro)
+            sucios.add(CATALOGO if nit is None else fragmento_de(nit, self.fragmentos))
+        return sucios
+
+    def guardar(self, datalake, cambios):
+        """
+        Anexa el lote al journal, reescribe los archivos que toca y vacía el journal. Si el proceso cae
+        entre un archivo y otro, recuperar reaplica lo que faltó; si la escritura falla el journal se
+        conserva y el Datalake reintenta el lote.
+        """
+        sucios = self._sucios(cambios) | self._recuperados
+        if not sucios:
+            return
+        try:
+            self.journal.agregar(cambios)
+        except OSError as e:
+            raise ErrorPersistencia(f"No se pudo escribir el journal {self.journal.ruta}: {e}") from e
+        self._escribir(datalake, sucios)
+        self._recuperados = set()
+        self.journal.truncar()
+
+    def guardar_completo(self, datalake):
+        self._indexados = None # Reconstruir los índices (también si cambió la cantidad de fragmentos)
+        self._escribir(datalake, {CATALOGO, *range(self.fragmentos)})
+        # Fragmentos que sobran si se redujo la cantidad: sus clientes ya se escribieron en los nuevos
+        for n in self._fragmentos_en_disco():
+            if n >= self.fragmentos:
+                self._eliminar(self._nombre_fragmento(n))
+        self._reescribir_todo = False
+        self._recuperados = set()
+        self.journal.truncar() # Todo el estado quedó en los archivos
+
+    def _actualizar_indices(self, datalake):
+        """
+        Pone al día los índices por fragmento; llamar con datalake.lock tomado. Entre cargas los clientes
+        y las facturas solo se añaden al final de sus listas, así que basta indexar lo nuevo. Si las listas
+        se reemplazaron (carga) o se vaciaron (reset) se reconstruyen desde cero.
+        """
+        clientes, facturas = datalake.clientes, datalake.facturas
+        if self._indexados is None or self._indexados[0] is not clientes or self._indexados[2] is not facturas \
+                or len(clientes) < self._indexados[1] or len(facturas) < self._indexados[3]:
+            self._clientes_por_fragmento = {n: [] for n in range(self.fragmentos)}
+            self._facturas_por_fragmento = {n: [] for n in range(self.fragmentos)}
+            self._ingresos_por_fragmento = {n: IngresosDiarios() for n in range(self.fragmentos)}
+            self._indexados = (clientes, 0, facturas, 0)
+        _, n_clientes, _, n_facturas = self._indexados
+        for cli in clientes[n_clientes:]:
+            self._clientes_por_fragmento[fragmento_de(cli.nit, self.fragmentos)].append(cli)
+        for f in facturas[n_facturas:]:
+            n = fragmento_de(f.nit_cliente, self.fragmentos)
+            self._facturas_por_fragmento[n].append(f)
+            self._ingresos_por_fragmento[n].agregar_factura(f)
+        self._indexados = (clientes, len(clientes), facturas, len(facturas))
+
+    def _escribir(self, datalake, sucios):
+        try:
+            os.makedirs(self.ruta, exist_ok=True)
+        except OSError as e:
+            raise ErrorPersistencia(f"No se pudo crear el directorio {self.ruta}: {e}") from e
+        fragmentos = sorted(sucios - {CATALOGO})
+        if fragmentos:
+            datalake._completar_carga_facturas() # Los fragmentos incluyen las facturas
+
+        # Bajo el lock solo se copia lo que se va a escribir: el catálogo y los clientes y facturas de los
+        # fragmentos sucios (las facturas no cambian y se comparten). La escritura va fuera del lock.
+        with datalake.lock:
+            self._actualizar_indices(datalake)
+            catalogo = datalake._copia_catalogo()
+            secuencia = catalogo.secuencia
+            contenido = {n: ([datalake._copia_cliente(cli) for cli in self._clientes_por_fragmento[n]],
+                             list(self._facturas_por_fragmento[n]), self._ingresos_por_fragmento[n].copia())
+                         for n in fragmentos}
+
+        try:
+            if CATALOGO in sucios:
+                self._generaciones(CATALOGO).escribir(
+                    lambda archivo: self._escribir_catalogo(catalogo, archivo, secuencia), secuencia)
+            for n in fragmentos:
+                clientes, facturas, ingresos = contenido[n]
+                self._generaciones(self._nombre_fragmento(n)).escribir(
+                    lambda archivo: self._escribir_fragmento(archivo, secuencia, clientes, facturas, ingresos), secuencia)
+        except Exception as e:
+            print(f"Error CRÍTICO al intentar guardar en {self.ruta}: {e}")
+            raise ErrorPersistencia(f"No se pudo guardar en {self.ruta}: {e}") from e
+
+    def _escribir_catalogo(self, catalogo, archivo, secuencia):
+        w = EscritorXML(archivo)
+        w.declaracion()
+        w.abrir("sistemaTecnologiasChapinas", secuencia=secuencia)
+        escribir_recursos(w, catalogo.recursos)
+        escribir_categorias(w, catalogo.categorias)
+        escribir_archivos(w, catalogo.huellas_archivos)
+        w.cerrar("sistemaTecnologiasChapinas")
+
+    def _escribir_fragmento(self, archivo, secuencia, clientes, facturas, ingresos):
+        w = EscritorXML(archivo)
+        w.declaracion()
+        w.abrir("sistemaTecnologiasChapinas", secuencia=secuencia)
+        escribir_clientes(w, clientes)
+        # Rollups solo de las facturas del fragmento (al cargar se suman los de todos)
+        escribir_ingresos_diarios(w, ingresos)
+        escribir_facturas(w, facturas)
+        w.cerrar("sistemaTecnologiasChapinas")
+
+    def _eliminar(self, nombre):
+        generaciones = self._generaciones(nombre)
+        rutas = [generaciones.db_file, generaciones.ruta_manifiesto]
+        rutas += [generaciones.ruta_generacion(e['generacion']) for e in generaciones.entradas]
+        for ruta in rutas:
+            try: os.remove(ruta)
+            except OSError: pass
+        del self._archivos[nombre]
+
+    def reset(self, datalake):
+        # Con el datalake vacío se reescriben todos los archivos y se borran los sobrantes
+        self.guardar_completo(datalake)
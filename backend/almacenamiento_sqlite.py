@@ -0,0 +1,359 @@
+import sqlite3
+import threading
+from almacenamiento import Almacenamiento, ErrorPersistencia
+from models import (
+    Recurso, Categoria, Configuracion, RecursoConfiguracion,
+    Cliente, Instancia, Factura, DetalleInstanciaFactura, DetalleRecursoInstancia
+)
+from utils import fecha_a_ordinal
+from ingresos_diarios import IngresosDiarios
+from huellas_consumo import HuellasConsumo, limite_para
+
+# Las tablas no usan el ID como INTEGER PRIMARY KEY para que rowid conserve el orden de inserción
+# (el mismo orden de las listas en memoria); los upserts con ON CONFLICT no cambian el rowid.
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+CREATE TABLE IF NOT EXISTS recursos (
+    id INTEGER NOT NULL UNIQUE, nombre TEXT, abreviatura TEXT, metrica TEXT, tipo TEXT, valor_x_hora REAL);
+CREATE TABLE IF NOT EXISTS categorias (
+    id INTEGER NOT NULL UNIQUE, nombre TEXT, descripcion TEXT, carga_trabajo TEXT);
+CREATE TABLE IF NOT EXISTS configuraciones (
+    id INTEGER NOT NULL UNIQUE, id_categoria INTEGER NOT NULL, nombre TEXT, descripcion TEXT);
+CREATE INDEX IF NOT EXISTS idx_configuraciones_categoria ON configuraciones(id_categoria);
+CREATE TABLE IF NOT EXISTS recursos_configuracion (
+    id_configuracion INTEGER NOT NULL, id_recurso INTEGER NOT NULL, cantidad REAL,
+    UNIQUE (id_configuracion, id_recurso));
+CREATE TABLE IF NOT EXISTS clientes (
+    nit TEXT NOT NULL UNIQUE, nombre TEXT, usuario TEXT, clave TEXT, direccion TEXT, correo TEXT);
+CREATE TABLE IF NOT EXISTS instancias (
+    nit TEXT NOT NULL, id INTEGER NOT NULL, id_configuracion INTEGER, nombre TEXT,
+    fecha_inicio TEXT, estado TEXT, fecha_final TEXT, UNIQUE (nit, id));
+CREATE INDEX IF NOT EXISTS idx_instancias_configuracion ON instancias(id_configuracion);
+CREATE TABLE IF NOT EXISTS consumos (
+    nit TEXT NOT NULL, id_instancia INTEGER NOT NULL, tiempo REAL, marca INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS idx_consumos_instancia ON consumos(nit, id_instancia);
+CREATE TABLE IF NOT EXISTS pendientes (
+    nit TEXT NOT NULL, id_instancia INTEGER NOT NULL, horas REAL NOT NULL, cantidad INTEGER NOT NULL,
+    UNIQUE (nit, id_instancia));
+CREATE TABLE IF NOT EXISTS huellas_consumo (
+    nit TEXT NOT NULL, huella INTEGER NOT NULL, marca INTEGER NOT NULL DEFAULT 0, UNIQUE (nit, huella));
+CREATE TABLE IF NOT EXISTS archivos_cargados (huella TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS facturas (
+    id TEXT NOT NULL UNIQUE, nit_cliente TEXT, nombre_cliente TEXT, fecha_factura TEXT,
+    fecha_ordinal INTEGER, monto_total_centavos INTEGER);
+CREATE INDEX IF NOT EXISTS idx_facturas_fecha ON facturas(fecha_ordinal);
+CREATE INDEX IF NOT EXISTS idx_facturas_cliente ON facturas(nit_cliente);
+CREATE TABLE IF NOT EXISTS detalles_instancia (
+    id_factura TEXT NOT NULL, posicion INTEGER NOT NULL, id_instancia INTEGER, nombre_instancia TEXT,
+    id_configuracion INTEGER, nombre_configuracion TEXT, id_categoria INTEGER,
+    horas_consumidas REAL, subtotal_instancia_centavos INTEGER, UNIQUE (id_factura, posicion));
+CREATE INDEX IF NOT EXISTS idx_detalles_instancia_configuracion ON detalles_instancia(id_configuracion);
+CREATE TABLE IF NOT EXISTS detalles_recurso (
+    id_factura TEXT NOT NULL, posicion_instancia INTEGER NOT NULL, id_recurso INTEGER, nombre_recurso TEXT,
+    cantidad REAL, metrica TEXT, valor_x_hora REAL, subtotal_centavos INTEGER);
+CREATE INDEX IF NOT EXISTS idx_detalles_recurso_factura ON detalles_recurso(id_factura, posicion_instancia);
+CREATE INDEX IF NOT EXISTS idx_detalles_recurso_recurso ON detalles_recurso(id_recurso);
+CREATE TABLE IF NOT EXISTS ingresos_diarios (
+    fecha_ordinal INTEGER NOT NULL, tipo TEXT NOT NULL, clave INTEGER, centavos INTEGER NOT NULL,
+    UNIQUE (fecha_ordinal, tipo, clave));
+"""
+
+TABLAS = ["recursos", "categorias", "configuraciones", "recursos_configuracion", "clientes",
+          "instancias", "consumos", "pendientes", "huellas_consumo", "archivos_cargados", "facturas", "detalles_instancia", "detalles_recurso",
+          "ingresos_diarios"]
+
+
+def _id_factura(texto):
+    return int(texto) if texto.isdigit() else texto
+
+
+class AlmacenamientoSQLite(Almacenamiento):
+    """
+    Persistencia en SQLite (biblioteca estándar) con una tabla indexada por entidad.
+    Cada mutación registrada se traduce en upserts/inserts de una fila, así que guardar un lote
+    cuesta O(cambios · log n) en lugar de reescribir todo. Los rollups de ingresos por día (ingresos_diarios.py)
+    tienen su propia tabla, que cada factura actualiza con upserts; se cargan sin leer el historial de facturas.
+    Orden de los locks: datalake.lock antes que self._lock (la carga diferida de facturas toma self._lock
+    dentro de los del Datalake); nunca al revés.
+    """
+
+    def __init__(self, ruta="db_persistente.sqlite3"):
+        self.ruta = ruta
+        # Se usa desde los hilos de Flask, el de group commit y el de carga de facturas
+        self.conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self._limites = {} # nit -> límite de sus huellas de consumo (ver huellas_consumo.py)
+        existe = lambda tabla: self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabla,)).fetchone() is not None
+        sin_pendientes, sin_ingresos = not existe('pendientes'), not existe('ingresos_diarios')
+        self.conn.executescript(ESQUEMA)
+        # Bases creadas antes de guardar la fechaHora de los consumos
+        if "marca" not in [c[1] for c in self.conn.execute("PRAGMA table_info(consumos)")]:
+            self.conn.execute("ALTER TABLE consumos ADD COLUMN marca INTEGER NOT NULL DEFAULT 0")
+        # Bases creadas antes de guardar la marca de las huellas: toman la del consumo pendiente más reciente
+        if "marca" not in [c[1] for c in self.conn.execute("PRAGMA table_info(huellas_consumo)")]:
+            self.conn.execute("ALTER TABLE huellas_consumo ADD COLUMN marca INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE huellas_consumo SET marca = COALESCE("
+                              "(SELECT MAX(marca) FROM consumos WHERE consumos.nit = huellas_consumo.nit), 0)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_huellas_consumo_marca ON huellas_consumo(nit, marca)")
+        # Bases creadas con los montos en quetzales (REAL): se pasan a centavos enteros, como en memoria
+        for tabla, columna in (("facturas", "monto_total"), ("detalles_instancia", "subtotal_instancia"),
+                               ("detalles_recurso", "subtotal")):
+            if columna in [c[1] for c in self.conn.execute(f"PRAGMA table_info({tabla})")]:
+                self.conn.execute("BEGIN")
+                self.conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna}_centavos INTEGER")
+                self.conn.execute(f"UPDATE {tabla} SET {columna}_centavos = CAST(ROUND({columna} * 100) AS INTEGER)")
+                self.conn.execute(f"ALTER TABLE {tabla} DROP COLUMN {columna}") # Era la última: el orden no cambia
+                self.conn.execute("COMMIT")
+        # Bases creadas antes de los acumulados por instancia: se calculan de las filas de consumos
+        if sin_pendientes:
+            self.conn.execute("INSERT INTO pendientes SELECT nit, id_instancia, SUM(tiempo), COUNT(*) "
+                              "FROM consumos GROUP BY nit, id_instancia")
+        # Bases creadas antes de los rollups: se agregan de los detalles de las facturas
+        if sin_ingresos:
+            self.conn.execute("BEGIN")
+            for tipo, tabla, clave, centavos in (
+                    ("recurso", "detalles_recurso", "id_recurso", "subtotal_centavos"),
+                    ("configuracion", "detalles_instancia", "id_configuracion", "subtotal_instancia_centavos"),
+                    ("categoria", "detalles_instancia", "id_categoria", "subtotal_instancia_centavos")):
+                self.conn.execute(f"INSERT INTO ingresos_diarios SELECT f.fecha_ordinal, '{tipo}', d.{clave}, SUM(d.{centavos}) "
+                                  f"FROM {tabla} d JOIN facturas f ON f.id = d.id_factura "
+                                  f"WHERE f.fecha_ordinal IS NOT NULL GROUP BY f.fecha_ordinal, d.{clave}")
+            self.conn.execute("COMMIT")
+
+    # --- Carga ---
+    def cargar(self, datalake, diferir_facturas=False):
+        with self._lock:
+            c = self.conn
+            fila = c.execute("SELECT valor FROM meta WHERE clave = 'secuencia'").fetchone()
+            datalake.secuencia = int(fila[0]) if fila else 0
+
+            datalake.recursos = [Recurso(*f) for f in c.execute(
+                "SELECT id, nombre, abreviatura, metrica, tipo, valor_x_hora FROM recursos ORDER BY rowid")]
+
+            categorias = {}
+            for f in c.execute("SELECT id, nombre, descripcion, carga_trabajo FROM categorias ORDER BY rowid"):
+                categorias[f[0]] = Categoria(*f, configuraciones=[])
+            configuraciones = {}
+            for id_conf, id_cat, nombre, descripcion in c.execute(
+                    "SELECT id, id_categoria, nombre, descripcion FROM configuraciones ORDER BY rowid"):
+                if id_cat in categorias:
+                    configuraciones[id_conf] = Configuracion(id_conf, nombre, descripcion, recursos=[])
+                    categorias[id_cat].configuraciones.append(configuraciones[id_conf])
+            for id_conf, id_rec, cantidad in c.execute(
+                    "SELECT id_configuracion, id_recurso, cantidad FROM recursos_configuracion ORDER BY rowid"):
+                if id_conf in configuraciones:
+                    configuraciones[id_conf].recursos.append(RecursoConfiguracion(id_rec, cantidad))
+            datalake.categorias = list(categorias.values())
+
+            clientes = {}
+            for f in c.execute("SELECT nit, nombre, usuario, clave, direccion, correo FROM clientes ORDER BY rowid"):
+                clientes[f[0]] = Cliente(*f, instancias=[])
+            instancias = {}
+            for f in c.execute("SELECT nit, id, id_configuracion, nombre, fecha_inicio, estado, fecha_final "
+                               "FROM instancias ORDER BY rowid"):
+                if f[0] in clientes:
+                    instancias[(f[0], f[1])] = Instancia(*f[1:])
+                    clientes[f[0]].instancias.append(instancias[(f[0], f[1])])
+            for nit, id_inst, tiempo, marca in c.execute(
+                    "SELECT nit, id_instancia, tiempo, marca FROM consumos ORDER BY rowid"):
+                if (nit, id_inst) in instancias:
+                    instancias[(nit, id_inst)].consumos.append(tiempo)
+                    instancias[(nit, id_inst)].marcas.append(marca)
+            for nit, id_inst, horas, cantidad in c.execute("SELECT nit, id_instancia, horas, cantidad FROM pendientes"):
+                if (nit, id_inst) in instancias:
+                    instancias[(nit, id_inst)].horas_pendientes = horas
+                    instancias[(nit, id_inst)].cantidad_pendientes = cantidad
+            huellas = {nit: {} for nit in clientes}
+            for nit, huella, marca in c.execute("SELECT nit, huella, marca FROM huellas_consumo"):
+                if nit in huellas:
+                    huellas[nit][huella] = marca
+            for nit, marcas in huellas.items():
+                clientes[nit].huellas_consumo = HuellasConsumo(marcas)
+            self._limites = {nit: cli.huellas_consumo.limite for nit, cli in clientes.items()}
+            datalake.clientes = list(clientes.values())
+            datalake.huellas_archivos = {f[0] for f in c.execute("SELECT huella FROM archivos_cargados")}
+            ingresos = IngresosDiarios()
+            for ordinal, tipo, clave, centavos in c.execute(
+                    "SELECT fecha_ordinal, tipo, clave, centavos FROM ingresos_diarios ORDER BY fecha_ordinal"):
+                ingresos.agregar(ordinal, tipo, clave, centavos)
+            datalake.ingresos_diarios = ingresos
+
+        facturas = []
+        datalake.facturas = facturas
+        print(f"Datos cargados exitosamente desde {self.ruta}")
+        if diferir_facturas:
+            return lambda: self._cargar_facturas(facturas)
+        self._cargar_facturas(facturas)
+        return None
+
+    def _cargar_facturas(self, facturas):
+        with self._lock:
+            c = self.conn
+            por_id = {}
+            for id_fac, nit, nombre, fecha, monto in c.execute(
+                    "SELECT id, nit_cliente, nombre_cliente, fecha_factura, monto_total_centavos FROM facturas ORDER BY rowid"):
+                por_id[id_fac] = Factura(_id_factura(id_fac), nit, nombre, fecha, monto, detalles_instancias=[])
+            detalles = {}
+            for f in c.execute("SELECT id_factura, posicion, id_instancia, nombre_instancia, id_configuracion, "
+                               "nombre_configuracion, horas_consumidas, subtotal_instancia_centavos, id_categoria "
+                               "FROM detalles_instancia ORDER BY id_factura, posicion"):
+                if f[0] in por_id:
+                    detalles[(f[0], f[1])] = DetalleInstanciaFactura(*f[2:8], f[8], recursos_costo=[])
+                    por_id[f[0]].detalles_instancias.append(detalles[(f[0], f[1])])
+            for f in c.execute("SELECT id_factura, posicion_instancia, id_recurso, nombre_recurso, cantidad, "
+                               "metrica, valor_x_hora, subtotal_centavos FROM detalles_recurso ORDER BY rowid"):
+                if (f[0], f[1]) in detalles:
+                    detalles[(f[0], f[1])].recursos_costo.append(DetalleRecursoInstancia(*f[2:8]))
+        facturas.extend(por_id.values())
+
+    # --- Escritura ---
+    def guardar(self, datalake, cambios):
+        if not cambios:
+            return
+        with self._lock:
+            try:
+                self.conn.execute("BEGIN")
+                for registro in cambios:
+                    getattr(self, f"_op_{registro['op']}")(registro['datos'])
+                self._fijar_secuencia(cambios[-1]['seq'])
+                self.conn.execute("COMMIT")
+            except Exception as e:
+                self.conn.execute("ROLLBACK")
+                raise ErrorPersistencia(f"No se pudieron guardar {len(cambios)} cambios en {self.ruta}: {e}") from e
+
+    def guardar_completo(self, datalake):
+        datalake._completar_carga_facturas()
+        with datalake.lock, self._lock: # Ver el orden de los locks en la clase
+            try:
+                self.conn.execute("BEGIN")
+                for tabla in TABLAS:
+                    self.conn.execute(f"DELETE FROM {tabla}")
+                for r in datalake.recursos:
+                    self._op_recurso(r.__dict__)
+                for cat in datalake.categorias:
+                    self._op_categoria({"id": cat.id, "nombre": cat.nombre, "descripcion": cat.descripcion,
+                                        "carga_trabajo": cat.carga_trabajo})
+                    for conf in cat.configuraciones:
+                        self._insertar_configuracion(cat.id, conf.id, conf.nombre, conf.descripcion,
+                                                     [(rc.id_recurso, rc.cantidad) for rc in conf.recursos])
+                for cli in datalake.clientes:
+                    self.conn.execute("INSERT INTO clientes VALUES (?, ?, ?, ?, ?, ?)",
+                                      (cli.nit, cli.nombre, cli.usuario, cli.clave, cli.direccion, cli.correo))
+                    self.conn.executemany("INSERT INTO huellas_consumo VALUES (?, ?, ?)",
+                                          ((cli.nit, huella, marca) for huella, marca in cli.huellas_consumo.marcas.items()))
+                    for inst in cli.instancias:
+                        self.conn.execute("INSERT INTO instancias VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          (cli.nit, inst.id, inst.id_configuracion, inst.nombre,
+                                           inst.fecha_inicio, inst.estado, inst.fecha_final))
+                        self.conn.executemany("INSERT INTO consumos VALUES (?, ?, ?, ?)",
+                                              ((cli.nit, inst.id, t, m) for t, m in zip(inst.consumos, inst.marcas)))
+                        if inst.cantidad_pendientes:
+                            self.conn.execute("INSERT INTO pendientes VALUES (?, ?, ?, ?)",
+                                              (cli.nit, inst.id, inst.horas_pendientes, inst.cantidad_pendientes))
+                self.conn.executemany("INSERT INTO archivos_cargados VALUES (?)",
+                                      ((huella,) for huella in datalake.huellas_archivos))
+                for f in datalake.facturas:
+                    self._insertar_factura(f)
+                self._sumar_ingresos(datalake._ingresos_diarios_listos())
+                self._fijar_secuencia(datalake.secuencia)
+                self.conn.execute("COMMIT")
+                self._limites = {cli.nit: cli.huellas_consumo.limite for cli in datalake.clientes}
+            except Exception as e:
+                self.conn.execute("ROLLBACK")
+                raise ErrorPersistencia(f"No se pudo reescribir {self.ruta}: {e}") from e
+
+    def _fijar_secuencia(self, secuencia):
+        self.conn.execute("INSERT INTO meta VALUES ('secuencia', ?) ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor",
+                          (str(secuencia),))
+
+    # Una función por tipo de registro (ver Datalake._aplicar_*), con la misma semántica de upsert
+    def _op_recurso(self, d):
+        self.conn.execute(
+            "INSERT INTO recursos VALUES (:id, :nombre, :abreviatura, :metrica, :tipo, :valor_x_hora) "
+            "ON CONFLICT(id) DO UPDATE SET nombre = excluded.nombre, abreviatura = excluded.abreviatura, "
+            "metrica = excluded.metrica, tipo = excluded.tipo, valor_x_hora = excluded.valor_x_hora", d)
+
+    def _op_categoria(self, d):
+        self.conn.execute(
+            "INSERT INTO categorias VALUES (:id, :nombre, :descripcion, :carga_trabajo) "
+            "ON CONFLICT(id) DO UPDATE SET nombre = excluded.nombre, descripcion = excluded.descripcion, "
+            "carga_trabajo = excluded.carga_trabajo", d)
+
+    def _op_configuracion(self, d):
+        self._insertar_configuracion(d['id_categoria'], d['id'], d['nombre'], d['descripcion'],
+                                     [(rc['id_recurso'], rc['cantidad']) for rc in d['recursos']])
+
+    def _insertar_configuracion(self, id_categoria, id_conf, nombre, descripcion, recursos):
+        self.conn.execute(
+            "INSERT INTO configuraciones VALUES (?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+            "id_categoria = excluded.id_categoria, nombre = excluded.nombre, descripcion = excluded.descripcion",
+            (id_conf, id_categoria, nombre, descripcion))
+        self.conn.execute("DELETE FROM recursos_configuracion WHERE id_configuracion = ?", (id_conf,))
+        self.conn.executemany("INSERT INTO recursos_configuracion VALUES (?, ?, ?)",
+                              ((id_conf, id_rec, cantidad) for id_rec, cantidad in recursos))
+
+    def _op_cliente(self, d):
+        self.conn.execute(
+            "INSERT INTO clientes VALUES (:nit, :nombre, :usuario, :clave, :direccion, :correo) "
+            "ON CONFLICT(nit) DO UPDATE SET nombre = excluded.nombre, usuario = excluded.usuario, "
+            "clave = excluded.clave, direccion = excluded.direccion, correo = excluded.correo", d)
+
+    def _op_instancia(self, d):
+        self.conn.execute(
+            "INSERT INTO instancias VALUES (:nit, :id, :id_configuracion, :nombre, :fecha_inicio, :estado, :fecha_final) "
+            "ON CONFLICT(nit, id) DO UPDATE SET id_configuracion = excluded.id_configuracion, nombre = excluded.nombre, "
+            "fecha_inicio = excluded.fecha_inicio, estado = excluded.estado, fecha_final = excluded.fecha_final", d)
+
+    def _op_consumo(self, d):
+        self.conn.execute(
+            "INSERT INTO pendientes VALUES (?, ?, ?, 1) ON CONFLICT(nit, id_instancia) DO UPDATE SET "
+            "horas = horas + excluded.horas, cantidad = cantidad + 1", (d['nit'], d['id_instancia'], d['tiempo']))
+        if d.get('conservar', True):
+            self.conn.execute("INSERT INTO consumos VALUES (?, ?, ?, ?)",
+                              (d['nit'], d['id_instancia'], d['tiempo'], d.get('marca', 0)))
+        if d.get('huella') is not None:
+            self.conn.execute("INSERT OR IGNORE INTO huellas_consumo VALUES (?, ?, ?)", (d['nit'], d['huella'], d['marca']))
+            # La misma poda que HuellasConsumo.agregar: solo cuando el límite del cliente avanza
+            limite = limite_para(d['marca'])
+            if self._limites.get(d['nit']) is None or limite > self._limites[d['nit']]:
+                self.conn.execute("DELETE FROM huellas_consumo WHERE nit = ? AND marca < ?", (d['nit'], limite))
+                self._limites[d['nit']] = limite
+
+    def _op_archivo(self, d):
+        self.conn.execute("INSERT OR IGNORE INTO archivos_cargados VALUES (?)", (d['huella'],))
+
+    def _op_factura(self, d):
+        factura = Factura.from_dict(d['factura'])
+        self._insertar_factura(factura)
+        self._sumar_ingresos(IngresosDiarios.desde_facturas([factura]))
+        for tabla in ("consumos", "pendientes"):
+            self.conn.executemany(f"DELETE FROM {tabla} WHERE nit = ? AND id_instancia = ?",
+                                  ((d['factura']['nit_cliente'], id_inst) for id_inst in d['instancias']))
+
+    def _insertar_factura(self, f):
+        id_fac = str(f.id)
+        self.conn.execute("INSERT INTO facturas VALUES (?, ?, ?, ?, ?, ?)",
+                          (id_fac, f.nit_cliente, f.nombre_cliente, f.fecha_factura,
+                           fecha_a_ordinal(f.fecha_factura), f.monto_total_centavos))
+        for posicion, di in enumerate(f.detalles_instancias):
+            self.conn.execute("INSERT INTO detalles_instancia VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (id_fac, posicion, di.id_instancia, di.nombre_instancia, di.id_configuracion,
+                               di.nombre_configuracion, di.id_categoria, di.horas_consumidas,
+                               di.subtotal_instancia_centavos))
+            self.conn.executemany("INSERT INTO detalles_recurso VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  ((id_fac, posicion, dr.id_recurso, dr.nombre_recurso, dr.cantidad,
+                                    dr.metrica, dr.valor_x_hora, dr.subtotal_centavos) for dr in di.recursos_costo))
+
+    def _sumar_ingresos(self, ingresos):
+        """ Suma los rollups de 'ingresos' a la tabla (la clave de categoría puede ser NULL: se compara con IS). """
+        for ordinal in ingresos.dias:
+            for tipo, totales in ingresos.por_dia[ordinal].items():
+                for clave, centavos in totales.items():
+                    actualizada = self.conn.execute(
+                        "UPDATE ingresos_diarios SET centavos = centavos + ? WHERE fecha_ordinal = ? AND tipo = ? AND clave IS ?",
+                        (centavos, ordinal, tipo, clave)).rowcount
+                    if not actualizada:
+                        self.conn.execute("INSERT INTO ingresos_diarios VALUES (?, ?, ?, ?)", (ordinal, tipo, clave, centavos))
@@ -1,4 +1,5 @@
 import os
+import tempfile
 import uuid # Para generar IDs únicos de factura
 from datetime import datetime # Para la fecha de factura
 from flask import Flask, request, jsonify
@@ -9,6 +10,8 @@ from models import (
     Cliente, Instancia, Factura, DetalleInstanciaFactura, DetalleRecursoInstancia
 )
 from utils import validar_nit, extraer_fecha # Importado para Release 2
+from trabajos import GestorTrabajos, ArchivoConProgreso
+from facturacion import facturar_cliente, facturacion_masiva, cotizar_cliente
 
 app = Flask(__name__)
 
@@ -28,6 +31,66 @@ def reset_sistema():
         return jsonify({"status": "error", "message": f"Error al resetear el sistema: {e}"}), 500
 
 
+# --- Cargas asíncronas ---
+# Con ?asincrono=1 (o el campo de formulario 'asincrono') las cargas se encolan: la respuesta es 202
+# con el id del trabajo y el avance se consulta en /jobs/<id>.
+gestor_trabajos = GestorTrabajos(trabajadores=int(os.environ.get('DATALAKE_TRABAJADORES', '2')))
+
+def opcion_activa(nombre):
+    """ Opción booleana de una carga, en la query string o como campo del formulario. """
+    valor = request.args.get(nombre) or request.form.get(nombre) or ''
+    return valor.lower() in ('1', 'true', 'si', 'sí')
+
+def es_asincrono():
+    return opcion_activa('asincrono')
+
+# Con ?dry_run=1 la carga solo valida el archivo contra los datos actuales: responde qué se crearía,
+# actualizaría o rechazaría, sin modificar el Datalake ni escribir en disco. Se combina con asincrono.
+def es_dry_run():
+    return opcion_activa('dry_run')
+
+def guardar_temporal(archivo):
+    """ Copia la subida a un archivo temporal (la petición termina antes que el trabajo). Devuelve (ruta, bytes). """
+    fd, ruta_tmp = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(fd, 'wb') as tmp:
+        archivo.save(tmp)
+    return ruta_tmp, os.path.getsize(ruta_tmp)
+
+def respuesta_trabajo(trabajo):
+    return jsonify({
+        "status": "success",
+        "message": f"Archivo recibido. Procesando en segundo plano (trabajo {trabajo.id}).",
+        "id_trabajo": trabajo.id,
+        "url_estado": f"/jobs/{trabajo.id}"
+    }), 202
+
+def procesar_configuracion(ruta, trabajo, dry_run=False):
+    with open(ruta, 'rb') as f:
+        datos = f.read()
+    trabajo.progreso["bytes_leidos"] = len(datos)
+    try:
+        xml_string = datos.decode('utf-8')
+    except UnicodeDecodeError:
+        return {"status": "error", "message": "Error de codificación. Asegúrese que el archivo sea UTF-8."}
+    return datalake.cargar_desde_xml_string(xml_string, progreso=trabajo.avance, dry_run=dry_run)
+
+def procesar_consumo(ruta, trabajo, dry_run=False):
+    if PROCESOS_CONSUMO > 1:
+        resultado = datalake.cargar_consumo_paralelo(ruta, PROCESOS_CONSUMO, progreso=trabajo.avance, dry_run=dry_run)
+        trabajo.progreso["bytes_leidos"] = trabajo.progreso["bytes_totales"]
+        return resultado
+    with open(ruta, 'rb') as f:
+        return datalake.cargar_consumo_desde_xml(ArchivoConProgreso(f, trabajo), progreso=trabajo.avance, dry_run=dry_run)
+
+@app.route('/jobs/<id_trabajo>', methods=['GET'])
+def estado_trabajo(id_trabajo):
+    """ Estado de una carga asíncrona: progreso, resumen de errores y resultado final. """
+    trabajo = gestor_trabajos.obtener(id_trabajo)
+    if not trabajo:
+        return jsonify({"status": "error", "message": f"Trabajo {id_trabajo} no encontrado"}), 404
+    return jsonify({"status": "success", "trabajo": trabajo.a_dict()})
+
+
 @app.route('/cargar-configuracion', methods=['POST'])
 def cargar_configuracion():
     """ Endpoint para recibir y procesar el XML de configuración. """
@@ -43,8 +106,15 @@ def cargar_configuracion():
 
     if archivo:
         try:
+            dry_run = es_dry_run()
+            if es_asincrono():
+                ruta_tmp, tamano = guardar_temporal(archivo)
+                trabajo = gestor_trabajos.enviar('validar-configuracion' if dry_run else 'cargar-configuracion',
+                                                 lambda t: procesar_configuracion(ruta_tmp, t, dry_run),
+                                                 ruta_tmp=ruta_tmp, bytes_totales=tamano)
+                return respuesta_trabajo(trabajo)
             xml_string = archivo.read().decode('utf-8')
-            resultado = datalake.cargar_desde_xml_string(xml_string) # Datalake ahora guarda automáticamente
+            resultado = datalake.cargar_desde_xml_string(xml_string, dry_run=dry_run) # Datalake ahora guarda automáticamente
             status_code = 200 if resultado["status"] == "success" else 500
             # No es necesario guardar aquí, cargar_desde_xml_string ya lo hace
             # if resultado["status"] == "success":
@@ -58,6 +128,18 @@ def cargar_configuracion():
             traceback.print_exc()
             return jsonify({"status": "error", "message": f"Error inesperado al procesar el archivo: {e}"}), 500
 
+# Procesos para parsear archivos de consumo (DATALAKE_PROCESOS_CONSUMO); 1 = streaming en un solo hilo
+PROCESOS_CONSUMO = int(os.environ.get('DATALAKE_PROCESOS_CONSUMO', '1'))
+
+def cargar_consumo_paralelo(archivo, dry_run=False):
+    """ Guarda la subida en un temporal y la procesa con el parseo multiproceso del Datalake. """
+    ruta_tmp, _ = guardar_temporal(archivo)
+    try:
+        return datalake.cargar_consumo_paralelo(ruta_tmp, PROCESOS_CONSUMO, dry_run=dry_run)
+    finally:
+        try: os.remove(ruta_tmp)
+        except OSError: pass
+
 @app.route('/cargar-consumo', methods=['POST'])
 def cargar_consumo():
     """ Endpoint para recibir y procesar el XML de consumo. """
@@ -72,21 +154,46 @@ def cargar_consumo():
 
     if archivo:
         try:
-            xml_string = archivo.read().decode('utf-8')
-            resultado = datalake.cargar_consumo_desde_xml_string(xml_string) # Datalake ahora guarda automáticamente
+            dry_run = es_dry_run()
+            if es_asincrono():
+                ruta_tmp, tamano = guardar_temporal(archivo)
+                trabajo = gestor_trabajos.enviar('validar-consumo' if dry_run else 'cargar-consumo',
+                                                 lambda t: procesar_consumo(ruta_tmp, t, dry_run),
+                                                 ruta_tmp=ruta_tmp, bytes_totales=tamano)
+                return respuesta_trabajo(trabajo)
+            if PROCESOS_CONSUMO > 1:
+                # Modo paralelo: los procesos leen cada uno su trozo del archivo en disco
+                resultado = cargar_consumo_paralelo(archivo, dry_run)
+            else:
+                # Se procesa en streaming desde la subida: el archivo nunca se carga completo en memoria.
+                # La codificación la resuelve el parser (declaración XML o UTF-8 por defecto)
+                resultado = datalake.cargar_consumo_desde_xml(archivo.stream, dry_run=dry_run) # Datalake guarda por lotes
             status_code = 200 if resultado["status"] == "success" else 500
-            # No es necesario guardar aquí, cargar_consumo_desde_xml_string ya lo hace
-            # if resultado["status"] == "success":
-            #    datalake.guardar_a_xml()
             return jsonify(resultado), status_code
-        except UnicodeDecodeError:
-             return jsonify({"status": "error", "message": "Error de codificación. Asegúrese que el archivo sea UTF-8."}), 400
         except Exception as e:
             print(f"Error inesperado en /cargar-consumo: {e}")
             import traceback
             traceback.print_exc()
             return jsonify({"status": "error", "message": f"Error inesperado al procesar el archivo: {e}"}), 500
 
+@app.route('/consumos/bulk', methods=['POST'])
+def consumos_bulk():
+    """
+    Carga masiva de consumos en NDJSON (application/x-ndjson), pensada para medidores:
+    un objeto por línea con nitCliente, idInstancia, tiempo y fechaHora.
+    El cuerpo se lee en streaming (admite Transfer-Encoding: chunked) y se aplica por lotes,
+    con la misma validación que /cargar-consumo. Responde un solo resumen para todos los registros.
+    """
+    try:
+        resultado = datalake.cargar_consumo_ndjson(request.stream)
+        status_code = 200 if resultado["status"] == "success" else 500
+        return jsonify(resultado), status_code
+    except Exception as e:
+        print(f"Error inesperado en /consumos/bulk: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"status": "error", "message": f"Error inesperado al procesar los consumos: {e}"}), 500
+
 @app.route('/consultar-datos', methods=['GET'])
 def consultar_datos():
     """ Endpoint para obtener un resumen de los datos actuales del Datalake. """
@@ -132,8 +239,7 @@ def crear_recurso():
         tipo=tipo_recurso,
         valor_x_hora=valor_hora
     )
-    datalake.recursos.append(nuevo_recurso)
-    datalake.guardar_a_xml() # Persistir cambio
+    datalake.agregar_recurso(nuevo_recurso) # Aplica y persiste el cambio
     return jsonify({"status": "success", "message": "Recurso creado exitosamente."}), 201
 
 @app.route('/crear-categoria', methods=['POST'])
@@ -161,8 +267,7 @@ def crear_categoria():
         carga_trabajo=str(data['carga_trabajo']).strip(),
         configuraciones=[] # Nueva categoría inicia sin configuraciones
     )
-    datalake.categorias.append(nueva_categoria)
-    datalake.guardar_a_xml() # Persistir cambio
+    datalake.agregar_categoria(nueva_categoria) # Aplica y persiste el cambio
     return jsonify({"status": "success", "message": "Categoría creada exitosamente."}), 201
 
 @app.route('/crear-configuracion', methods=['POST'])
@@ -219,8 +324,7 @@ def crear_configuracion():
         descripcion=str(data['descripcion']).strip(),
         recursos=recursos_config_obj
     )
-    categoria.configuraciones.append(nueva_configuracion)
-    datalake.guardar_a_xml() # Persistir cambio
+    datalake.agregar_configuracion(categoria.id, nueva_configuracion) # Aplica y persiste el cambio
     return jsonify({"status": "success", "message": "Configuración creada exitosamente."}), 201
 
 
@@ -250,8 +354,7 @@ def crear_cliente():
         correo=str(data['correo']).strip(),
         instancias=[]
     )
-    datalake.clientes.append(nuevo_cliente)
-    datalake.guardar_a_xml() # Persistir cambio
+    datalake.agregar_cliente(nuevo_cliente) # Aplica y persiste el cambio
     return jsonify({"status": "success", "message": "Cliente creado exitosamente."}), 201
 
 
@@ -296,11 +399,9 @@ def crear_instancia():
         nombre=str(data['nombre']).strip(),
         fecha_inicio=fecha_inicio_valida, # Guarda la fecha extraída/validada
         estado='Vigente', # Nueva instancia siempre inicia Vigente
-        fecha_final=None,
-        consumos=[]
+        fecha_final=None # Sin consumos pendientes
     )
-    cliente.instancias.append(nueva_instancia)
-    datalake.guardar_a_xml() # Persistir cambio
+    datalake.agregar_instancia(nit, nueva_instancia) # Aplica y persiste el cambio
     return jsonify({"status": "success", "message": "Instancia creada exitosamente."}), 201
 
 @app.route('/cancelar-instancia', methods=['POST'])
@@ -332,11 +433,8 @@ def cancelar_instancia():
     if instancia.estado == 'Cancelada':
         return jsonify({"status": "warning", "message": f"La instancia ID {id_inst} ya estaba cancelada."}), 200 # O 400 si se prefiere error
 
-    instancia.estado = 'Cancelada'
-    instancia.fecha_final = fecha_final_valida
     # Los consumos pendientes NO se limpian aquí, se limpian al facturar.
-
-    datalake.guardar_a_xml() # Persistir cambio
+    datalake.cancelar_instancia(nit, id_inst, fecha_final_valida) # Aplica y persiste el cambio
     return jsonify({"status": "success", "message": f"Instancia ID {id_inst} cancelada exitosamente."}), 200
 
 
@@ -358,94 +456,26 @@ def generar_factura():
 
     # --- CORRECCIÓN: Generar fecha_factura aquí ---
     fecha_factura_dt = datetime.now()
-    fecha_factura_str = fecha_factura_dt.strftime('%d/%m/%Y') # Formato dd/mm/yyyy
 
     cliente = datalake.find_cliente(nit_cliente)
     if not cliente:
         return jsonify({"status": "error", "message": f"Cliente con NIT {nit_cliente} no encontrado"}), 404
 
-    total_factura_general = 0.0
-    detalles_instancias_facturadas = []
-    instancias_procesadas_ids = [] # Para saber qué instancias limpiar
-
-    for instancia in cliente.instancias:
-        # Solo procesa instancias VIGENTES y con consumos pendientes
-        if instancia.estado != 'Vigente' or not instancia.consumos:
-            continue
-
-        configuracion = datalake.find_configuracion(instancia.id_configuracion)
-        if not configuracion:
-            print(f"Advertencia (Factura): Configuración ID {instancia.id_configuracion} para Instancia ID {instancia.id} (NIT {nit_cliente}) no encontrada. Omitiendo instancia.")
-            continue # Salta esta instancia si su config no existe
-
-        categoria = datalake.find_categoria_por_config(instancia.id_configuracion) # Necesario para reportes
-
-        horas_consumidas_instancia = sum(instancia.consumos)
-        costo_instancia_actual = 0.0
-        detalles_recursos_facturados = []
-
-        for rec_conf in configuracion.recursos:
-            recurso = datalake.find_recurso(rec_conf.id_recurso)
-            if not recurso:
-                 print(f"Advertencia (Factura): Recurso ID {rec_conf.id_recurso} de Config ID {configuracion.id} no encontrado. Omitiendo costo de este recurso.")
-                 continue # Salta este recurso si no existe globalmente
-
-            costo_recurso_en_instancia = rec_conf.cantidad * recurso.valor_x_hora * horas_consumidas_instancia
-            costo_instancia_actual += costo_recurso_en_instancia
-
-            # Usar nombres correctos de models.py
-            detalles_recursos_facturados.append(DetalleRecursoInstancia(
-                id_recurso=recurso.id,
-                nombre_recurso=recurso.nombre,
-                cantidad=rec_conf.cantidad,
-                metrica=recurso.metrica,
-                valor_x_hora=recurso.valor_x_hora,
-                subtotal=round(costo_recurso_en_instancia, 2)
-            ))
-
-        total_factura_general += costo_instancia_actual
-        instancias_procesadas_ids.append(instancia.id) # Marcar para limpiar consumos
-
-        # Usar nombres correctos de models.py
-        detalles_instancias_facturadas.append(DetalleInstanciaFactura(
-            id_instancia=instancia.id,
-            nombre_instancia=instancia.nombre,
-            id_configuracion=configuracion.id,
-            nombre_configuracion=configuracion.nombre,
-            horas_consumidas=round(horas_consumidas_instancia, 2),
-            subtotal_instancia=round(costo_instancia_actual, 2),
-            id_categoria=categoria.id if categoria else None, # Añadir ID categoría
-            recursos_costo=detalles_recursos_facturados
-        ))
-
-    if not detalles_instancias_facturadas:
+    # Arma la factura, limpia los consumos de las instancias procesadas y persiste ambos cambios
+    nueva_factura = facturar_cliente(datalake, cliente, fecha_factura_dt)
+    if not nueva_factura:
         return jsonify({
             "status": "info", # Cambiado a 'info' para indicar que no hubo error pero no se hizo nada
             "message": "No se encontraron consumos pendientes para facturar en instancias vigentes de este cliente."
         }), 200
+    id_factura_unico = nueva_factura.id
 
-    # Generar número único de factura
-    num_factura_actual = len(datalake.facturas) + 1
-    # Genera un ID más robusto para evitar colisiones simples
-    id_factura_unico = f"F-{fecha_factura_dt.strftime('%Y%m%d')}-{num_factura_actual}"
-
-    nueva_factura = Factura(
-        id=id_factura_unico, # Usar ID único
-        nit_cliente=nit_cliente,
-        nombre_cliente=cliente.nombre, # Añadir nombre para conveniencia
-        fecha_factura=fecha_factura_str, # Fecha de hoy (dd/mm/yyyy)
-        monto_total=round(total_factura_general, 2),
-        detalles_instancias=detalles_instancias_facturadas
-    )
-    datalake.facturas.append(nueva_factura)
-
-    # Limpiar consumos de las instancias procesadas
-    for inst_id in instancias_procesadas_ids:
-        instancia = datalake.find_instancia(nit_cliente, inst_id)
-        if instancia:
-            instancia.consumos.clear()
-
-    datalake.guardar_a_xml() # Persistir la nueva factura y la limpieza de consumos
+    # La factura debe estar en disco antes de confirmarla al cliente
+    if not datalake.esperar_persistencia(timeout=10):
+        return jsonify({
+            "status": "error",
+            "message": f"Factura {id_factura_unico} generada pero no se pudo confirmar su escritura en disco. Revise los logs del backend."
+        }), 503
 
     # Devolver la factura generada como JSON
     return jsonify({
@@ -454,6 +484,70 @@ def generar_factura():
         "factura": nueva_factura.to_dict() # Asume que Factura tiene to_dict()
     }), 201 # 201 Created
 
+@app.route('/factura/preview', methods=['GET'])
+def vista_previa_factura():
+    """
+    Vista previa de la factura de un cliente (?nit=): lo que cobraría /generar-factura en este momento,
+    sin generarla ni limpiar sus consumos. La cotización se reutiliza mientras no cambien los consumos,
+    las instancias o las tarifas del cliente ('en_cache' indica si se calculó en esta consulta).
+    """
+    nit_cliente = request.args.get('nit')
+    if not nit_cliente:
+        return jsonify({"status": "error", "message": "Falta NIT del cliente."}), 400
+
+    cliente = datalake.find_cliente(nit_cliente)
+    if not cliente:
+        return jsonify({"status": "error", "message": f"Cliente con NIT {nit_cliente} no encontrado"}), 404
+
+    cotizacion, en_cache = cotizar_cliente(datalake, cliente)
+    if not cotizacion["detalles_instancias"]:
+        return jsonify({
+            "status": "info",
+            "message": "No se encontraron consumos pendientes para facturar en instancias vigentes de este cliente.",
+            "cotizacion": cotizacion,
+            "en_cache": en_cache
+        }), 200
+
+    return jsonify({
+        "status": "success",
+        "message": f"Vista previa: se facturarían {cotizacion['monto_total']} por {len(cotizacion['detalles_instancias'])} instancias.",
+        "cotizacion": cotizacion,
+        "en_cache": en_cache
+    }), 200
+
+@app.route('/facturacion/masiva', methods=['POST'])
+def facturar_masivo():
+    """
+    Factura en una sola pasada a todos los clientes con consumos pendientes en instancias vigentes
+    (o solo a los NIT de 'nits' en el cuerpo JSON). Se escribe una sola vez al final y se responde
+    un resumen compacto con el total por cliente, no las facturas completas.
+    """
+    data = request.get_json(silent=True) or {}
+    nits = data.get('nits')
+    if nits is not None and (not isinstance(nits, list) or not all(isinstance(n, str) for n in nits)):
+        return jsonify({"status": "error", "message": "'nits' debe ser una lista de NIT."}), 400
+
+    resumen = facturacion_masiva(datalake, nits)
+    if not resumen["facturas_generadas"]:
+        return jsonify({
+            "status": "info",
+            "message": "No se encontraron consumos pendientes para facturar en instancias vigentes.",
+            "resumen": resumen
+        }), 200
+    # Las facturas deben estar en disco antes de confirmarlas
+    if not datalake.esperar_persistencia(timeout=30):
+        return jsonify({
+            "status": "error",
+            "message": f"Se generaron {resumen['facturas_generadas']} facturas pero no se pudo confirmar su escritura en disco. Revise los logs del backend.",
+            "resumen": resumen
+        }), 503
+
+    return jsonify({
+        "status": "success",
+        "message": f"{resumen['facturas_generadas']} facturas generadas por un total de {resumen['monto_total']}.",
+        "resumen": resumen
+    }), 201
+
 # --- Endpoints de Reportes ---
 
 def parse_date_range(args):
@@ -475,38 +569,16 @@ def parse_date_range(args):
     # Devolver objetos datetime
     return fecha_inicio_dt, fecha_fin_dt
 
-def filter_facturas_by_date(fecha_inicio_dt, fecha_fin_dt):
-    """ Filtra las facturas del datalake por rango de fechas (objetos datetime). """
-    facturas_filtradas = []
-    for f in datalake.facturas:
-        try:
-            # Convertir fecha de factura (dd/mm/yyyy) a datetime
-            fecha_factura_dt = datetime.strptime(f.fecha_factura, '%d/%m/%Y')
-            # Comparar fechas completas (sin hora)
-            if fecha_inicio_dt.date() <= fecha_factura_dt.date() <= fecha_fin_dt.date():
-                facturas_filtradas.append(f)
-        except (ValueError, TypeError):
-            print(f"Advertencia: Ignorando factura ID {f.id} con fecha inválida '{f.fecha_factura}'")
-            continue # Ignora facturas con fecha inválida
-    return facturas_filtradas
-
 @app.route('/reporte/ventas-recurso', methods=['GET']) # Cambiado a GET para reportes
 def reporte_ventas_recurso():
     """ Reporte: Recursos que más ingresos generan en un rango de fechas. """
     try:
         fecha_inicio_dt, fecha_fin_dt = parse_date_range(request.args)
-        facturas_filtradas = filter_facturas_by_date(fecha_inicio_dt, fecha_fin_dt)
     except ValueError as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
-    ingresos_por_recurso = {} # {id_recurso: total_generado}
-
-    for factura in facturas_filtradas:
-        for detalle_inst in factura.detalles_instancias:
-            for detalle_rec in detalle_inst.recursos_costo:
-                id_rec = detalle_rec.id_recurso
-                subtotal_rec = detalle_rec.subtotal
-                ingresos_por_recurso[id_rec] = ingresos_por_recurso.get(id_rec, 0.0) + subtotal_rec
+    # {id_recurso: total_generado}, de los rollups diarios del Datalake
+    ingresos_por_recurso = datalake.ingresos_por_recurso(fecha_inicio_dt.date(), fecha_fin_dt.date())
 
     # Mapear IDs a nombres y ordenar
     resultado = {}
@@ -532,18 +604,11 @@ def reporte_ventas_categoria():
     """ Reporte: Categorías/Configuraciones que más ingresos generan en un rango de fechas. """
     try:
         fecha_inicio_dt, fecha_fin_dt = parse_date_range(request.args)
-        facturas_filtradas = filter_facturas_by_date(fecha_inicio_dt, fecha_fin_dt)
     except ValueError as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
     # Cambiamos a ingresos por configuración, ya que la categoría se deriva
-    ingresos_por_config = {} # {id_config: total_generado}
-
-    for factura in facturas_filtradas:
-        for detalle_inst in factura.detalles_instancias:
-            id_conf = detalle_inst.id_configuracion
-            subtotal_inst = detalle_inst.subtotal_instancia
-            ingresos_por_config[id_conf] = ingresos_por_config.get(id_conf, 0.0) + subtotal_inst
+    ingresos_por_config = datalake.ingresos_por_configuracion(fecha_inicio_dt.date(), fecha_fin_dt.date()) # {id_config: total_generado}
 
     # Mapear IDs a nombres (Config y Cat) y ordenar
     resultado = {}
@@ -565,12 +630,20 @@ def reporte_ventas_categoria():
      # Ordenar por valor descendente
     resultado_ordenado = dict(sorted(resultado.items(), key=lambda item: item[1], reverse=True))
 
+    # Totales por categoría, según la categoría registrada en cada factura
+    por_categoria = {}
+    for id_cat, total in datalake.ingresos_por_categoria(fecha_inicio_dt.date(), fecha_fin_dt.date()).items():
+        cat = datalake.find_categoria(id_cat)
+        nombre = f"{cat.nombre} (ID: {id_cat})" if cat else f"Categoría Desconocida (ID: {id_cat})"
+        por_categoria[nombre] = round(total, 2)
+
     return jsonify({
         "status": "success",
         "tipo_reporte": "Categorías/Configuraciones",
         "fecha_inicio": fecha_inicio_dt.strftime('%d/%m/%Y'), # Devolver en formato dd/mm/yyyy
         "fecha_fin": fecha_fin_dt.strftime('%d/%m/%Y'),       # Devolver en formato dd/mm/yyyy
-        "data": resultado_ordenado
+        "data": resultado_ordenado,
+        "por_categoria": dict(sorted(por_categoria.items(), key=lambda item: item[1], reverse=True))
     })
 
 
@@ -0,0 +1,76 @@
+"""
+Compara los dos motores de cálculo de facturas (facturacion.detalles_instancias): escalar y numpy.
+Para cada tamaño de lote verifica que los detalles sean idénticos y mide el tiempo de cada
+motor; el primer tamaño en que numpy gana es el punto de cruce que conviene usar como
+DATALAKE_UMBRAL_NUMPY.
+
+    python benchmark_facturacion.py [tamaños...] [--configuraciones N] [--recursos N]
+"""
+import sys
+import time
+import random
+import argparse
+from models import Instancia, TarifaConfiguracion
+import facturacion
+
+
+def generar_lote(instancias, configuraciones, recursos, semilla=1):
+    """ (instancia, tarifa) sintéticos: tarifas de 1 a 8 líneas sobre un catálogo de recursos. """
+    azar = random.Random(semilla)
+    precios = [round(azar.uniform(0.01, 50), 2) for _ in range(recursos)]
+    tarifas = []
+    for id_conf in range(configuraciones):
+        tarifa = TarifaConfiguracion(id_conf, f"Config {id_conf}", id_conf % 5, 0.0)
+        for id_rec in azar.sample(range(recursos), azar.randint(1, min(8, recursos))):
+            cantidad = float(azar.choice([0.5, 1, 2, 4, 8, 16]))
+            tarifa_linea = cantidad * precios[id_rec]
+            tarifa.tarifa_hora += tarifa_linea
+            tarifa.lineas.append((id_rec, f"Recurso {id_rec}", cantidad, "u", precios[id_rec], tarifa_linea))
+        tarifas.append(tarifa)
+    pares = []
+    for id_inst in range(instancias):
+        tarifa = azar.choice(tarifas)
+        instancia = Instancia(id_inst, tarifa.id_configuracion, f"Instancia {id_inst}", "01/01/2025", "Vigente")
+        instancia.horas_pendientes = round(azar.uniform(0, 720), azar.choice([1, 2, 3]))
+        instancia.cantidad_pendientes = 1
+        pares.append((instancia, tarifa))
+    return pares
+
+
+def medir(funcion, repeticiones):
+    mejor = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        transcurrido = time.perf_counter() - inicio
+        mejor = transcurrido if mejor is None else min(mejor, transcurrido)
+    return mejor, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("tamanos", nargs="*", type=int, default=[10, 100, 500, 1000, 2000, 5000, 10000, 50000, 100000])
+    parser.add_argument("--configuraciones", type=int, default=200)
+    parser.add_argument("--recursos", type=int, default=50)
+    args = parser.parse_args()
+    if facturacion.np is None:
+        sys.exit("numpy no está instalado: solo está disponible el motor escalar.")
+
+    cruce = None
+    print(f"{'instancias':>10} {'escalar (ms)':>13} {'numpy (ms)':>11} {'aceleración':>12}")
+    for tamano in args.tamanos:
+        pares = generar_lote(tamano, args.configuraciones, args.recursos)
+        repeticiones = max(1, min(20, 20000 // max(tamano, 1)))
+        t_escalar, escalar = medir(lambda: facturacion.detalles_instancias(pares, 'escalar'), repeticiones)
+        t_numpy, vectorizado = medir(lambda: facturacion.detalles_instancias(pares, 'numpy'), repeticiones)
+        if escalar != vectorizado:
+            sys.exit(f"Los motores difieren con {tamano} instancias.")
+        if cruce is None and t_numpy < t_escalar:
+            cruce = tamano
+        print(f"{tamano:>10} {t_escalar * 1000:>13.2f} {t_numpy * 1000:>11.2f} {t_escalar / t_numpy:>11.2f}x")
+    print(f"Resultados idénticos en todos los tamaños. Punto de cruce: "
+          f"{cruce if cruce is not None else 'numpy no ganó en los tamaños probados'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,341 +1,669 @@
 import os
+import time
+import atexit
+import threading
+import bisect
+import json
+from contextlib import nullcontext
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from types import SimpleNamespace
+from dataclasses import asdict, replace
 # CORRECCIÓN: Nombres de import actualizados
 from models import (
     Recurso, Categoria, Configuracion, RecursoConfiguracion,
-    Cliente, Instancia, Factura, DetalleInstanciaFactura, DetalleRecursoInstancia
+    Cliente, Instancia, Factura, DetalleInstanciaFactura, DetalleRecursoInstancia,
+    TarifaConfiguracion
 )
-from utils import extraer_fecha, validar_nit
+from utils import (
+    fecha_a_ordinal, SIN_MARCA, huella_consumo, huella_contenido, huella_archivo, marca_actual
+)
+from almacenamiento import ErrorPersistencia, AlmacenamientoXML, UMBRAL_COMPACTACION
+from almacenamiento_sqlite import AlmacenamientoSQLite
+from almacenamiento_fragmentado import AlmacenamientoFragmentado
+from ingesta_paralela import validar_consumo, validar_consumo_json, parsear_consumos
+from ingesta_configuracion import leer_configuracion, fusionar, SECCIONES
+from errores_carga import ErroresCarga
+from ingresos_diarios import IngresosDiarios
+from huellas_consumo import TOLERANCIA_FUTURO
+
+LOTE_CONSUMOS = 5000 # Consumos por lote en la carga en streaming
+
 
 class Datalake:
-    def __init__(self, db_filename="db_persistente.xml"):
+    def __init__(self, db_filename="db_persistente.xml", modo_journal=False, umbral_compactacion=UMBRAL_COMPACTACION,
+                 carga_facturas="inmediata", group_commit_ms=None, group_commit_max=100,
+                 generaciones_conservadas=3, almacenamiento=None, conservar_consumos=True):
         self.recursos = []
         self.categorias = []
         self.clientes = []
-        self.facturas = []
-        self.db_file = db_filename
-        # CORRECCIÓN: Mover creación de directorio a guardar_a_xml
-        # os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
-        self.cargar_desde_xml_persistente()
-
-    def cargar_desde_xml_string(self, xml_string):
-        """ Parsea el XML de configuración inicial y carga los datos en memoria, haciendo merge. """
-        current_recursos = {r.id: r for r in self.recursos}
-        current_categorias = {c.id: c for c in self.categorias}
-        current_configs = {conf.id: conf for cat in self.categorias for conf in cat.configuraciones}
-        current_clientes = {cli.nit: cli for cli in self.clientes}
-        current_instancias = {(inst.id, cli.nit): inst for cli in self.clientes for inst in cli.instancias}
-
-        # No limpiamos nada al inicio, hacemos merge
-        nuevos = {'recursos': 0, 'categorias': 0, 'configuraciones': 0, 'clientes': 0, 'instancias': 0}
-        actualizados = {'recursos': 0, 'categorias': 0, 'configuraciones': 0, 'clientes': 0, 'instancias': 0}
-        errores = []
-        ids_config_procesadas_en_este_xml = set()
+        self._facturas = []
+        # Índice de facturas por fecha: (ordinales ordenados, facturas en el mismo orden), o None si hay que construirlo
+        self._idx_fechas = None
+        # Backend de persistencia; por defecto el snapshot XML (con journal si modo_journal)
+        self.almacenamiento = almacenamiento or AlmacenamientoXML(
+            db_filename, modo_journal=modo_journal, umbral_compactacion=umbral_compactacion,
+            generaciones_conservadas=generaciones_conservadas)
+        # Carga de las facturas al iniciar: 'inmediata', 'diferida' (al primer acceso) o 'segundo_plano'
+        self.carga_facturas = carga_facturas
+        # Si es False, los consumos solo suman a los acumulados de la instancia y no se guardan uno por uno
+        self.conservar_consumos = conservar_consumos
+        # Huellas de los archivos de consumo ya cargados sin errores (utils.huella_archivo)
+        self.huellas_archivos = set()
+        # Huellas de archivos que se están cargando en streaming (ver _reservar_archivo); protegidas por self.lock
+        self._archivos_en_curso = set()
+        # Rollups de ingresos por día (ingresos_diarios.py). El almacenamiento los carga si los guardó;
+        # con None se reconstruyen desde las facturas en el primer uso (ver _ingresos_diarios_listos)
+        self.ingresos_diarios = None
+        self._carga_facturas = None # Función del almacenamiento que completa la carga de facturas
+        self._lock_facturas = threading.Lock()
+        # Facturas del journal reaplicadas mientras la carga sigue pendiente: van después de las del
+        # snapshot, así que se añaden al terminarla. _lock_recuperadas no se retiene junto con otro lock.
+        self._facturas_recuperadas = []
+        self._lock_recuperadas = threading.Lock()
+        self.secuencia = 0 # Número de secuencia de la última mutación aplicada
+        self._cambios_pendientes = [] # Registros aún no persistidos
+        self.lock = threading.RLock() # Protege los modelos en memoria y la secuencia
+        self._lock_escritura = threading.RLock() # Serializa escrituras a disco (journal, snapshot, compactación)
+        # Group commit: persistir() solo marca el estado como sucio y un hilo de fondo escribe
+        # como máximo cada group_commit_ms milisegundos o al acumular group_commit_max mutaciones
+        self.group_commit_ms = group_commit_ms
+        self.group_commit_max = group_commit_max
+        self._cond_escritor = threading.Condition()
+        self._generacion_solicitada = 0 # Se incrementa en cada persistir()
+        self._generacion_persistida = 0 # Última generación que ya está en disco
+        self._forzar_escritura = False
+        self._reindexar()
+        self.cargar()
+        if self.group_commit_ms is not None:
+            threading.Thread(target=self._hilo_escritor, name="group-commit", daemon=True).start()
+            atexit.register(self.esperar_persistencia, 5.0) # No perder el último lote al cerrar
+
+    @property
+    def facturas(self):
+        # Si el historial de facturas aún se está cargando, se espera a que termine
+        if self._carga_facturas is not None:
+            self._completar_carga_facturas()
+        return self._facturas
+
+    @facturas.setter
+    def facturas(self, valor):
+        self._facturas = valor
+        self._idx_fechas = None # Se reconstruye en la próxima consulta por fechas
+
+    def _completar_carga_facturas(self):
+        """ Termina de cargar las facturas (en el hilo de fondo o en el primer acceso). """
+        with self._lock_facturas:
+            completar = self._carga_facturas
+            if completar is None:
+                return # Otro hilo ya terminó la carga
+            try:
+                completar()
+                print(f"{len(self._facturas)} facturas cargadas desde {self.almacenamiento.ruta}")
+            except Exception as e:
+                print(f"Error al cargar las facturas de {self.almacenamiento.ruta}: {e}. Se conservan las {len(self._facturas)} leídas.")
+            finally:
+                with self._lock_recuperadas:
+                    self._facturas.extend(self._facturas_recuperadas)
+                    self._facturas_recuperadas = []
+                    self._carga_facturas = None
+                self._idx_fechas = None
+
+    def cargar_desde_xml_string(self, xml_string, progreso=None, dry_run=False):
+        """
+        Parsea el XML de configuración inicial y carga los datos en memoria, haciendo merge.
+        progreso(procesados, errores) se llama al terminar cada sección (ver trabajos.py).
+        Con dry_run solo se valida: el resumen dice qué se crearía, actualizaría o rechazaría según
+        los índices actuales, sin tomar el lock, sin aplicar cambios y sin persistir.
+        """
+        if dry_run:
+            return self._cargar_desde_xml_string(xml_string, progreso, dry_run=True)
+        with self.lock:
+            resultado = self._cargar_desde_xml_string(xml_string, progreso)
+        # Guardar después de procesar todo el XML (fuera del lock para no bloquear al hilo escritor)
+        if resultado["status"] == "success":
+            self.persistir()
+        return resultado
+
+    def _cargar_desde_xml_string(self, xml_string, progreso=None, dry_run=False):
+        """
+        Merge en tres pasos: el XML se lee a tablas (ingesta_configuracion), se compara contra los índices
+        y solo las entidades nuevas o que cambiaron se aplican, como un lote de mutaciones. Volver a subir
+        el mismo archivo no genera registros ni escrituras.
+        """
+        errores = ErroresCarga()
+        resumen = {seccion: {"nuevos": 0, "actualizados": 0, "sin_cambios": 0} for seccion in SECCIONES}
+
+        def avance(procesados):
+            if progreso:
+                progreso(procesados, errores)
 
         try:
             root = ET.fromstring(xml_string)
-
-            # Cargar/Actualizar Recursos
-            for rec_elem in root.findall('.//listaRecursos/recurso'):
-                try:
-                    rec_id = int(rec_elem.attrib['id'])
-                    recurso_data = Recurso(
-                        id=rec_id,
-                        nombre=rec_elem.findtext('nombre'),
-                        abreviatura=rec_elem.findtext('abreviatura'),
-                        metrica=rec_elem.findtext('metrica'),
-                        tipo=(rec_elem.findtext('tipo') or '').strip().upper(),
-                        valor_x_hora=float(rec_elem.findtext('valorXhora'))
-                    )
-                    if rec_id in current_recursos:
-                        # Actualiza el existente
-                        existing = current_recursos[rec_id]
-                        existing.nombre = recurso_data.nombre or existing.nombre
-                        existing.abreviatura = recurso_data.abreviatura or existing.abreviatura
-                        existing.metrica = recurso_data.metrica or existing.metrica
-                        existing.tipo = recurso_data.tipo or existing.tipo
-                        existing.valor_x_hora = recurso_data.valor_x_hora # Siempre actualiza valor
-                        actualizados['recursos'] += 1
-                    else:
-                        # Añade nuevo
-                        self.recursos.append(recurso_data)
-                        current_recursos[rec_id] = recurso_data # Añade al dict temporal
-                        nuevos['recursos'] += 1
-                except (ValueError, KeyError, AttributeError, TypeError, ET.ParseError) as e:
-                    errores.append(f"Error procesando recurso XML: {e} - {ET.tostring(rec_elem, encoding='unicode')[:100]}")
-
-
-            # Cargar/Actualizar Categorías y Configuraciones
-            for cat_elem in root.findall('.//listaCategorias/categoria'):
-                try:
-                    id_cat = int(cat_elem.attrib['id'])
-                    categoria_existente = current_categorias.get(id_cat)
-
-                    if categoria_existente:
-                        categoria_actual = categoria_existente
-                        categoria_actual.nombre = cat_elem.findtext('nombre') or categoria_actual.nombre
-                        categoria_actual.descripcion = cat_elem.findtext('descripcion') or categoria_actual.descripcion
-                        categoria_actual.carga_trabajo = cat_elem.findtext('cargaTrabajo') or categoria_actual.carga_trabajo
-                        actualizados['categorias'] += 1
-                    else:
-                        categoria_actual = Categoria(
-                            id=id_cat,
-                            nombre=cat_elem.findtext('nombre'),
-                            descripcion=cat_elem.findtext('descripcion'),
-                            carga_trabajo=cat_elem.findtext('cargaTrabajo'),
-                            configuraciones=[]
-                        )
-                        self.categorias.append(categoria_actual)
-                        current_categorias[id_cat] = categoria_actual # Añade al dict temporal
-                        nuevos['categorias'] += 1
-
-                    for conf_elem in cat_elem.findall('.//listaConfiguraciones/configuracion'):
-                        try:
-                            id_conf = int(conf_elem.attrib['id'])
-
-                            # Evitar procesar el mismo ID de config dos veces DESDE ESTE XML
-                            if id_conf in ids_config_procesadas_en_este_xml:
-                                errores.append(f"Configuración ID {id_conf} duplicada dentro del XML. Omitiendo segunda aparición.")
-                                continue
-                            ids_config_procesadas_en_este_xml.add(id_conf)
-
-                            config_existente = current_configs.get(id_conf)
-                            cat_de_existente = self.find_categoria_por_config(id_conf) if config_existente else None
-
-                            # Lógica de validación: No puede existir en otra categoría
-                            if config_existente and cat_de_existente and cat_de_existente.id != categoria_actual.id:
-                                errores.append(f"Configuración ID {id_conf} ya existe en Categoría ID {cat_de_existente.id}. No se puede añadir/modificar en Cat ID {categoria_actual.id}.")
-                                continue
-
-                            recursos_de_config = []
-                            for rec_conf_elem in conf_elem.findall('.//recursosConfiguracion/recurso'):
-                                try:
-                                    rec_id = int(rec_conf_elem.attrib['id'])
-                                    cantidad = float(rec_conf_elem.text)
-                                    if rec_id in current_recursos: # Validar contra recursos ya cargados/existentes
-                                        # Evitar duplicados del mismo recurso dentro de la config
-                                        if not any(rc.id_recurso == rec_id for rc in recursos_de_config):
-                                            recursos_de_config.append(RecursoConfiguracion(id_recurso=rec_id, cantidad=cantidad))
-                                        else:
-                                            errores.append(f"Config ID {id_conf}: Recurso ID {rec_id} duplicado dentro de <recursosConfiguracion>. Omitiendo duplicado.")
-                                    else:
-                                         errores.append(f"Config ID {id_conf}: Recurso ID {rec_id} referenciado no existe en <listaRecursos>.")
-                                except (ValueError, KeyError, AttributeError, TypeError, ET.ParseError) as e_rec:
-                                    errores.append(f"Error proc. recurso en config ID {id_conf}: {e_rec}")
-
-
-                            if config_existente:
-                                # Actualiza la existente (asumiendo que está en la categoría correcta)
-                                config_actual = config_existente
-                                config_actual.nombre = conf_elem.findtext('nombre') or config_actual.nombre
-                                config_actual.descripcion = conf_elem.findtext('descripcion') or config_actual.descripcion
-                                config_actual.recursos = recursos_de_config # Sobrescribe recursos
-                                actualizados['configuraciones'] += 1
-                            else:
-                                # Crea nueva configuración
-                                config_actual = Configuracion(
-                                    id=id_conf,
-                                    nombre=conf_elem.findtext('nombre'),
-                                    descripcion=conf_elem.findtext('descripcion'),
-                                    recursos=recursos_de_config
-                                )
-                                categoria_actual.configuraciones.append(config_actual)
-                                current_configs[id_conf] = config_actual # Añade al dict temporal
-                                nuevos['configuraciones'] += 1
-
-                        except (ValueError, KeyError, AttributeError, TypeError, ET.ParseError) as e_conf:
-                            errores.append(f"Error proc. config en cat ID {categoria_actual.id}: {e_conf} - {ET.tostring(conf_elem, encoding='unicode')[:100]}")
-                except (ValueError, KeyError, AttributeError, TypeError, ET.ParseError) as e_cat:
-                    errores.append(f"Error procesando categoría: {e_cat} - {ET.tostring(cat_elem, encoding='unicode')[:100]}")
-
-            # Cargar/Actualizar Clientes e Instancias
-            for cli_elem in root.findall('.//listaClientes/cliente'):
-                try:
-                    nit = cli_elem.attrib['nit']
-                    if not validar_nit(nit):
-                        errores.append(f"NIT '{nit}' inválido. Saltando cliente.")
-                        continue
-
-                    cliente_existente = current_clientes.get(nit)
-                    if cliente_existente:
-                        cliente_actual = cliente_existente
-                        cliente_actual.nombre = cli_elem.findtext('nombre') or cliente_actual.nombre
-                        cliente_actual.usuario = cli_elem.findtext('usuario') or cliente_actual.usuario
-                        cliente_actual.clave = cli_elem.findtext('clave') or cliente_actual.clave
-                        cliente_actual.direccion = cli_elem.findtext('direccion') or cliente_actual.direccion
-                        cliente_actual.correo = cli_elem.findtext('correoElectronico') or cliente_actual.correo
-                        actualizados['clientes'] += 1
-                    else:
-                        cliente_actual = Cliente(
-                            nit=nit,
-                            nombre=cli_elem.findtext('nombre'),
-                            usuario=cli_elem.findtext('usuario'),
-                            clave=cli_elem.findtext('clave'),
-                            direccion=cli_elem.findtext('direccion'),
-                            correo=cli_elem.findtext('correoElectronico'),
-                            instancias=[]
-                        )
-                        self.clientes.append(cliente_actual)
-                        current_clientes[nit] = cliente_actual # Añade al dict temporal
-                        nuevos['clientes'] += 1
-
-                    for inst_elem in cli_elem.findall('.//listaInstancias/instancia'):
-                        try:
-                            id_inst = int(inst_elem.attrib['id'])
-                            instancia_key = (id_inst, nit)
-                            instancia_existente = current_instancias.get(instancia_key)
-
-                            id_conf_str = inst_elem.findtext('idConfiguracion')
-                            if not id_conf_str:
-                                errores.append(f"Cliente NIT {nit}, Instancia ID {id_inst}: Falta <idConfiguracion>. Saltando.")
-                                continue
-                            id_conf = int(id_conf_str)
-
-                            # Usa el diccionario actualizado de configs para validar
-                            if id_conf not in current_configs:
-                                errores.append(f"Cliente NIT {nit}, Instancia ID {id_inst}: Config ID {id_conf} referenciada no existe globalmente. Saltando instancia.")
-                                continue
-
-                            estado = (inst_elem.findtext('estado') or '').strip().upper()
-                            fecha_inicio = extraer_fecha(inst_elem.findtext('fechaInicio'))
-                            fecha_final = None
-                            if estado == 'CANCELADA':
-                                fecha_final = extraer_fecha(inst_elem.findtext('fechaFinal'))
-
-                            if instancia_existente:
-                                # Actualiza la instancia existente
-                                instancia_actual = instancia_existente
-                                instancia_actual.id_configuracion = id_conf
-                                instancia_actual.nombre = inst_elem.findtext('nombre') or instancia_actual.nombre
-                                instancia_actual.fecha_inicio = fecha_inicio if fecha_inicio else instancia_actual.fecha_inicio
-                                instancia_actual.estado = 'Cancelada' if estado == 'CANCELADA' else 'Vigente'
-                                instancia_actual.fecha_final = fecha_final if instancia_actual.estado == 'Cancelada' else None
-                                # Los consumos NO se tocan al cargar configuración
-                                actualizados['instancias'] += 1
-                            else:
-                                # Crea nueva instancia
-                                instancia_actual = Instancia(
-                                    id=id_inst,
-                                    id_configuracion=id_conf,
-                                    nombre=inst_elem.findtext('nombre'),
-                                    fecha_inicio=fecha_inicio if fecha_inicio else "Fecha Inválida",
-                                    estado='Cancelada' if estado == 'CANCELADA' else 'Vigente',
-                                    fecha_final=fecha_final,
-                                    consumos=[] # Nueva instancia sin consumos
-                                )
-                                cliente_actual.instancias.append(instancia_actual)
-                                current_instancias[instancia_key] = instancia_actual # Añade al dict temporal
-                                nuevos['instancias'] += 1
-                        except (ValueError, KeyError, AttributeError, TypeError, ET.ParseError) as e_inst:
-                            errores.append(f"Error proc. instancia para cliente NIT {nit}: {e_inst}")
-                except (KeyError, AttributeError, TypeError, ET.ParseError) as e_cli:
-                     errores.append(f"Error procesando cliente: {e_cli} - {ET.tostring(cli_elem, encoding='unicode')[:100]}")
+            tablas = leer_configuracion(root, errores)
+            avance(0)
+            plan = self._planificar_configuracion(tablas, errores, avance)
+
+            # Aplicar el lote en orden (las categorías antes que sus configuraciones, los clientes antes que sus instancias)
+            for (op, _), (seccion, anterior, datos) in plan.items():
+                if anterior is None:
+                    resumen[seccion]["nuevos"] += 1
+                elif anterior == datos:
+                    resumen[seccion]["sin_cambios"] += 1
+                    continue
+                else:
+                    resumen[seccion]["actualizados"] += 1
+                if not dry_run:
+                    self._cambio(op, datos)
+            avance(len(plan))
 
             # Construir mensaje de resumen
-            resumen_nuevos = [f"{v} {k}" for k, v in nuevos.items() if v > 0]
-            resumen_actualizados = [f"{v} {k}" for k, v in actualizados.items() if v > 0]
-            mensaje = "Carga de configuración completada. "
+            resumen_nuevos = [f"{v['nuevos']} {k}" for k, v in resumen.items() if v['nuevos'] > 0]
+            resumen_actualizados = [f"{v['actualizados']} {k}" for k, v in resumen.items() if v['actualizados'] > 0]
+            sin_cambios = sum(v['sin_cambios'] for v in resumen.values())
+            mensaje = "Validación de configuración completada (dry run, no se aplicó ningún cambio). " if dry_run \
+                      else "Carga de configuración completada. "
             if resumen_nuevos: mensaje += f"Nuevos: {', '.join(resumen_nuevos)}. "
             if resumen_actualizados: mensaje += f"Actualizados: {', '.join(resumen_actualizados)}. "
             if not resumen_nuevos and not resumen_actualizados: mensaje += "No se realizaron cambios (datos ya existentes o sin cambios)."
+            elif sin_cambios: mensaje += f"Sin cambios: {sin_cambios}."
 
             if errores:
-                mensaje += f" Se encontraron {len(errores)} advertencias/errores durante la carga. Revise los logs del backend."
-                print("\n--- Errores/Advertencias Carga Config XML ---")
-                for i, err in enumerate(errores): print(f"{i+1}. {err}")
-                print("---------------------------------------------\n")
+                mensaje += f" Se encontraron {len(errores)} advertencias/errores durante la carga. Revise el detalle en 'errores'."
+                errores.ubicar(texto=xml_string, raiz=root)
+                errores.registrar_log("Validación de configuración XML (dry run)" if dry_run else "Carga de configuración XML")
 
-            # Guardar después de procesar todo el XML
-            self.guardar_a_xml()
-            return {"status": "success", "message": mensaje}
+            resultado = {"status": "success", "message": mensaje, "resumen": resumen, "errores": errores.a_dict()}
+            if dry_run:
+                resultado["dry_run"] = True
+            return resultado
 
         except ET.ParseError as e:
-            return {"status": "error", "message": f"Error fatal al parsear el XML de configuración: {e}"}
+            self._error_de_parseo(errores, e, "Carga de configuración XML")
+            return {"status": "error", "message": f"Error fatal al parsear el XML de configuración: {e}",
+                    "errores": errores.a_dict()}
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {"status": "error", "message": f"Error inesperado durante carga de configuración: {type(e).__name__} - {e}"}
 
 
+    def _planificar_configuracion(self, tablas, errores, avance):
+        """
+        Compara las tablas leídas del XML con el estado actual. Devuelve un dict ordenado
+        (op, clave) -> (sección, registro anterior o None, registro resultante); una entidad repetida
+        en el XML se fusiona sobre su primera aparición, como si se hubieran aplicado una tras otra.
+        """
+        plan = {}
+        # Un dry run planifica sin el lock: los conjuntos de claves se copian bajo el lock, de una vez
+        with self.lock:
+            recursos_actuales = set(self._idx_recursos)
+            configs_disponibles = set(self._idx_configuraciones)
+
+        def planificar(seccion, op, clave, actual, nuevo, siempre=()):
+            previo = plan.get((op, clave))
+            if previo:
+                anterior, base = previo[1], previo[2]
+            else:
+                anterior = base = actual
+            datos = fusionar(base, nuevo, siempre) if base else nuevo
+            plan[(op, clave)] = (seccion, anterior, datos)
+            return datos
+
+        for datos in tablas["recursos"]:
+            existente = self._idx_recursos.get(datos['id'])
+            planificar('recursos', 'recurso', datos['id'], asdict(existente) if existente else None, datos,
+                       siempre=('valor_x_hora',)) # Siempre actualiza valor
+        recursos_disponibles = recursos_actuales | {datos['id'] for datos in tablas["recursos"]}
+        avance(len(plan))
+
+        for datos_cat, configuraciones in tablas["categorias"]:
+            existente = self._idx_categorias.get(datos_cat['id'])
+            planificar('categorias', 'categoria', datos_cat['id'],
+                       self._datos_categoria(existente) if existente else None, datos_cat)
+            for conf in configuraciones:
+                id_conf = conf['id']
+                actual = self._idx_configuraciones.get(id_conf)
+                # Lógica de validación: No puede existir en otra categoría
+                if actual and actual[0].id != datos_cat['id']:
+                    errores.agregar("configuracion_en_otra_categoria", f"Configuración ID {id_conf} ya existe en Categoría ID {actual[0].id}. No se puede añadir/modificar en Cat ID {datos_cat['id']}.")
+                    continue
+                recursos, vistos = [], set()
+                for rec_id, cantidad in conf['recursos']:
+                    if rec_id not in recursos_disponibles:
+                        errores.agregar("recurso_inexistente", f"Config ID {id_conf}: Recurso ID {rec_id} referenciado no existe en <listaRecursos>.")
+                    elif rec_id in vistos:
+                        errores.agregar("recurso_duplicado", f"Config ID {id_conf}: Recurso ID {rec_id} duplicado dentro de <recursosConfiguracion>. Omitiendo duplicado.")
+                    else:
+                        vistos.add(rec_id)
+                        recursos.append({"id_recurso": rec_id, "cantidad": cantidad})
+                planificar('configuraciones', 'configuracion', id_conf,
+                           self._datos_configuracion(actual[0].id, actual[1]) if actual else None,
+                           dict(conf, recursos=recursos), siempre=('recursos',)) # Sobrescribe recursos
+                configs_disponibles.add(id_conf)
+        avance(len(plan))
+
+        for datos_cli, instancias in tablas["clientes"]:
+            nit = datos_cli['nit']
+            existente = self._idx_clientes.get(nit)
+            planificar('clientes', 'cliente', nit, self._datos_cliente(existente) if existente else None, datos_cli)
+            for inst in instancias:
+                if inst['id_configuracion'] not in configs_disponibles:
+                    errores.agregar("configuracion_inexistente", f"Cliente NIT {nit}, Instancia ID {inst['id']}: Config ID {inst['id_configuracion']} referenciada no existe globalmente. Saltando instancia.")
+                    continue
+                existente = self._idx_instancias.get((nit, inst['id']))
+                datos = planificar('instancias', 'instancia', (nit, inst['id']),
+                                   self._datos_instancia(nit, existente) if existente else None, inst,
+                                   siempre=('id_configuracion', 'estado', 'fecha_final'))
+                if not datos['fecha_inicio']:
+                    datos['fecha_inicio'] = "Fecha Inválida"
+        avance(len(plan))
+        return plan
+
     def cargar_consumo_desde_xml_string(self, xml_string):
         """ Parsea el XML de consumo y lo registra en la instancia correspondiente. """
+        huella = huella_contenido(xml_string)
+        with self.lock: # La huella se comprueba y se registra sin soltar el lock
+            if huella in self.huellas_archivos or huella in self._archivos_en_curso:
+                return self._archivo_repetido(huella)
+            resultado = self._cargar_consumo_desde_xml_string(xml_string, huella)
+        # Guardar después de procesar todos los consumos
+        if resultado["status"] == "success":
+            self.persistir()
+        return resultado
+
+    def _cargar_consumo_desde_xml_string(self, xml_string, huella=None):
         consumos_procesados = 0
-        errores = []
+        duplicados = 0
+        errores = ErroresCarga()
+        ubicacion = errores.ubicacion = {"elemento": "consumo", "indice": 0}
         try:
             root = ET.fromstring(xml_string)
 
-            for consumo_elem in root.findall('.//consumo'):
-                try:
-                    # Usar .get() para evitar KeyError si falta el atributo
-                    nit_cliente = consumo_elem.attrib.get('nitCliente')
-                    id_instancia_str = consumo_elem.attrib.get('idInstancia')
-                    tiempo_str = consumo_elem.findtext('tiempo') # Más seguro que .find().text
-
-                    # Validaciones básicas
-                    if not nit_cliente or not id_instancia_str or tiempo_str is None:
-                        errores.append(f"Consumo inválido (falta nitCliente, idInstancia o tiempo): {ET.tostring(consumo_elem, encoding='unicode')[:100]}")
-                        continue
-
-                    id_instancia = int(id_instancia_str)
-                    tiempo = float(tiempo_str)
-
-                    # Ignora fechaHora por ahora, según enunciado solo importa el tiempo
-
-                    instancia_encontrada = self.find_instancia(nit_cliente, id_instancia)
-
-                    if not instancia_encontrada:
-                        errores.append(f"Instancia ID {id_instancia} para cliente NIT {nit_cliente} no encontrada.")
-                        continue
+            consumos = root.findall('.//consumo')
+            for indice, consumo_elem in enumerate(consumos, 1):
+                ubicacion["indice"] = indice
+                registrado = self._procesar_consumo(consumo_elem, errores)
+                if registrado:
+                    consumos_procesados += 1
+                elif registrado is None:
+                    duplicados += 1
 
-                    if instancia_encontrada.estado != 'Vigente':
-                         errores.append(f"Intento de añadir consumo a instancia ID {id_instancia} (NIT {nit_cliente}) que está '{instancia_encontrada.estado}'.")
-                         continue
+            self._recordar_archivo(huella, errores)
+            errores.ubicar(texto=xml_string)
+            return self._resultado_consumos(len(consumos), consumos_procesados, duplicados, errores, False)
 
-                    # Añadir el consumo a la lista de la instancia
-                    instancia_encontrada.consumos.append(tiempo)
-                    consumos_procesados += 1
-                except (ValueError, TypeError) as e: # Captura errores de conversión int/float
-                     errores.append(f"Error procesando valor en un consumo: {e} - {ET.tostring(consumo_elem, encoding='unicode')[:100]}")
-                except Exception as e: # Captura otros errores inesperados por elemento
-                     errores.append(f"Error inesperado procesando un consumo: {e} - {ET.tostring(consumo_elem, encoding='unicode')[:100]}")
+        except ET.ParseError as e:
+            self._error_de_parseo(errores, e, "Carga de consumo XML")
+            return {"status": "error", "message": f"Error fatal al parsear el XML de consumo: {e}",
+                    "errores": errores.a_dict()}
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return {"status": "error", "message": f"Error inesperado durante carga de consumo: {type(e).__name__} - {e}"}
 
-            mensaje = f"{consumos_procesados} consumos procesados."
-            if errores:
-                 mensaje += f" Se encontraron {len(errores)} advertencias/errores. Revise logs del backend."
-                 print("\n--- Errores/Advertencias Carga Consumo XML ---")
-                 for i, err in enumerate(errores): print(f"{i+1}. {err}")
-                 print("----------------------------------------------\n")
+    def cargar_consumo_desde_xml(self, fuente, lote=LOTE_CONSUMOS, progreso=None, dry_run=False):
+        """
+        Versión en streaming de cargar_consumo_desde_xml_string para archivos grandes.
+        'fuente' es un archivo binario abierto (p. ej. el stream de la subida) o una ruta. Cada <consumo>
+        se procesa en cuanto se cierra y se descarta, así la memoria no depende del tamaño del archivo.
+        Los consumos se aplican y persisten por lotes de 'lote' elementos: el lock solo se toma por lote y
+        los registros pendientes no crecen sin límite. Si el XML se corta a la mitad, los lotes
+        ya aplicados se conservan y el mensaje lo indica. progreso(procesados, errores) se llama tras cada lote.
+        Un archivo idéntico a uno ya cargado se omite completo (si 'fuente' se puede releer para calcular su huella).
+        Con dry_run cada consumo se valida contra los índices actuales (instancia, estado, huellas) sin
+        registrarlo: no se toma el lock ni se persiste, y el resumen dice qué se registraría.
+        """
+        huella = huella_archivo(fuente)
+        if not self._reservar_archivo(huella, dry_run):
+            return self._archivo_repetido(huella, dry_run)
+        try:
+            return self._cargar_consumo_desde_xml(fuente, huella, lote, progreso, dry_run)
+        finally:
+            self._liberar_archivo(huella, dry_run)
+
+    def _cargar_consumo_desde_xml(self, fuente, huella, lote, progreso, dry_run):
+        """ Cuerpo de cargar_consumo_desde_xml, con la huella del archivo ya reservada. """
+        # Dónde empieza el documento, para releerlo al ubicar los errores (ver errores_carga.py)
+        inicio = fuente.tell() if not isinstance(fuente, (str, os.PathLike)) and huella is not None else 0
+        consumos_procesados = 0
+        duplicados = 0
+        leidos = 0 # <consumo> vistos, para la ubicación de los errores
+        errores = ErroresCarga()
+        ubicacion = errores.ubicacion = {"elemento": "consumo", "indice": 0}
+        pendientes = [] # (índice, elemento <consumo>) del lote en curso (ya separados del árbol)
+        padres = [] # Pila de elementos abiertos, para soltar cada consumo de su padre
+        vistas = set() if dry_run else None # Huellas del archivo, para los repetidos dentro de una validación
+
+        def aplicar_lote():
+            nonlocal consumos_procesados, duplicados
+            if not pendientes:
+                return
+            with nullcontext() if dry_run else self.lock:
+                for ubicacion["indice"], consumo_elem in pendientes:
+                    registrado = self._procesar_consumo(consumo_elem, errores, vistas)
+                    if registrado:
+                        consumos_procesados += 1
+                    elif registrado is None:
+                        duplicados += 1
+            pendientes.clear()
+            if not dry_run:
+                self.persistir()
+                self.esperar_persistencia() # Contrapresión: no leer más rápido de lo que se escribe
+            if progreso:
+                progreso(consumos_procesados, errores)
 
-            # Guardar después de procesar todos los consumos
-            self.guardar_a_xml()
-            return {"status": "success", "message": mensaje}
+        try:
+            for evento, elem in ET.iterparse(fuente, events=('start', 'end')):
+                if evento == 'start':
+                    padres.append(elem)
+                    continue
+                padres.pop()
+                if elem.tag != 'consumo':
+                    continue
+                if padres:
+                    padres[-1].remove(elem) # El árbol parcial de iterparse no retiene los ya leídos
+                leidos += 1
+                pendientes.append((leidos, elem))
+                if len(pendientes) >= lote:
+                    aplicar_lote()
+            aplicar_lote()
+            if not dry_run and self._recordar_archivo(huella, errores):
+                self.persistir()
+            self._ubicar_en_fuente(errores, fuente, inicio)
+            return self._resultado_consumos(leidos, consumos_procesados, duplicados, errores, dry_run)
 
         except ET.ParseError as e:
-            return {"status": "error", "message": f"Error fatal al parsear el XML de consumo: {e}"}
+            aplicar_lote() # Lo leído antes del error es válido y se conserva
+            self._ubicar_en_fuente(errores, fuente, inicio)
+            self._error_de_parseo(errores, e, "Validación de consumo XML (dry run)" if dry_run else "Carga de consumo XML")
+            resultado = {"status": "error", "message": f"Error fatal al parsear el XML de consumo: {e}. "
+                                                       f"{'Se habrían registrado' if dry_run else 'Se registraron'} "
+                                                       f"{consumos_procesados} consumos antes del error.",
+                         "errores": errores.a_dict()}
+            if dry_run:
+                resultado["dry_run"] = True
+            return resultado
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {"status": "error", "message": f"Error inesperado durante carga de consumo: {type(e).__name__} - {e}"}
 
-    def reset_datos(self):
-        """ Limpia todos los datos en memoria y el archivo XML persistente. """
-        self.recursos.clear()
-        self.categorias.clear()
-        self.clientes.clear()
-        self.facturas.clear()
+    def cargar_consumo_paralelo(self, ruta, procesos=None, progreso=None, dry_run=False):
+        """
+        Carga un archivo de consumo grande parseándolo en 'procesos' procesos (por defecto uno por CPU).
+        El parseo y la validación de cada trozo van en paralelo; el registro en las instancias se hace
+        aquí, en orden de documento, así el resultado y el reporte de errores son los del camino secuencial.
+        Si el archivo no se puede repartir de forma segura se procesa en streaming.
+        dry_run como en cargar_consumo_desde_xml.
+        """
+        procesos = procesos or os.cpu_count() or 1
+        huella = huella_archivo(ruta)
+        if huella in self.huellas_archivos:
+            return self._archivo_repetido(huella, dry_run)
         try:
-            if os.path.exists(self.db_file):
-                # Opcional: Escribir un archivo vacío en lugar de borrarlo
-                # self.guardar_a_xml() # Guardará un estado vacío
-                os.remove(self.db_file) # Borra el archivo
-                print(f"Archivo {self.db_file} eliminado.")
-            # Asegura que al reiniciar se cree el archivo vacío si no existe
-            self.guardar_a_xml()
-        except OSError as e:
-            print(f"Error al manejar {self.db_file} en reset: {e}")
+            resultados = parsear_consumos(ruta, procesos)
         except Exception as e:
-             print(f"Error inesperado en reset_datos: {e}")
+            print(f"Advertencia: falló el parseo en paralelo de {ruta} ({type(e).__name__}: {e}). Se usa el camino secuencial.")
+            resultados = None
+        if resultados is None:
+            with open(ruta, "rb") as f:
+                return self.cargar_consumo_desde_xml(f, progreso=progreso, dry_run=dry_run)
+        if not self._reservar_archivo(huella, dry_run):
+            return self._archivo_repetido(huella, dry_run)
+        try:
+            return self._registrar_resultados(ruta, huella, resultados, progreso, dry_run)
+        finally:
+            self._liberar_archivo(huella, dry_run)
+
+    def _registrar_resultados(self, ruta, huella, resultados, progreso, dry_run):
+        """ Registra en orden los consumos ya parseados por parsear_consumos (ver cargar_consumo_paralelo). """
+        consumos_procesados = 0
+        duplicados = 0
+        errores = ErroresCarga()
+        ubicacion = errores.ubicacion = {"elemento": "consumo", "indice": 0}
+        vistas = set() if dry_run else None
+        for inicio in range(0, len(resultados), LOTE_CONSUMOS):
+            with nullcontext() if dry_run else self.lock:
+                for ubicacion["indice"], resultado in enumerate(resultados[inicio:inicio + LOTE_CONSUMOS], inicio + 1):
+                    if resultado[0] == "error":
+                        errores.agregar(resultado[1], resultado[2])
+                        continue
+                    registrado = self._registrar_consumo(*resultado[1:], errores, vistas)
+                    if registrado:
+                        consumos_procesados += 1
+                    elif registrado is None:
+                        duplicados += 1
+            if not dry_run:
+                self.persistir()
+                self.esperar_persistencia()
+            if progreso:
+                progreso(consumos_procesados, errores)
+        if not dry_run and self._recordar_archivo(huella, errores):
+            self.persistir()
+        errores.ubicar(ruta=ruta)
+        return self._resultado_consumos(len(resultados), consumos_procesados, duplicados, errores, dry_run)
+
+    def cargar_consumo_ndjson(self, lineas, lote=LOTE_CONSUMOS, progreso=None):
+        """
+        Carga consumos en NDJSON: un objeto por línea con nitCliente, idInstancia, tiempo y fechaHora.
+        'lineas' es cualquier iterable de líneas (bytes o str), p. ej. el cuerpo de la petición leído en
+        streaming. La validación, las huellas y los lotes son los de cargar_consumo_desde_xml.
+        Además del mensaje devuelve un resumen por registro: registrados, repetidos y rechazados;
+        la línea y el motivo de los rechazos van en la muestra de 'errores'.
+        """
+        resumen = {"recibidos": 0, "registrados": 0, "duplicados": 0, "rechazados": 0}
+        errores = ErroresCarga()
+        ubicacion = errores.ubicacion = {"linea": 0}
+        pendientes = [] # (número de línea, resultado de validar_consumo_json) del lote en curso
+
+        def aplicar_lote():
+            if not pendientes:
+                return
+            with self.lock:
+                for ubicacion["linea"], resultado in pendientes:
+                    if resultado[0] == "error":
+                        errores.agregar(resultado[1], resultado[2])
+                        resumen["rechazados"] += 1
+                        continue
+                    registrado = self._registrar_consumo(*resultado[1:], errores)
+                    if registrado:
+                        resumen["registrados"] += 1
+                    elif registrado is None:
+                        resumen["duplicados"] += 1
+                    else:
+                        resumen["rechazados"] += 1
+            pendientes.clear()
+            self.persistir()
+            self.esperar_persistencia() # Contrapresión, como en la carga XML en streaming
+            if progreso:
+                progreso(resumen["registrados"], errores)
+
+        try:
+            for numero, linea in enumerate(lineas, 1):
+                if not linea.strip():
+                    continue
+                resumen["recibidos"] += 1
+                try:
+                    resultado = validar_consumo_json(json.loads(linea))
+                except ValueError as e: # JSON mal formado o bytes que no son UTF-8
+                    resultado = ("error", "json_invalido", f"JSON inválido: {e}")
+                pendientes.append((numero, resultado))
+                if len(pendientes) >= lote:
+                    aplicar_lote()
+            aplicar_lote()
+        except Exception as e:
+            # El cuerpo se cortó (p. ej. el cliente se desconectó): lo recibido hasta ahí se conserva
+            aplicar_lote()
+            errores.registrar_log("Carga de consumo NDJSON")
+            return {"status": "error", "message": f"Error leyendo el cuerpo NDJSON: {type(e).__name__} - {e}. "
+                                                  f"Se registraron {resumen['registrados']} consumos antes del error.",
+                    "resumen": resumen, "errores": errores.a_dict()}
+        mensaje = self._resumen_consumos(resumen["registrados"], errores, resumen["duplicados"], "Carga de consumo NDJSON")
+        return {"status": "success", "message": mensaje, "resumen": resumen, "errores": errores.a_dict()}
+
+    def _procesar_consumo(self, consumo_elem, errores, vistas=None):
+        """
+        Valida y registra un <consumo>. Devuelve True si se añadió, None si ya estaba registrado
+        o False si no es válido (el motivo queda en errores).
+        """
+        resultado = validar_consumo(consumo_elem)
+        if resultado[0] == "error":
+            errores.agregar(resultado[1], resultado[2])
+            return False
+        return self._registrar_consumo(*resultado[1:], errores, vistas)
+
+    def _registrar_consumo(self, nit_cliente, id_instancia, tiempo, marca, errores, vistas=None):
+        """
+        Registra un consumo ya validado (ver _procesar_consumo). Con 'vistas' (set de huellas) es una
+        validación sin cambios (dry run): se responde lo mismo pero nada se registra y las huellas
+        nuevas van a 'vistas', para reconocer los repetidos dentro del mismo archivo.
+        """
+        instancia_encontrada = self.find_instancia(nit_cliente, id_instancia)
+
+        if not instancia_encontrada:
+            errores.agregar("instancia_no_encontrada", f"Instancia ID {id_instancia} para cliente NIT {nit_cliente} no encontrada.")
+            return False
+
+        if instancia_encontrada.estado != 'Vigente':
+             errores.agregar("instancia_no_vigente", f"Intento de añadir consumo a instancia ID {id_instancia} (NIT {nit_cliente}) que está '{instancia_encontrada.estado}'.")
+             return False
+
+        # Solo los consumos con fechaHora se distinguen entre sí; los que no la tienen quedan
+        # cubiertos por la huella del archivo completo
+        huella = huella_consumo(nit_cliente, id_instancia, marca, tiempo) if marca != SIN_MARCA else None
+        if huella is not None:
+            cliente = self.find_cliente(nit_cliente)
+            if marca > marca_actual() + TOLERANCIA_FUTURO:
+                # Una fecha errónea movería la ventana de huellas y podaría las de las lecturas reales
+                errores.agregar("fecha_futura", f"Consumo de la instancia ID {id_instancia} (NIT {nit_cliente}) con fechaHora "
+                                                f"posterior a la fecha actual.")
+                return False
+            if huella in cliente.huellas_consumo or (vistas is not None and huella in vistas):
+                return None # Repetido (reintento o archivo subido dos veces): no se vuelve a cobrar
+            if cliente.huellas_consumo.fuera_de_ventana(marca):
+                errores.advertir("consumo_fuera_de_ventana", f"Consumo de la instancia ID {id_instancia} (NIT {nit_cliente}) "
+                                                             f"anterior a la ventana de huellas: se registra, pero no se pudo "
+                                                             f"comparar con las lecturas ya podadas.")
+            if vistas is not None:
+                vistas.add(huella)
+            else:
+                cliente.huellas_consumo.agregar(huella, marca)
+        if vistas is not None:
+            return True
+
+        self._acumular_consumo(instancia_encontrada, tiempo, marca, self.conservar_consumos)
+        self._invalidar_cotizacion(nit_cliente)
+        self._registrar('consumo', {"nit": nit_cliente, "id_instancia": id_instancia, "tiempo": tiempo, "marca": marca,
+                                    "conservar": self.conservar_consumos, "huella": huella})
+        return True
+
+    def _acumular_consumo(self, instancia, tiempo, marca, conservar):
+        """ Suma el consumo a los acumulados de la instancia y, si se conservan, lo añade a sus columnas. """
+        instancia.horas_pendientes += tiempo
+        instancia.cantidad_pendientes += 1
+        if conservar:
+            instancia.consumos.append(tiempo)
+            instancia.marcas.append(marca)
+
+    def _recordar_archivo(self, huella, errores):
+        """
+        Registra la huella de un archivo cargado sin errores para omitirlo si se vuelve a subir.
+        Con errores no se registra: puede reintentarse después de corregir (p. ej. crear la instancia)
+        y los consumos con fechaHora que ya entraron se omiten por su propia huella.
+        """
+        if huella is None or errores.hay_errores: # Las advertencias no impiden recordarlo
+            return False
+        self._cambio('archivo', {"huella": huella})
+        return True
+
+    def _reservar_archivo(self, huella, dry_run=False):
+        """
+        Comprueba bajo el lock que el archivo no esté cargado ni cargándose y lo marca como en curso hasta
+        _liberar_archivo: dos subidas idénticas simultáneas no pasan ambas (los consumos sin fechaHora no
+        tienen huella propia y se cobrarían dos veces). Devuelve False si es repetido. Un dry run solo comprueba.
+        """
+        if huella is None:
+            return True # No se pudo calcular: no hay con qué comparar
+        with self.lock:
+            if huella in self.huellas_archivos or huella in self._archivos_en_curso:
+                return False
+            if not dry_run:
+                self._archivos_en_curso.add(huella)
+            return True
+
+    def _liberar_archivo(self, huella, dry_run=False):
+        if huella is not None and not dry_run:
+            with self.lock:
+                self._archivos_en_curso.discard(huella)
+
+    def _archivo_repetido(self, huella, dry_run=False):
+        print(f"Archivo de consumo con huella {huella} ya cargado. Se omite.")
+        if dry_run:
+            return {"status": "success", "dry_run": True,
+                    "message": "El archivo ya había sido cargado. No se registraría ningún consumo."}
+        return {"status": "success", "message": "El archivo ya había sido cargado. No se registraron consumos nuevos."}
+
+    def _resultado_consumos(self, leidos, consumos_procesados, duplicados, errores, dry_run):
+        """ Respuesta de las cargas de consumo XML: mensaje, conteo por registro y errores. """
+        resultado = {
+            "status": "success",
+            "message": self._resumen_consumos(consumos_procesados, errores, duplicados, dry_run=dry_run),
+            "resumen": {"recibidos": leidos, "registrados": consumos_procesados, "duplicados": duplicados,
+                        "rechazados": leidos - consumos_procesados - duplicados},
+            "errores": errores.a_dict()
+        }
+        if dry_run:
+            resultado["dry_run"] = True # En 'resumen', registrados = los que se registrarían
+        return resultado
+
+    def _resumen_consumos(self, consumos_procesados, errores, duplicados=0, titulo="Carga de consumo XML", dry_run=False):
+        """ Mensaje de la carga; los errores (ErroresCarga, ya ubicados) se escriben en el log. """
+        if dry_run:
+            mensaje = f"Validación completada (dry run, no se registró nada): {consumos_procesados} consumos se registrarían."
+            if duplicados:
+                mensaje += f" {duplicados} consumos ya registrados se omitirían."
+            titulo += " (dry run)"
+        else:
+            mensaje = f"{consumos_procesados} consumos procesados."
+            if duplicados:
+                mensaje += f" {duplicados} consumos ya registrados se omitieron."
+        if errores:
+             mensaje += f" Se encontraron {len(errores)} advertencias/errores. Revise el detalle en 'errores'."
+             errores.registrar_log(titulo)
+        return mensaje
+
+    def _error_de_parseo(self, errores, e, titulo):
+        """ Agrega un XML mal formado al colector, con la línea y columna que da el parser, y lo escribe en el log. """
+        linea, columna = getattr(e, 'position', (None, None))
+        errores.agregar("xml_mal_formado", str(e), linea=linea, columna=columna)
+        errores.registrar_log(titulo)
+
+    def _ubicar_en_fuente(self, errores, fuente, inicio):
+        """ Ubica los errores de una carga en streaming releyendo 'fuente' (ruta o archivo con seek). """
+        if isinstance(fuente, (str, os.PathLike)):
+            errores.ubicar(ruta=fuente)
+        else:
+            errores.ubicar(archivo=fuente, inicio=inicio)
+
+    def reset_datos(self):
+        """ Limpia todos los datos en memoria y lo persistido. """
+        with self._lock_escritura, self.lock:
+            self.recursos.clear()
+            self.categorias.clear()
+            self.clientes.clear()
+            self.facturas.clear()
+            self.huellas_archivos.clear()
+            self.ingresos_diarios = IngresosDiarios()
+            self._reindexar()
+            self._cambios_pendientes.clear()
+            try:
+                self.almacenamiento.reset(self)
+            except ErrorPersistencia:
+                raise # Lo reporta el endpoint /reset
+            except OSError as e:
+                print(f"Error al manejar {self.almacenamiento.ruta} en reset: {e}")
+            except Exception as e:
+                 print(f"Error inesperado en reset_datos: {e}")
 
 
     def get_datos_generales(self):
@@ -366,8 +694,8 @@ class Datalake:
                             "id": inst.id, "id_configuracion": inst.id_configuracion,
                             "nombre": inst.nombre, "fecha_inicio": inst.fecha_inicio,
                             "estado": inst.estado, "fecha_final": inst.fecha_final,
-                            "consumos_pendientes_count": len(inst.consumos), # Devuelve la cantidad, no los valores
-                            "consumos_pendientes_total_horas": sum(inst.consumos) # Devuelve el total de horas
+                            "consumos_pendientes_count": inst.cantidad_pendientes, # Devuelve la cantidad, no los valores
+                            "consumos_pendientes_total_horas": inst.horas_pendientes # Devuelve el total de horas
                         } for inst in cli.instancias
                     ]
                 } for cli in self.clientes
@@ -377,43 +705,134 @@ class Datalake:
 
 
     # --- Métodos de Búsqueda ---
+    # Todas son O(1) sobre los índices; los IDs se normalizan a int como en las listas
     def find_cliente(self, nit):
-        return next((c for c in self.clientes if c.nit == nit), None)
+        return self._idx_clientes.get(nit)
 
     def find_recurso(self, id_recurso):
         # Asegura comparación de enteros
         try: id_recurso_int = int(id_recurso)
         except (ValueError, TypeError): return None
-        return next((r for r in self.recursos if r.id == id_recurso_int), None)
+        return self._idx_recursos.get(id_recurso_int)
 
     def find_categoria(self, id_categoria):
         try: id_categoria_int = int(id_categoria)
         except (ValueError, TypeError): return None
-        return next((c for c in self.categorias if c.id == id_categoria_int), None)
+        return self._idx_categorias.get(id_categoria_int)
 
     def find_configuracion(self, id_configuracion):
         try: id_configuracion_int = int(id_configuracion)
         except (ValueError, TypeError): return None
-        for cat in self.categorias:
-            found = next((conf for conf in cat.configuraciones if conf.id == id_configuracion_int), None)
-            if found: return found
-        return None
+        par = self._idx_configuraciones.get(id_configuracion_int)
+        return par[1] if par else None
 
     def find_instancia(self, nit_cliente, id_instancia):
         try: id_instancia_int = int(id_instancia)
         except (ValueError, TypeError): return None
-        cliente = self.find_cliente(nit_cliente)
-        if cliente:
-            return next((i for i in cliente.instancias if i.id == id_instancia_int), None)
-        return None
+        return self._idx_instancias.get((nit_cliente, id_instancia_int))
 
     def find_categoria_por_config(self, id_configuracion):
         try: id_configuracion_int = int(id_configuracion)
         except (ValueError, TypeError): return None
+        par = self._idx_configuraciones.get(id_configuracion_int)
+        return par[0] if par else None
+
+    # --- Índices ---
+    # Diccionarios sobre los mismos objetos de las listas. Se actualizan en cada alta (merge XML y
+    # _aplicar_*) y se reconstruyen completos cuando las listas se reemplazan (carga, reset).
+    def _reindexar(self):
+        self._idx_recursos = {}
+        self._idx_categorias = {}
+        self._idx_configuraciones = {} # id_configuracion -> (categoria, configuracion)
+        self._idx_clientes = {}
+        self._idx_instancias = {} # (nit, id_instancia) -> instancia
+        self._tarifas = {} # id_configuracion -> TarifaConfiguracion (ver tarifa_configuracion)
+        self._cotizaciones = {} # nit -> (cotización, ids de configuración de sus instancias) (ver cotizacion_guardada)
+        self._idx_fechas = None
+        for r in self.recursos:
+            self._idx_recursos.setdefault(r.id, r) # Con IDs repetidos gana el primero, como en la búsqueda lineal
         for cat in self.categorias:
-            if any(conf.id == id_configuracion_int for conf in cat.configuraciones):
-                return cat
-        return None
+            self._indexar_categoria(cat)
+        for cli in self.clientes:
+            self._indexar_cliente(cli)
+
+    def _indexar_categoria(self, categoria):
+        self._idx_categorias.setdefault(categoria.id, categoria)
+        for conf in categoria.configuraciones:
+            self._indexar_configuracion(categoria, conf)
+
+    def _indexar_configuracion(self, categoria, configuracion):
+        self._idx_configuraciones.setdefault(configuracion.id, (categoria, configuracion))
+
+    def _indexar_cliente(self, cliente):
+        self._idx_clientes.setdefault(cliente.nit, cliente)
+        for inst in cliente.instancias:
+            self._idx_instancias.setdefault((cliente.nit, inst.id), inst)
+
+    # --- Tarifas precompiladas ---
+    def tarifa_configuracion(self, id_configuracion):
+        """
+        TarifaConfiguracion de una configuración (o None si no existe), compilada en el primer uso.
+        Se invalida solo cuando cambian los recursos de la configuración o el precio/datos de un recurso.
+        """
+        with self.lock:
+            try: id_configuracion = int(id_configuracion)
+            except (ValueError, TypeError): return None
+            tarifa = self._tarifas.get(id_configuracion)
+            if tarifa is None:
+                tarifa = self._compilar_tarifa(id_configuracion)
+                if tarifa:
+                    self._tarifas[id_configuracion] = tarifa
+            return tarifa
+
+    def _compilar_tarifa(self, id_configuracion):
+        par = self._idx_configuraciones.get(id_configuracion)
+        if not par:
+            return None
+        categoria, configuracion = par
+        tarifa = TarifaConfiguracion(configuracion.id, configuracion.nombre, categoria.id, 0.0)
+        for rec_conf in configuracion.recursos:
+            tarifa.ids_recursos.add(rec_conf.id_recurso)
+            recurso = self.find_recurso(rec_conf.id_recurso)
+            if not recurso:
+                print(f"Advertencia (Tarifa): Recurso ID {rec_conf.id_recurso} de Config ID {configuracion.id} no encontrado. Se omite su costo.")
+                continue
+            tarifa_linea = rec_conf.cantidad * recurso.valor_x_hora
+            tarifa.tarifa_hora += tarifa_linea
+            tarifa.lineas.append((recurso.id, recurso.nombre, rec_conf.cantidad, recurso.metrica,
+                                  recurso.valor_x_hora, tarifa_linea))
+        return tarifa
+
+    def _invalidar_tarifas(self, id_recurso=None, id_configuracion=None):
+        afectadas = set()
+        if id_configuracion is not None:
+            self._tarifas.pop(id_configuracion, None)
+            afectadas.add(id_configuracion)
+        if id_recurso is not None:
+            for id_conf in [i for i, t in self._tarifas.items() if id_recurso in t.ids_recursos]:
+                del self._tarifas[id_conf]
+                afectadas.add(id_conf)
+        # Una cotización usó la tarifa compilada de sus configuraciones: si esa tarifa seguía en
+        # _tarifas, está entre las afectadas; si ya se había invalidado, la cotización también
+        for nit in [n for n, (_, ids) in self._cotizaciones.items() if ids & afectadas]:
+            del self._cotizaciones[nit]
+
+    # --- Cotizaciones (vista previa de factura) ---
+    # Lo que se le facturaría a un cliente, calculado por facturacion.cotizar_cliente y guardado hasta
+    # que cambien sus consumos, sus instancias o la tarifa de alguna de sus configuraciones.
+    def cotizacion_guardada(self, nit):
+        """ Cotización vigente de 'nit' o None si hay que calcularla. """
+        with self.lock:
+            guardada = self._cotizaciones.get(nit)
+            return guardada[0] if guardada else None
+
+    def guardar_cotizacion(self, nit, cotizacion, ids_configuracion):
+        """ Guarda la cotización de 'nit'; 'ids_configuracion' son las tarifas de las que depende. """
+        with self.lock:
+            self._cotizaciones[nit] = (cotizacion, frozenset(ids_configuracion))
+
+    def _invalidar_cotizacion(self, nit):
+        self._cotizaciones.pop(nit, None)
 
     def get_all_configuraciones(self):
         all_configs = []
@@ -421,239 +840,375 @@ class Datalake:
             all_configs.extend(cat.configuraciones)
         return all_configs
 
-    # --- Persistencia en XML ---
-    def guardar_a_xml(self):
-        """ Guarda el estado actual de los datos en el archivo XML persistente. """
-        # CORRECCIÓN: Asegurar que el directorio exista ANTES de intentar escribir
-        try:
-             # Si db_file es solo nombre (sin ruta), dirname será '', lo cual es válido para os.makedirs
-            dir_path = os.path.dirname(self.db_file)
-            if dir_path: # Solo crear si hay un directorio especificado
-                os.makedirs(dir_path, exist_ok=True)
-        except OSError as e:
-            print(f"Advertencia: No se pudo crear el directorio para {self.db_file}: {e}. Intentando guardar en directorio actual.")
-            # Podríamos intentar guardar en el directorio actual si falla
-            self.db_file = os.path.basename(self.db_file) # Usar solo el nombre
-
-        root = ET.Element("sistemaTecnologiasChapinas")
-
-        # Guardar Recursos
-        lista_rec = ET.SubElement(root, "listaRecursos")
-        for r in self.recursos:
-            rec_elem = ET.SubElement(lista_rec, "recurso", id=str(r.id))
-            ET.SubElement(rec_elem, "nombre").text = r.nombre
-            ET.SubElement(rec_elem, "abreviatura").text = r.abreviatura
-            ET.SubElement(rec_elem, "metrica").text = r.metrica
-            ET.SubElement(rec_elem, "tipo").text = r.tipo
-            ET.SubElement(rec_elem, "valorXhora").text = str(r.valor_x_hora)
-
-        # Guardar Categorías y Configuraciones
-        lista_cat = ET.SubElement(root, "listaCategorias")
-        for c in self.categorias:
-            cat_elem = ET.SubElement(lista_cat, "categoria", id=str(c.id))
-            ET.SubElement(cat_elem, "nombre").text = c.nombre
-            ET.SubElement(cat_elem, "descripcion").text = c.descripcion
-            ET.SubElement(cat_elem, "cargaTrabajo").text = c.carga_trabajo
-            lista_conf = ET.SubElement(cat_elem, "listaConfiguraciones")
-            for conf in c.configuraciones:
-                conf_elem = ET.SubElement(lista_conf, "configuracion", id=str(conf.id))
-                ET.SubElement(conf_elem, "nombre").text = conf.nombre
-                ET.SubElement(conf_elem, "descripcion").text = conf.descripcion
-                rec_conf_lista = ET.SubElement(conf_elem, "recursosConfiguracion")
-                for rc in conf.recursos:
-                    rec_conf_elem = ET.SubElement(rec_conf_lista, "recurso", id=str(rc.id_recurso))
-                    rec_conf_elem.text = str(rc.cantidad)
-
-        # Guardar Clientes e Instancias (con consumos pendientes)
-        lista_cli = ET.SubElement(root, "listaClientes")
-        for cli in self.clientes:
-            cli_elem = ET.SubElement(lista_cli, "cliente", nit=cli.nit)
-            ET.SubElement(cli_elem, "nombre").text = cli.nombre
-            ET.SubElement(cli_elem, "usuario").text = cli.usuario
-            ET.SubElement(cli_elem, "clave").text = cli.clave # ¡Ojo con guardar claves en texto plano!
-            ET.SubElement(cli_elem, "direccion").text = cli.direccion
-            ET.SubElement(cli_elem, "correoElectronico").text = cli.correo
-            lista_inst = ET.SubElement(cli_elem, "listaInstancias")
-            for inst in cli.instancias:
-                inst_elem = ET.SubElement(lista_inst, "instancia", id=str(inst.id))
-                ET.SubElement(inst_elem, "idConfiguracion").text = str(inst.id_configuracion)
-                ET.SubElement(inst_elem, "nombre").text = inst.nombre
-                ET.SubElement(inst_elem, "fechaInicio").text = inst.fecha_inicio if inst.fecha_inicio else ""
-                ET.SubElement(inst_elem, "estado").text = inst.estado
-                ET.SubElement(inst_elem, "fechaFinal").text = inst.fecha_final if inst.fecha_final else ""
-                cons_lista = ET.SubElement(inst_elem, "consumosPendientes")
-                for cons in inst.consumos: # Guarda la lista de floats
-                    ET.SubElement(cons_lista, "consumo").text = str(cons)
-
-        # Guardar Facturas
-        lista_fac = ET.SubElement(root, "listaFacturas")
-        for f in self.facturas:
-            fac_elem = ET.SubElement(lista_fac, "factura", id=str(f.id), nitCliente=f.nit_cliente)
-            ET.SubElement(fac_elem, "nombreCliente").text = f.nombre_cliente
-            ET.SubElement(fac_elem, "fechaFactura").text = f.fecha_factura
-            ET.SubElement(fac_elem, "montoTotal").text = str(f.monto_total)
-            detalles_inst_elem = ET.SubElement(fac_elem, "detallesInstancias")
-            # CORRECCIÓN: Usar nombres correctos de clases/atributos
-            for det_inst in f.detalles_instancias:
-                det_inst_elem = ET.SubElement(detalles_inst_elem, "detalleInstancia", idInstancia=str(det_inst.id_instancia))
-                ET.SubElement(det_inst_elem, "nombreInstancia").text = det_inst.nombre_instancia
-                ET.SubElement(det_inst_elem, "idConfiguracion").text = str(det_inst.id_configuracion)
-                ET.SubElement(det_inst_elem, "nombreConfiguracion").text = det_inst.nombre_configuracion
-                ET.SubElement(det_inst_elem, "idCategoria").text = str(det_inst.id_categoria if det_inst.id_categoria is not None else "") # Manejar None
-                ET.SubElement(det_inst_elem, "horasConsumidas").text = str(det_inst.horas_consumidas)
-                ET.SubElement(det_inst_elem, "subtotalInstancia").text = str(det_inst.subtotal_instancia)
-                detalles_rec_elem = ET.SubElement(det_inst_elem, "recursosCosto")
-                for det_rec in det_inst.recursos_costo:
-                    det_rec_elem = ET.SubElement(detalles_rec_elem, "detalleRecurso", idRecurso=str(det_rec.id_recurso))
-                    ET.SubElement(det_rec_elem, "nombreRecurso").text = det_rec.nombre_recurso
-                    ET.SubElement(det_rec_elem, "cantidad").text = str(det_rec.cantidad)
-                    ET.SubElement(det_rec_elem, "metrica").text = det_rec.metrica
-                    ET.SubElement(det_rec_elem, "valorXhora").text = str(det_rec.valor_x_hora)
-                    ET.SubElement(det_rec_elem, "subtotal").text = str(det_rec.subtotal)
-
-        # Escribir el archivo XML formateado
-        try:
-            xml_str_bytes = ET.tostring(root, encoding='utf-8', method='xml')
-            dom = minidom.parseString(xml_str_bytes)
-            # Indentación con dos espacios
-            pretty_xml_str = dom.toprettyxml(indent="  ")
-            # Eliminar la declaración XML duplicada y asegurar UTF-8
-            # pretty_xml_str = '\n'.join(line for line in pretty_xml_str.splitlines()[1:] if line.strip())
-
-            with open(self.db_file, "w", encoding='utf-8') as f: # Escribir como texto UTF-8
-                 f.write(pretty_xml_str)
-            # Quitar el print de aquí para no saturar consola, se puede loguear si se quiere
-            # print(f"Datos guardados exitosamente en {self.db_file}")
-        except Exception as e:
-            print(f"Error CRÍTICO al intentar guardar en {self.db_file}: {e}")
-            import traceback
-            traceback.print_exc()
-            # Considerar qué hacer aquí. ¿Lanzar excepción? ¿Intentar de nuevo?
-
-    def cargar_desde_xml_persistente(self):
-        """ Carga los datos desde el archivo XML persistente al iniciar. """
-        if not os.path.exists(self.db_file):
-            print(f"Archivo {self.db_file} no encontrado. Iniciando en blanco.")
+    # --- Consultas para reportes ---
+    def facturas_en_rango(self, fecha_inicio, fecha_fin):
+        """
+        Facturas con fecha_factura entre fecha_inicio y fecha_fin (objetos date, ambos inclusive),
+        en orden de fecha. Usa búsqueda binaria sobre el índice por fecha: O(log n + k).
+        """
+        with self.lock:
+            ordinales, facturas = self._indice_fechas()
+            desde = bisect.bisect_left(ordinales, fecha_inicio.toordinal())
+            hasta = bisect.bisect_right(ordinales, fecha_fin.toordinal())
+            return facturas[desde:hasta]
+
+    def _indice_fechas(self):
+        if self._idx_fechas is None:
+            con_fecha = []
+            for f in self.facturas:
+                ordinal = fecha_a_ordinal(f.fecha_factura)
+                if ordinal is None:
+                    print(f"Advertencia: Ignorando factura ID {f.id} con fecha inválida '{f.fecha_factura}'")
+                    continue # Ignora facturas con fecha inválida
+                con_fecha.append((ordinal, f))
+            con_fecha.sort(key=lambda par: par[0]) # Estable: mismo día conserva el orden de registro
+            self._idx_fechas = ([o for o, _ in con_fecha], [f for _, f in con_fecha])
+        return self._idx_fechas
+
+    def _indexar_factura(self, factura):
+        if self._idx_fechas is None:
+            return # Se indexará al construir el índice
+        ordinal = fecha_a_ordinal(factura.fecha_factura)
+        if ordinal is None:
             return
-
-        try:
-            # Añadir manejo de archivo vacío
-            if os.path.getsize(self.db_file) == 0:
-                print(f"Archivo {self.db_file} está vacío. Iniciando en blanco.")
-                return
-
-            tree = ET.parse(self.db_file)
-            root = tree.getroot()
-
-            # Cargar Recursos
-            self.recursos = []
-            for rec_elem in root.findall('.//listaRecursos/recurso'):
-                try: self.recursos.append(Recurso(
-                        id=int(rec_elem.attrib['id']), nombre=rec_elem.findtext('nombre', default=""),
-                        abreviatura=rec_elem.findtext('abreviatura', default=""), metrica=rec_elem.findtext('metrica', default=""),
-                        tipo=rec_elem.findtext('tipo', default="HARDWARE"), valor_x_hora=float(rec_elem.findtext('valorXhora', default=0.0))
-                    ))
-                except (ValueError, KeyError, AttributeError, TypeError): continue
-
-            # Cargar Categorías y Configuraciones
-            self.categorias = []
-            for cat_elem in root.findall('.//listaCategorias/categoria'):
-                try:
-                    categoria = Categoria(
-                        id=int(cat_elem.attrib['id']), nombre=cat_elem.findtext('nombre', default=""),
-                        descripcion=cat_elem.findtext('descripcion', default=""), carga_trabajo=cat_elem.findtext('cargaTrabajo', default=""),
-                        configuraciones=[] )
-                    for conf_elem in cat_elem.findall('.//listaConfiguraciones/configuracion'):
-                        try:
-                            configuracion = Configuracion(
-                                id=int(conf_elem.attrib['id']), nombre=conf_elem.findtext('nombre', default=""),
-                                descripcion=conf_elem.findtext('descripcion', default=""), recursos=[] )
-                            for rec_conf_elem in conf_elem.findall('.//recursosConfiguracion/recurso'):
-                                try: configuracion.recursos.append(RecursoConfiguracion(
-                                        id_recurso=int(rec_conf_elem.attrib['id']), cantidad=float(rec_conf_elem.text or 0.0) ))
-                                except (ValueError, KeyError, AttributeError, TypeError): continue
-                            categoria.configuraciones.append(configuracion)
-                        except (ValueError, KeyError, AttributeError, TypeError): continue
-                    self.categorias.append(categoria)
-                except (ValueError, KeyError, AttributeError, TypeError): continue
-
-            # Cargar Clientes e Instancias
-            self.clientes = []
-            for cli_elem in root.findall('.//listaClientes/cliente'):
-                 try:
-                    cliente = Cliente(
-                        nit=cli_elem.attrib['nit'], nombre=cli_elem.findtext('nombre', default=""),
-                        usuario=cli_elem.findtext('usuario', default=""), clave=cli_elem.findtext('clave', default=""),
-                        direccion=cli_elem.findtext('direccion', default=""), correo=cli_elem.findtext('correoElectronico', default=""),
-                        instancias=[] )
-                    for inst_elem in cli_elem.findall('.//listaInstancias/instancia'):
-                        try:
-                            instancia = Instancia(
-                                id=int(inst_elem.attrib['id']), id_configuracion=int(inst_elem.findtext('idConfiguracion', default=0)),
-                                nombre=inst_elem.findtext('nombre', default=""), fecha_inicio=inst_elem.findtext('fechaInicio', default=""),
-                                estado=inst_elem.findtext('estado', default="Vigente"), fecha_final=inst_elem.findtext('fechaFinal'), # None si no existe
-                                consumos=[] )
-                            for cons_elem in inst_elem.findall('.//consumosPendientes/consumo'):
-                                try: instancia.consumos.append(float(cons_elem.text or 0.0))
-                                except (ValueError, TypeError): continue
-                            cliente.instancias.append(instancia)
-                        except (ValueError, KeyError, AttributeError, TypeError): continue
-                    self.clientes.append(cliente)
-                 except (KeyError, AttributeError, TypeError): continue
-
-            # Cargar Facturas
-            self.facturas = []
-            for fac_elem in root.findall('.//listaFacturas/factura'):
-                try:
-                    factura = Factura(
-                        id=int(fac_elem.attrib['id']), nit_cliente=fac_elem.attrib['nitCliente'],
-                        nombre_cliente=fac_elem.findtext('nombreCliente', default=""), fecha_factura=fac_elem.findtext('fechaFactura', default=""),
-                        monto_total=float(fac_elem.findtext('montoTotal', default=0.0)), detalles_instancias=[] )
-                    # CORRECCIÓN: Usar nombres correctos
-                    for det_inst_elem in fac_elem.findall('.//detallesInstancias/detalleInstancia'):
-                         try:
-                            id_cat_text = det_inst_elem.findtext('idCategoria')
-                            id_categoria = int(id_cat_text) if id_cat_text and id_cat_text.isdigit() else None # Asegurar que sea numérico
-
-                            detalle_inst = DetalleInstanciaFactura(
-                                id_instancia=int(det_inst_elem.attrib['idInstancia']), nombre_instancia=det_inst_elem.findtext('nombreInstancia', default=""),
-                                id_configuracion=int(det_inst_elem.findtext('idConfiguracion', default=0)), nombre_configuracion=det_inst_elem.findtext('nombreConfiguracion', default=""),
-                                horas_consumidas=float(det_inst_elem.findtext('horasConsumidas', default=0.0)),
-                                subtotal_instancia=float(det_inst_elem.findtext('subtotalInstancia', default=0.0)),
-                                id_categoria=id_categoria, # Mover aquí después de los no-default
-                                recursos_costo=[] )
-                            for det_rec_elem in det_inst_elem.findall('.//recursosCosto/detalleRecurso'):
-                                try: detalle_inst.recursos_costo.append(DetalleRecursoInstancia(
-                                        id_recurso=int(det_rec_elem.attrib['idRecurso']), nombre_recurso=det_rec_elem.findtext('nombreRecurso', default=""),
-                                        cantidad=float(det_rec_elem.findtext('cantidad', default=0.0)), metrica=det_rec_elem.findtext('metrica', default=""),
-                                        valor_x_hora=float(det_rec_elem.findtext('valorXhora', default=0.0)), subtotal=float(det_rec_elem.findtext('subtotal', default=0.0)) ))
-                                except (ValueError, KeyError, AttributeError, TypeError): continue
-                            factura.detalles_instancias.append(detalle_inst)
-                         except (ValueError, KeyError, AttributeError, TypeError): continue
-                    self.facturas.append(factura)
-                except (ValueError, KeyError, AttributeError, TypeError): continue
-
-            print(f"Datos cargados exitosamente desde {self.db_file}")
-
-        except ET.ParseError as e:
-            print(f"Error al parsear {self.db_file}: {e}. Archivo corrupto o vacío. Iniciando en blanco.")
-            # Si el archivo está corrupto, lo mejor es empezar de cero
-            self.recursos, self.categorias, self.clientes, self.facturas = [], [], [], []
-            # Opcional: intentar borrar el archivo corrupto
-            try: os.remove(self.db_file)
-            except OSError: pass
-        except FileNotFoundError:
-             print(f"Archivo {self.db_file} no encontrado. Iniciando en blanco.")
-        except Exception as e:
-            print(f"Error INESPERADO al cargar XML persistente ({type(e).__name__}): {e}. Iniciando en blanco.")
-            import traceback
-            traceback.print_exc()
-            self.recursos, self.categorias, self.clientes, self.facturas = [], [], [], []
-            try: os.remove(self.db_file)
-            except OSError: pass
+        ordinales, facturas = self._idx_fechas
+        posicion = bisect.bisect_right(ordinales, ordinal) # Casi siempre al final (fecha de hoy)
+        ordinales.insert(posicion, ordinal)
+        facturas.insert(posicion, factura)
+
+    # Los reportes de ingresos suman los rollups diarios: O(días con facturas en el rango)
+    def ingresos_por_recurso(self, fecha_inicio, fecha_fin):
+        """ {id_recurso: total facturado} entre fecha_inicio y fecha_fin (objetos date, ambos inclusive). """
+        return self._totales_diarios("recurso", fecha_inicio, fecha_fin)
+
+    def ingresos_por_configuracion(self, fecha_inicio, fecha_fin):
+        """ {id_configuracion: total facturado} en el rango. """
+        return self._totales_diarios("configuracion", fecha_inicio, fecha_fin)
+
+    def ingresos_por_categoria(self, fecha_inicio, fecha_fin):
+        """ {id_categoria: total facturado} en el rango, según la categoría registrada en cada factura. """
+        return self._totales_diarios("categoria", fecha_inicio, fecha_fin)
+
+    def _totales_diarios(self, tipo, fecha_inicio, fecha_fin):
+        with self.lock:
+            return self._ingresos_diarios_listos().totales(tipo, fecha_inicio.toordinal(), fecha_fin.toordinal())
+
+    def _ingresos_diarios_listos(self):
+        """ Rollups de ingresos; si lo cargado no los traía se reconstruyen una vez desde las facturas. """
+        with self.lock:
+            if self.ingresos_diarios is None:
+                self.ingresos_diarios = IngresosDiarios.desde_facturas(self.facturas)
+            return self.ingresos_diarios
+
+    # --- Mutaciones ---
+    # Toda modificación pasa por _cambio(): se aplica en memoria con el mismo código que usa la
+    # reproducción del journal y queda registrada para la próxima llamada a persistir().
+
+    def agregar_recurso(self, recurso):
+        self._cambio('recurso', asdict(recurso))
+        self.persistir()
+
+    def agregar_categoria(self, categoria):
+        self._cambio('categoria', self._datos_categoria(categoria))
+        for conf in categoria.configuraciones:
+            self._cambio('configuracion', self._datos_configuracion(categoria.id, conf))
+        self.persistir()
+
+    def agregar_configuracion(self, id_categoria, configuracion):
+        self._cambio('configuracion', self._datos_configuracion(id_categoria, configuracion))
+        self.persistir()
+
+    def agregar_cliente(self, cliente):
+        self._cambio('cliente', self._datos_cliente(cliente))
+        for inst in cliente.instancias:
+            self._cambio('instancia', self._datos_instancia(cliente.nit, inst))
+        self.persistir()
+
+    def agregar_instancia(self, nit_cliente, instancia):
+        self._cambio('instancia', self._datos_instancia(nit_cliente, instancia))
+        self.persistir()
+
+    def cancelar_instancia(self, nit_cliente, id_instancia, fecha_final):
+        with self.lock:
+            instancia = self.find_instancia(nit_cliente, id_instancia)
+            datos = self._datos_instancia(nit_cliente, instancia)
+            datos.update(estado='Cancelada', fecha_final=fecha_final)
+            self._cambio('instancia', datos)
+        self.persistir()
+
+    def registrar_factura(self, factura, ids_instancias):
+        """ Añade la factura y limpia los consumos pendientes de las instancias facturadas. """
+        self.registrar_facturas([(factura, ids_instancias)])
+
+    def registrar_facturas(self, lote, persistir=True):
+        """
+        registrar_factura para un lote de (factura, ids_instancias), aplicado bajo un solo lock.
+        Con persistir=False el llamador persiste después (p. ej. tras soltar el lock, ver facturacion.py).
+        """
+        with self.lock:
+            for factura, ids_instancias in lote:
+                self._cambio('factura', {"factura": factura.to_dict(), "instancias": list(ids_instancias)})
+        if persistir:
+            self.persistir()
+
+    def _cambio(self, op, datos):
+        with self.lock:
+            self._aplicar(op, datos)
+            self._registrar(op, datos)
+
+    def _registrar(self, op, datos):
+        with self.lock:
+            self.secuencia += 1
+            self._cambios_pendientes.append({"seq": self.secuencia, "op": op, "datos": datos})
+
+    def _aplicar(self, op, datos):
+        getattr(self, f"_aplicar_{op}")(datos)
+
+    def _aplicar_recurso(self, datos):
+        recurso = self.find_recurso(datos['id'])
+        self._invalidar_tarifas(id_recurso=datos['id'])
+        if recurso:
+            for campo, valor in datos.items(): setattr(recurso, campo, valor)
+        else:
+            recurso = Recurso(**datos)
+            self.recursos.append(recurso)
+            self._idx_recursos[recurso.id] = recurso
+
+    def _aplicar_categoria(self, datos):
+        categoria = self.find_categoria(datos['id'])
+        if categoria:
+            for campo, valor in datos.items(): setattr(categoria, campo, valor)
+        else:
+            categoria = Categoria(**datos, configuraciones=[])
+            self.categorias.append(categoria)
+            self._indexar_categoria(categoria)
+
+    def _aplicar_configuracion(self, datos):
+        datos = dict(datos)
+        id_categoria = datos.pop('id_categoria')
+        datos['recursos'] = [RecursoConfiguracion(**rc) for rc in datos['recursos']]
+        categoria = self.find_categoria(id_categoria)
+        if not categoria:
+            print(f"Advertencia (Journal): Categoría ID {id_categoria} no existe. Omitiendo configuración ID {datos['id']}.")
+            return
+        configuracion = self.find_configuracion(datos['id'])
+        self._invalidar_tarifas(id_configuracion=datos['id'])
+        if configuracion:
+            for campo, valor in datos.items(): setattr(configuracion, campo, valor)
+        else:
+            configuracion = Configuracion(**datos)
+            categoria.configuraciones.append(configuracion)
+            self._indexar_configuracion(categoria, configuracion)
+
+    def _aplicar_cliente(self, datos):
+        self._invalidar_cotizacion(datos['nit'])
+        cliente = self.find_cliente(datos['nit'])
+        if cliente:
+            for campo, valor in datos.items(): setattr(cliente, campo, valor)
+        else:
+            cliente = Cliente(**datos, instancias=[])
+            self.clientes.append(cliente)
+            self._indexar_cliente(cliente)
+
+    def _aplicar_instancia(self, datos):
+        datos = dict(datos)
+        nit = datos.pop('nit')
+        cliente = self.find_cliente(nit)
+        if not cliente:
+            print(f"Advertencia (Journal): Cliente NIT {nit} no existe. Omitiendo instancia ID {datos['id']}.")
+            return
+        self._invalidar_cotizacion(nit)
+        instancia = self.find_instancia(nit, datos['id'])
+        if instancia:
+            for campo, valor in datos.items(): setattr(instancia, campo, valor)
+        else:
+            instancia = Instancia(**datos)
+            cliente.instancias.append(instancia)
+            self._idx_instancias[(nit, instancia.id)] = instancia
+
+    def _aplicar_consumo(self, datos):
+        instancia = self.find_instancia(datos['nit'], datos['id_instancia'])
+        if instancia:
+            if datos.get('huella') is not None:
+                self.find_cliente(datos['nit']).huellas_consumo.agregar(datos['huella'], datos.get('marca', SIN_MARCA))
+            # Registros anteriores no tienen marca ni 'conservar' (siempre se conservaban)
+            self._acumular_consumo(instancia, datos['tiempo'], datos.get('marca', SIN_MARCA), datos.get('conservar', True))
+            self._invalidar_cotizacion(datos['nit'])
+
+    def _aplicar_archivo(self, datos):
+        self.huellas_archivos.add(datos['huella'])
+
+    def _aplicar_factura(self, datos):
+        factura = Factura.from_dict(datos['factura'])
+        # Sin pasar por la propiedad 'facturas': reaplicar el journal al iniciar no debe forzar la carga diferida
+        with self._lock_recuperadas:
+            if self._carga_facturas is not None:
+                self._facturas_recuperadas.append(factura)
+            else:
+                self._facturas.append(factura)
+        self._indexar_factura(factura)
+        if self.ingresos_diarios is not None: # Si no, la factura entra al reconstruirlos
+            self.ingresos_diarios.agregar_factura(factura)
+        self._invalidar_cotizacion(factura.nit_cliente)
+        for id_inst in datos['instancias']:
+            instancia = self.find_instancia(factura.nit_cliente, id_inst)
+            if instancia:
+                instancia.horas_pendientes = 0.0
+                instancia.cantidad_pendientes = 0
+                del instancia.consumos[:] # array no tiene clear()
+                del instancia.marcas[:]
+
+    # Representación de cada entidad en un registro del journal (sin sus listas hijas)
+    def _datos_categoria(self, categoria):
+        return {"id": categoria.id, "nombre": categoria.nombre, "descripcion": categoria.descripcion,
+                "carga_trabajo": categoria.carga_trabajo}
+
+    def _datos_configuracion(self, id_categoria, configuracion):
+        return {"id_categoria": id_categoria, "id": configuracion.id, "nombre": configuracion.nombre,
+                "descripcion": configuracion.descripcion,
+                "recursos": [asdict(rc) for rc in configuracion.recursos]}
+
+    def _datos_cliente(self, cliente):
+        return {"nit": cliente.nit, "nombre": cliente.nombre, "usuario": cliente.usuario, "clave": cliente.clave,
+                "direccion": cliente.direccion, "correo": cliente.correo}
+
+    def _datos_instancia(self, nit_cliente, instancia):
+        return {"nit": nit_cliente, "id": instancia.id, "id_configuracion": instancia.id_configuracion,
+                "nombre": instancia.nombre, "fecha_inicio": instancia.fecha_inicio,
+                "estado": instancia.estado, "fecha_final": instancia.fecha_final}
+
+    # --- Persistencia y group commit ---
+    def persistir(self):
+        """
+        Persiste las mutaciones registradas desde la última llamada a través del almacenamiento.
+        En modo group commit solo avisa al hilo escritor y regresa sin esperar la escritura.
+        """
+        if self.group_commit_ms is None:
+            self._escribir_cambios()
+            return
+        with self._cond_escritor:
+            self._generacion_solicitada += 1
+            self._cond_escritor.notify_all()
+
+    def esperar_persistencia(self, timeout=None):
+        """
+        Barrera de durabilidad: bloquea hasta que todo lo registrado antes de la llamada esté en disco.
+        Devuelve False si se agotó el timeout.
+        """
+        if self.group_commit_ms is None:
+            return True # Sin group commit persistir() ya es síncrono
+        with self._cond_escritor:
+            objetivo = self._generacion_solicitada
+            if self._generacion_persistida >= objetivo:
+                return True
+            self._forzar_escritura = True # No esperar a que venza el intervalo
+            self._cond_escritor.notify_all()
+            return self._cond_escritor.wait_for(lambda: self._generacion_persistida >= objetivo, timeout)
+
+    def _hilo_escritor(self):
+        intervalo = self.group_commit_ms / 1000.0
+        while True:
+            with self._cond_escritor:
+                self._cond_escritor.wait_for(lambda: self._generacion_solicitada > self._generacion_persistida)
+                # Agrupar: esperar el intervalo o hasta juntar group_commit_max mutaciones
+                limite = time.monotonic() + intervalo
+                while not self._forzar_escritura and \
+                        self._generacion_solicitada - self._generacion_persistida < self.group_commit_max:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._cond_escritor.wait(restante)
+                generacion = self._generacion_solicitada
+                self._forzar_escritura = False
+            try:
+                self._escribir_cambios()
+            except Exception as e:
+                print(f"Error CRÍTICO en el hilo de group commit: {e}. Se reintentará.")
+                import traceback
+                traceback.print_exc()
+                time.sleep(intervalo) # La generación queda sin confirmar y el bucle la reintenta
+                continue
+            with self._cond_escritor:
+                self._generacion_persistida = generacion
+                self._cond_escritor.notify_all()
+
+    def _estado_para_snapshot(self):
+        """
+        Copia del estado para escribir un snapshot sin retener el lock (ver persistencia_xml.escribir_snapshot).
+        Bajo el lock solo se copia lo que cambia en su lugar: las listas, los modelos que se actualizan
+        con setattr, las columnas de consumos, las huellas y los rollups. Las facturas no cambian una vez
+        registradas y se comparten. Así el snapshot refleja exactamente la secuencia que declara.
+        """
+        self._completar_carga_facturas()
+        with self.lock:
+            estado = self._copia_catalogo()
+            estado.clientes = [self._copia_cliente(cli) for cli in self.clientes]
+            estado.ingresos_diarios = self._ingresos_diarios_listos().copia()
+            estado.facturas = list(self.facturas)
+            return estado
+
+    def _copia_catalogo(self):
+        """ Copia de recursos, categorías y huellas de archivos (con la secuencia); llamar con el lock tomado. """
+        return SimpleNamespace(
+            secuencia=self.secuencia,
+            recursos=[replace(r) for r in self.recursos],
+            categorias=[replace(c, configuraciones=[replace(conf, recursos=list(conf.recursos)) for conf in c.configuraciones])
+                        for c in self.categorias],
+            huellas_archivos=set(self.huellas_archivos)
+        )
+
+    @staticmethod
+    def _copia_cliente(cliente):
+        """ Copia de un cliente con sus instancias y columnas de consumos; llamar con el lock tomado. """
+        return replace(cliente, huellas_consumo=cliente.huellas_consumo.copia(),
+                       instancias=[replace(i, consumos=i.consumos[:], marcas=i.marcas[:]) for i in cliente.instancias])
+
+    def _escribir_cambios(self):
+        with self._lock_escritura:
+            with self.lock:
+                cambios, self._cambios_pendientes = self._cambios_pendientes, []
+            try:
+                self.almacenamiento.guardar(self, cambios)
+            except Exception:
+                with self.lock: # Devolver el lote para reintentarlo en la próxima escritura
+                    self._cambios_pendientes[:0] = cambios
+                raise
+
+    def compactar(self):
+        """ Pide al almacenamiento que compacte lo persistido (snapshot + vaciar journal en XML). """
+        with self._lock_escritura:
+            self.almacenamiento.compactar(self)
+
+    def guardar_completo(self):
+        """ Reescribe todo el estado en el almacenamiento. Lanza ErrorPersistencia si falla. """
+        with self._lock_escritura:
+            self.almacenamiento.guardar_completo(self)
+
+    # --- Carga ---
+    def cargar(self):
+        """ Carga el estado desde el almacenamiento y reaplica lo que quedó en su journal. """
+        completar = self.almacenamiento.cargar(self, diferir_facturas=self.carga_facturas != 'inmediata')
+        self._reindexar() # El almacenamiento reemplazó las listas
+        if completar:
+            self._carga_facturas = completar
+            if self.carga_facturas == 'segundo_plano':
+                threading.Thread(target=self._completar_carga_facturas, name="carga-facturas", daemon=True).start()
+        self.almacenamiento.recuperar(self)
 
 
 # Instancia global del Datalake
 # Se crea aquí para que esté disponible para importación en app.py
 # La carga inicial se hace en el __init__
-datalake = Datalake()
+# Backend de persistencia (DATALAKE_ALMACENAMIENTO): snapshot XML con journal (por defecto), 'sqlite'
+# o 'fragmentado' (un archivo por grupo de clientes; la primera vez importa db_persistente.xml)
+_tipo_almacenamiento = os.environ.get('DATALAKE_ALMACENAMIENTO', 'xml').lower()
+if _tipo_almacenamiento == 'sqlite':
+    _almacenamiento = AlmacenamientoSQLite("db_persistente.sqlite3")
+elif _tipo_almacenamiento == 'fragmentado':
+    _almacenamiento = AlmacenamientoFragmentado("db_persistente", fragmentos=16, origen="db_persistente.xml")
+else:
+    _almacenamiento = AlmacenamientoXML("db_persistente.xml", modo_journal=True)
+# DATALAKE_CONSERVAR_CONSUMOS=0 guarda solo los acumulados por instancia (facturar no necesita las lecturas)
+_conservar_consumos = os.environ.get('DATALAKE_CONSERVAR_CONSUMOS', '1') != '0'
+datalake = Datalake(almacenamiento=_almacenamiento, carga_facturas='segundo_plano', group_commit_ms=50, group_commit_max=200,
+                    conservar_consumos=_conservar_consumos)
@@ -0,0 +1,165 @@
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Errores de las cargas (configuración y consumos).
+# Un archivo con miles de registros inválidos no debe costar más por sus errores que por la carga:
+# se cuentan todos por categoría, pero solo se guarda (y se formatea para la respuesta y el log)
+# una muestra acotada. La línea y columna de cada muestra se calculan al final, releyendo la fuente
+# solo para esas pocas muestras. El log pasa por una cola: quien carga nunca espera a la consola.
+
+MAX_MUESTRAS = 50 # Errores con detalle en la respuesta y en el log
+MAX_MUESTRAS_POR_CATEGORIA = 10 # Para que una categoría muy repetida no oculte a las demás
+
+logger = logging.getLogger("datalake.cargas")
+_cola_log = queue.SimpleQueue()
+_receptor_log = QueueListener(_cola_log, logging.StreamHandler())
+logger.addHandler(QueueHandler(_cola_log))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_receptor_log.start()
+atexit.register(_receptor_log.stop) # Vacía la cola antes de salir
+
+
+class ErroresCarga:
+    """
+    Colector de errores de una carga. 'ubicacion' describe el registro en curso y se copia en las
+    muestras: {"elemento": tag, "indice": n} (n-ésimo <tag> del documento, desde 1), {"nodo": elem}
+    (elemento de un árbol completo) o {"linea": n} (NDJSON). Con ubicar() las dos primeras formas
+    se convierten en línea y columna (columna desde 0, como ET.ParseError.position).
+    """
+
+    def __init__(self, maximo=MAX_MUESTRAS, por_categoria=MAX_MUESTRAS_POR_CATEGORIA):
+        self.total = 0
+        self.advertencias = 0 # Parte de 'total' que corresponde a registros aceptados (ver advertir)
+        self.por_categoria = {}
+        self.muestras = []
+        self.ubicacion = {}
+        self._maximo = maximo
+        self._max_por_categoria = por_categoria
+
+    def __len__(self):
+        return self.total
+
+    def advertir(self, categoria, mensaje, **ubicacion):
+        """ Como agregar(), para un registro que sí se aceptó: cuenta y se muestra, pero no es un error. """
+        self.advertencias += 1
+        self.agregar(categoria, mensaje, **ubicacion)
+
+    @property
+    def hay_errores(self):
+        return self.total > self.advertencias
+
+    def agregar(self, categoria, mensaje, **ubicacion):
+        """ Cuenta el error; si cabe en la muestra la guarda con 'ubicacion' (o la del registro en curso). """
+        self.total += 1
+        cantidad = self.por_categoria.get(categoria, 0) + 1
+        self.por_categoria[categoria] = cantidad
+        if cantidad <= self._max_por_categoria and len(self.muestras) < self._maximo:
+            self.muestras.append({"categoria": categoria, "mensaje": mensaje, **(ubicacion or self.ubicacion)})
+
+    def ubicar(self, texto=None, ruta=None, archivo=None, inicio=0, raiz=None):
+        """
+        Calcula línea y columna de las muestras releyendo el documento: 'texto' (str o bytes), 'ruta'
+        o 'archivo' (binario con seek, se lee desde 'inicio'). 'raiz' es el árbol de las muestras con "nodo".
+        Si el documento no se puede releer las muestras conservan solo su índice.
+        """
+        if raiz is not None:
+            nodos = {id(m["nodo"]): m for m in self.muestras if "nodo" in m}
+            if nodos:
+                contadores = {}
+                for elem in raiz.iter():
+                    contadores[elem.tag] = contadores.get(elem.tag, 0) + 1
+                    muestra = nodos.get(id(elem))
+                    if muestra:
+                        del muestra["nodo"]
+                        muestra.update(elemento=elem.tag, indice=contadores[elem.tag])
+        buscadas = {}
+        for muestra in self.muestras:
+            if "indice" in muestra and "linea" not in muestra:
+                buscadas.setdefault(muestra["elemento"], set()).add(muestra["indice"])
+        if not buscadas:
+            return
+        try:
+            posiciones = _ubicar_etiquetas(_bloques(texto, ruta, archivo, inicio), buscadas)
+        except (OSError, ValueError) as e:
+            logger.warning("No se pudo releer la fuente para ubicar los errores: %s", e)
+            return
+        for muestra in self.muestras:
+            posicion = posiciones.get((muestra.get("elemento"), muestra.get("indice")))
+            if posicion:
+                muestra["linea"], muestra["columna"] = posicion
+
+    def a_dict(self):
+        return {"total": self.total, "por_categoria": dict(self.por_categoria),
+                "muestras": [{k: v for k, v in m.items() if k != "nodo"} for m in self.muestras]}
+
+    def registrar_log(self, titulo):
+        """ Resumen por categoría y muestras en el log (asíncrono). """
+        if not self.total:
+            return
+        categorias = ", ".join(f"{c}: {n}" for c, n in sorted(self.por_categoria.items(), key=lambda x: -x[1]))
+        logger.warning("%s: %d advertencias/errores (%s)", titulo, self.total, categorias)
+        for muestra in self.muestras:
+            donde = f"línea {muestra['linea']}" if "linea" in muestra else \
+                    f"<{muestra['elemento']}> #{muestra['indice']}" if "indice" in muestra else "-"
+            if "columna" in muestra:
+                donde += f", columna {muestra['columna']}"
+            logger.warning("  [%s] %s: %s", muestra["categoria"], donde, muestra["mensaje"])
+        if self.total > len(self.muestras):
+            logger.warning("  ... %d más sin detalle.", self.total - len(self.muestras))
+
+
+def _bloques(texto, ruta, archivo, inicio, tamano=1 << 20):
+    if texto is not None:
+        yield texto.encode('utf-8') if isinstance(texto, str) else bytes(texto)
+    elif ruta is not None:
+        with open(ruta, 'rb') as f:
+            yield from iter(lambda: f.read(tamano), b'')
+    elif archivo is not None and getattr(archivo, 'seekable', None) and archivo.seekable():
+        archivo.seek(inicio)
+        yield from iter(lambda: archivo.read(tamano), b'')
+    else:
+        raise ValueError("el documento no se puede releer")
+
+
+def _ubicar_etiquetas(bloques, buscadas):
+    """
+    Recorre el documento por bloques y devuelve {(tag, indice): (linea, columna)} del indice-ésimo
+    '<tag' de cada etiqueta buscada (el mismo orden de documento que Element.iter(tag)).
+    """
+    patrones = {tag: b"<" + tag.encode('utf-8') for tag in buscadas}
+    largo = max(len(p) for p in patrones.values()) + 1 # Patrón más el carácter que lo delimita
+    contadores = dict.fromkeys(buscadas, 0)
+    posiciones = {}
+    resto = b""
+    lineas = 1 # Línea donde empieza 'datos'
+    columna_base = 0 # Columna donde empieza 'datos'
+    bloques = iter(bloques)
+    bloque = next(bloques, b"")
+    while bloque or resto:
+        siguiente = next(bloques, b"")
+        datos = resto + bloque
+        limite = len(datos) - largo if siguiente else len(datos) # Lo que sigue se busca en la próxima vuelta
+        for tag, patron in patrones.items():
+            pos = datos.find(patron)
+            while pos != -1 and pos < limite:
+                delimitador = datos[pos + len(patron):pos + len(patron) + 1]
+                if delimitador in (b" ", b">", b"/", b"\t", b"\n", b"\r"):
+                    contadores[tag] += 1
+                    if contadores[tag] in buscadas[tag]:
+                        salto = datos.rfind(b"\n", 0, pos)
+                        columna = pos - salto - 1 if salto != -1 else columna_base + pos
+                        posiciones[(tag, contadores[tag])] = (lineas + datos.count(b"\n", 0, pos), columna)
+                pos = datos.find(patron, pos + 1)
+        limite = max(limite, 0)
+        procesado = datos[:limite]
+        saltos = procesado.count(b"\n")
+        lineas += saltos
+        columna_base = len(procesado) - procesado.rfind(b"\n") - 1 if saltos else columna_base + len(procesado)
+        resto = datos[limite:]
+        bloque = siguiente
+        if not siguiente:
+            break
+    return posiciones
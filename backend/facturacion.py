@@ -0,0 +1,248 @@
+import os
+from datetime import datetime
+from models import Factura, DetalleInstanciaFactura, DetalleRecursoInstancia
+from utils import a_centavos, de_centavos
+
+try:
+    import numpy as np
+except ImportError: # El motor vectorizado es opcional; sin numpy se usa siempre el escalar
+    np = None
+
+# Facturación de los consumos pendientes.
+# El cálculo usa los acumulados de cada instancia (horas_pendientes) y la tarifa precompilada de su
+# configuración, así facturar a un cliente no recorre sus consumos. Todo se arma y se aplica bajo el
+# lock del Datalake: un consumo que llega a la mitad no puede quedar limpiado sin haberse cobrado,
+# y los números de factura no se repiten. La escritura a disco va después, fuera del lock.
+#
+# Los detalles se calculan con uno de dos motores que dan exactamente los mismos montos: el escalar
+# (una instancia y una línea a la vez) y el vectorizado con numpy, que conviene con muchas instancias.
+# Motor: DATALAKE_MOTOR_FACTURACION = 'auto' (numpy desde UMBRAL_NUMPY instancias), 'escalar' o 'numpy'.
+# El umbral se calibra con benchmark_facturacion.py: el valor por defecto es su punto de cruce (numpy
+# empieza a ganar hacia las 100 instancias; por debajo el escalar es hasta 1.3x más rápido).
+
+MOTOR = os.environ.get('DATALAKE_MOTOR_FACTURACION', 'auto')
+UMBRAL_NUMPY = int(os.environ.get('DATALAKE_UMBRAL_NUMPY', '100'))
+
+
+def id_factura(fecha_dt, numero):
+    return f"F-{fecha_dt.strftime('%Y%m%d')}-{numero}"
+
+
+def instancias_facturables(datalake, cliente):
+    """ (instancia, tarifa) de las instancias VIGENTES de 'cliente' con consumos pendientes. """
+    pares = []
+    for instancia in cliente.instancias:
+        # Solo procesa instancias VIGENTES y con consumos pendientes
+        if instancia.estado != 'Vigente' or not instancia.cantidad_pendientes:
+            continue
+
+        # Tarifa precompilada de la configuración: costo por hora y plantilla de líneas por recurso
+        tarifa = datalake.tarifa_configuracion(instancia.id_configuracion)
+        if not tarifa:
+            print(f"Advertencia (Factura): Configuración ID {instancia.id_configuracion} para Instancia ID {instancia.id} (NIT {cliente.nit}) no encontrada. Omitiendo instancia.")
+            continue # Salta esta instancia si su config no existe
+        pares.append((instancia, tarifa))
+    return pares
+
+
+def detalles_instancias(pares, motor=None):
+    """ Detalle de factura de cada (instancia, tarifa), en el mismo orden. """
+    motor = motor or MOTOR
+    if np is not None and pares and (motor == 'numpy' or (motor == 'auto' and len(pares) >= UMBRAL_NUMPY)):
+        return _detalles_numpy(pares)
+    return _detalles_escalar(pares)
+
+
+def _detalles_escalar(pares):
+    # horas_pendientes es el acumulado al ingerir, O(1) por instancia
+    return [tarifa.detalle_instancia(instancia, instancia.horas_pendientes) for instancia, tarifa in pares]
+
+
+def _detalles_numpy(pares):
+    """
+    Mismo cálculo que _detalles_escalar con operaciones sobre arreglos: una matriz dispersa
+    configuración x recurso (en COO, una entrada por línea de tarifa) con las cantidades, el vector
+    de precios por recurso y las horas pendientes de todas las instancias en un solo arreglo.
+    Cada producto es el mismo que en el camino escalar y las sumas se hacen en el mismo orden,
+    así los montos coinciden bit a bit antes de pasarlos a centavos.
+    """
+    # Configuraciones distintas del lote y sus líneas, en el orden de TarifaConfiguracion.lineas
+    tarifas, indice_tarifa = [], {}
+    for _, tarifa in pares:
+        if id(tarifa) not in indice_tarifa:
+            indice_tarifa[id(tarifa)] = len(tarifas)
+            tarifas.append(tarifa)
+    columna_recurso, precios = {}, []
+    filas, columnas, cantidades = [], [], []
+    for fila, tarifa in enumerate(tarifas):
+        for id_rec, _, cantidad, _, valor, _ in tarifa.lineas:
+            if id_rec not in columna_recurso:
+                columna_recurso[id_rec] = len(precios)
+                precios.append(valor)
+            filas.append(fila)
+            columnas.append(columna_recurso[id_rec])
+            cantidades.append(cantidad)
+    filas = np.array(filas, dtype=np.intp)
+    valor_linea = np.array(cantidades, dtype=float) * np.array(precios, dtype=float)[np.array(columnas, dtype=np.intp)]
+    tarifa_hora = np.zeros(len(tarifas))
+    np.add.at(tarifa_hora, filas, valor_linea) # Acumula en orden de línea, como _compilar_tarifa
+    lineas_por_tarifa = np.bincount(filas, minlength=len(tarifas))
+    primera_linea = np.cumsum(lineas_por_tarifa) - lineas_por_tarifa
+
+    # Todas las instancias a la vez
+    fila_instancia = np.fromiter((indice_tarifa[id(tarifa)] for _, tarifa in pares), dtype=np.intp, count=len(pares))
+    horas = np.fromiter((instancia.horas_pendientes for instancia, _ in pares), dtype=float, count=len(pares))
+    costos = tarifa_hora[fila_instancia] * horas
+    # Líneas de todas las instancias: posiciones consecutivas de la línea de su tarifa en valor_linea
+    n_lineas = lineas_por_tarifa[fila_instancia]
+    inicio_instancia = np.cumsum(n_lineas) - n_lineas
+    posiciones = np.arange(int(n_lineas.sum())) + np.repeat(primera_linea[fila_instancia] - inicio_instancia, n_lineas)
+    subtotales_lineas = valor_linea[posiciones] * np.repeat(horas, n_lineas)
+
+    horas_r = _redondear(horas).tolist()
+    costos_c = _centavos(costos).tolist()
+    lineas_c = _centavos(subtotales_lineas).tolist()
+    inicios = inicio_instancia.tolist()
+    detalles = []
+    for k, (instancia, tarifa) in enumerate(pares):
+        inicio = inicios[k]
+        detalles.append(DetalleInstanciaFactura(
+            id_instancia=instancia.id,
+            nombre_instancia=instancia.nombre,
+            id_configuracion=tarifa.id_configuracion,
+            nombre_configuracion=tarifa.nombre_configuracion,
+            horas_consumidas=horas_r[k],
+            subtotal_instancia_centavos=costos_c[k],
+            id_categoria=tarifa.id_categoria,
+            recursos_costo=[
+                DetalleRecursoInstancia(id_rec, nombre, cantidad, metrica, valor, subtotal)
+                for (id_rec, nombre, cantidad, metrica, valor, _), subtotal
+                in zip(tarifa.lineas, lineas_c[inicio:inicio + len(tarifa.lineas)])
+            ]
+        ))
+    return detalles
+
+
+def _redondear(valores):
+    """
+    round(x, 2) elemento a elemento. rint(x*100)/100 da lo mismo que round() salvo cuando x*100
+    queda a un paso de ...,5 (el producto pudo cruzar la mitad): esos pocos se resuelven con round().
+    """
+    escalados = valores * 100
+    resultado = np.rint(escalados) / 100
+    dudosos = np.flatnonzero(np.abs(escalados - np.floor(escalados) - 0.5) < 1e-6)
+    for i in dudosos.tolist():
+        resultado[i] = round(float(valores[i]), 2)
+    return resultado
+
+
+def _centavos(valores):
+    """ utils.a_centavos elemento a elemento, como enteros int64 (mismo criterio para los dudosos). """
+    escalados = valores * 100
+    resultado = np.rint(escalados).astype(np.int64)
+    dudosos = np.flatnonzero(np.abs(escalados - np.floor(escalados) - 0.5) < 1e-6)
+    for i in dudosos.tolist():
+        resultado[i] = a_centavos(float(valores[i]))
+    return resultado
+
+
+def armar_factura(cliente, pares, detalles, fecha_dt, numero):
+    """
+    Factura de 'cliente' con los detalles ya calculados de sus instancias facturables (pares).
+    Devuelve (factura, ids de las instancias facturadas) o None si no hay nada que facturar.
+    """
+    if not detalles:
+        return None
+    # Suma entera de los subtotales: el total es exactamente la suma de lo que muestra cada detalle
+    total_centavos = sum(detalle.subtotal_instancia_centavos for detalle in detalles)
+
+    factura = Factura(
+        id=id_factura(fecha_dt, numero),
+        nit_cliente=cliente.nit,
+        nombre_cliente=cliente.nombre, # Añadir nombre para conveniencia
+        fecha_factura=fecha_dt.strftime('%d/%m/%Y'), # Formato dd/mm/yyyy
+        monto_total_centavos=total_centavos,
+        detalles_instancias=detalles
+    )
+    return factura, [instancia.id for instancia, _ in pares] # Instancias a limpiar
+
+
+def facturar_cliente(datalake, cliente, fecha_dt=None):
+    """ Factura a un cliente y la persiste. Devuelve la Factura o None si no tenía consumos pendientes. """
+    fecha_dt = fecha_dt or datetime.now()
+    with datalake.lock:
+        pares = instancias_facturables(datalake, cliente)
+        armado = armar_factura(cliente, pares, detalles_instancias(pares), fecha_dt, len(datalake.facturas) + 1)
+        if armado:
+            datalake.registrar_facturas([armado], persistir=False)
+    if not armado:
+        return None
+    datalake.persistir()
+    return armado[0]
+
+
+def cotizar_cliente(datalake, cliente):
+    """
+    Lo que se le facturaría ahora a 'cliente', sin registrar ni persistir nada: mismos detalles y total
+    que facturar_cliente, sin número ni fecha de factura. Devuelve (cotización, en_caché). La cotización
+    se guarda en el Datalake hasta que cambien los consumos o instancias del cliente o sus tarifas.
+    """
+    with datalake.lock:
+        cotizacion = datalake.cotizacion_guardada(cliente.nit)
+        if cotizacion is not None:
+            return cotizacion, True
+        detalles = detalles_instancias(instancias_facturables(datalake, cliente))
+        cotizacion = {
+            "nit_cliente": cliente.nit,
+            "nombre_cliente": cliente.nombre,
+            "monto_total": de_centavos(sum(detalle.subtotal_instancia_centavos for detalle in detalles)),
+            "detalles_instancias": [detalle.to_dict() for detalle in detalles],
+            "calculada": datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+        }
+        # Depende de la tarifa de todas sus configuraciones, también las que aún no existen
+        ids_configuracion = set()
+        for instancia in cliente.instancias:
+            try: ids_configuracion.add(int(instancia.id_configuracion))
+            except (ValueError, TypeError): pass
+        datalake.guardar_cotizacion(cliente.nit, cotizacion, ids_configuracion)
+    return cotizacion, False
+
+
+def facturacion_masiva(datalake, nits=None, fecha_dt=None, motor=None):
+    """
+    Factura en una sola pasada a todos los clientes con consumos pendientes (o solo a los de 'nits').
+    Los números de factura se asignan en bloque y todo el lote se persiste con una sola escritura
+    (un solo lote en el journal). 'motor' elige el cálculo de los detalles (ver detalles_instancias).
+    Devuelve el resumen por cliente; la escritura no se espera aquí (ver Datalake.esperar_persistencia).
+    """
+    fecha_dt = fecha_dt or datetime.now()
+    filtro = set(nits) if nits is not None else None
+    lote = []
+    with datalake.lock:
+        siguiente = len(datalake.facturas) + 1
+        por_cliente = [] # (cliente, pares)
+        for cliente in datalake.clientes:
+            if filtro is not None and cliente.nit not in filtro:
+                continue
+            pares = instancias_facturables(datalake, cliente)
+            if pares:
+                por_cliente.append((cliente, pares))
+        # Los detalles de todas las instancias del lote se calculan juntos (con numpy si conviene)
+        detalles = detalles_instancias([par for _, pares in por_cliente for par in pares], motor)
+        inicio = 0
+        for cliente, pares in por_cliente:
+            fin = inicio + len(pares)
+            lote.append(armar_factura(cliente, pares, detalles[inicio:fin], fecha_dt, siguiente + len(lote)))
+            inicio = fin
+        datalake.registrar_facturas(lote, persistir=False)
+        no_encontrados = sorted(nit for nit in filtro if not datalake.find_cliente(nit)) if filtro is not None else []
+    if lote:
+        datalake.persistir()
+
+    return {
+        "facturas_generadas": len(lote),
+        "monto_total": de_centavos(sum(factura.monto_total_centavos for factura, _ in lote)),
+        "clientes": [{"nit": factura.nit_cliente, "nombre": factura.nombre_cliente, "id_factura": factura.id,
+                      "instancias": len(ids), "monto_total": factura.monto_total} for factura, ids in lote],
+        "no_encontrados": no_encontrados
+    }
@@ -0,0 +1,158 @@
+import os
+import json
+import shutil
+import hashlib
+
+TAM_BUFFER = 1 << 16
+
+
+class ArchivoConHash:
+    """ Archivo de salida que calcula el SHA-256 y el tamaño de lo escrito mientras se escribe. """
+
+    def __init__(self, ruta):
+        self._f = open(ruta, "wb", buffering=TAM_BUFFER)
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, texto):
+        datos = texto.encode('utf-8')
+        self.sha256.update(datos)
+        self.bytes += len(datos)
+        self._f.write(datos)
+
+    def sincronizar_y_cerrar(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+
+    def cerrar(self):
+        self._f.close()
+
+
+def _fsync_directorio(ruta_dir):
+    """ Asegura que un rename dentro del directorio sobreviva a una caída (no disponible en todos los SO). """
+    try:
+        fd = os.open(ruta_dir or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class GeneracionesSnapshot:
+    """
+    Snapshots versionados y escritos de forma atómica.
+    Cada snapshot se escribe a un temporal, se sincroniza a disco y se renombra como una
+    generación nueva (db_persistente.g000007.xml). Luego db_file se reemplaza atómicamente por
+    esa generación y el manifiesto registra tamaño y SHA-256 de las últimas 'conservar' generaciones.
+    """
+
+    def __init__(self, db_file, conservar=3):
+        self.db_file = db_file
+        self.conservar = max(1, conservar)
+        base, ext = os.path.splitext(db_file)
+        self._base = base
+        self._ext = ext or ".xml"
+        self.ruta_manifiesto = base + ".manifest.json"
+        self.entradas = self._leer_manifiesto() # Más reciente primero
+
+    def ruta_generacion(self, generacion):
+        return f"{self._base}.g{generacion:06d}{self._ext}"
+
+    def _leer_manifiesto(self):
+        if not os.path.exists(self.ruta_manifiesto):
+            return []
+        try:
+            with open(self.ruta_manifiesto, encoding='utf-8') as f:
+                return json.load(f).get('generaciones', [])
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Advertencia: manifiesto {self.ruta_manifiesto} ilegible ({e}). Se usará {self.db_file}.")
+            return []
+
+    def _escribir_manifiesto(self):
+        tmp = self.ruta_manifiesto + ".tmp"
+        with open(tmp, "w", encoding='utf-8') as f:
+            json.dump({"generaciones": self.entradas}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ruta_manifiesto)
+
+    def escribir(self, escribir_fn, secuencia):
+        """
+        Crea una generación nueva llamando a escribir_fn(archivo). Si algo falla el temporal se
+        descarta y las generaciones anteriores (y db_file) quedan intactas.
+        """
+        generacion = (self.entradas[0]['generacion'] + 1) if self.entradas else 1
+        ruta = self.ruta_generacion(generacion)
+        tmp = ruta + ".tmp"
+        archivo = ArchivoConHash(tmp)
+        try:
+            escribir_fn(archivo)
+            archivo.sincronizar_y_cerrar()
+        except BaseException:
+            archivo.cerrar()
+            try: os.remove(tmp)
+            except OSError: pass
+            raise
+        os.replace(tmp, ruta)
+
+        # db_file apunta siempre a la generación vigente (enlace duro; copia si el FS no los soporta)
+        tmp_vigente = self.db_file + ".tmp"
+        try: os.remove(tmp_vigente)
+        except OSError: pass
+        try:
+            os.link(ruta, tmp_vigente)
+        except OSError:
+            shutil.copyfile(ruta, tmp_vigente)
+        os.replace(tmp_vigente, self.db_file)
+
+        self.entradas.insert(0, {
+            "generacion": generacion, "archivo": os.path.basename(ruta), "bytes": archivo.bytes,
+            "sha256": archivo.sha256.hexdigest(), "secuencia": secuencia
+        })
+        descartadas = self.entradas[self.conservar:]
+        self.entradas = self.entradas[:self.conservar]
+        self._escribir_manifiesto()
+        _fsync_directorio(os.path.dirname(self.db_file))
+        for entrada in descartadas:
+            try: os.remove(self._ruta_entrada(entrada))
+            except OSError: pass
+        return ruta
+
+    def _ruta_entrada(self, entrada):
+        return os.path.join(os.path.dirname(self.db_file), entrada['archivo'])
+
+    def _es_valida(self, entrada):
+        ruta = self._ruta_entrada(entrada)
+        try:
+            if os.path.getsize(ruta) != entrada['bytes']:
+                return False
+            sha = hashlib.sha256()
+            with open(ruta, "rb") as f:
+                for bloque in iter(lambda: f.read(TAM_BUFFER), b""):
+                    sha.update(bloque)
+            return sha.hexdigest() == entrada['sha256']
+        except (OSError, KeyError):
+            return False
+
+    def candidatos(self):
+        """
+        Snapshots a intentar cargar, del más reciente al más antiguo, verificados contra el manifiesto.
+        Es un generador: cada generación se verifica (se lee completa para el SHA-256) solo cuando se pide,
+        así que si la más reciente carga bien las anteriores no se leen.
+        """
+        validas = 0
+        for entrada in self.entradas:
+            if self._es_valida(entrada):
+                validas += 1
+                yield self._ruta_entrada(entrada)
+            else:
+                print(f"Advertencia: generación {entrada.get('generacion')} ({entrada.get('archivo')}) incompleta o corrupta. Se descarta.")
+        # Sin manifiesto (archivo de versiones anteriores) o sin generaciones válidas: último recurso
+        if not validas and os.path.exists(self.db_file):
+            yield self.db_file
+
@@ -0,0 +1,67 @@
+from utils import SIN_MARCA
+
+# Huellas de los consumos ya registrados de un cliente, acotadas por una ventana de tiempo.
+# Cada huella (utils.huella_consumo) se recuerda junto con la marca de su fechaHora. Solo se conservan
+# las de las últimas VENTANA_HUELLAS segundos contados desde la lectura más reciente del cliente, así que
+# el tamaño depende de cuántas lecturas entran en la ventana y no de todo el historial. El límite avanza
+# de PASO_PODA en PASO_PODA: se poda una vez por paso y no en cada lectura.
+#
+# - Dentro de la ventana la comparación es exacta salvo colisiones de la huella de 64 bits (del orden
+#   de n²/2⁶⁵ para n huellas): una lectura distinta que colisione se reporta como repetida.
+# - Una lectura anterior al límite se acepta igual que antes; Datalake la reporta como advertencia
+#   (consumo_fuera_de_ventana) y su huella se guarda hasta la próxima poda.
+# - Solo mueven la ventana las lecturas aceptadas, y Datalake rechaza las fechadas más de
+#   TOLERANCIA_FUTURO después del momento de la carga (fecha_futura): una fecha errónea no puede podar
+#   las huellas de las lecturas reales.
+# El límite depende solo de la marca más reciente, que nunca se poda: al cargar un snapshot se
+# recalcula de las huellas guardadas y el resultado es el mismo que al reaplicar el journal.
+
+VENTANA_HUELLAS = 31 * 24 * 3600 # Segundos de fechaHora durante los que se detectan los reintentos
+PASO_PODA = VENTANA_HUELLAS // 4
+TOLERANCIA_FUTURO = 24 * 3600 # Adelanto máximo de una fechaHora sobre la hora de la carga
+
+
+def limite_para(marca):
+    """ Marca desde la que se recuerdan las huellas si la lectura más reciente es 'marca'. """
+    return (marca - VENTANA_HUELLAS) // PASO_PODA * PASO_PODA
+
+
+class HuellasConsumo:
+    """
+    marcas[huella] = marca de la lectura. 'limite' es la marca mínima que se recuerda (None mientras
+    no haya huellas con fecha). Las lecturas sin fechaHora (SIN_MARCA) no tienen huella.
+    """
+
+    def __init__(self, marcas=None):
+        self.marcas = dict(marcas or {})
+        self.limite = limite_para(max(self.marcas.values())) if self.marcas else None
+
+    def __contains__(self, huella):
+        return huella in self.marcas
+
+    def __len__(self):
+        return len(self.marcas)
+
+    def __eq__(self, otras):
+        return isinstance(otras, HuellasConsumo) and self.marcas == otras.marcas and self.limite == otras.limite
+
+    def fuera_de_ventana(self, marca):
+        return self.limite is not None and marca < self.limite
+
+    def agregar(self, huella, marca):
+        self.marcas[huella] = marca # Fuera de la ventana también: se descarta en la próxima poda
+        limite = limite_para(marca)
+        if self.limite is None or limite > self.limite:
+            self.limite = limite
+            self.marcas = {h: m for h, m in self.marcas.items() if m >= limite}
+
+    def copia(self):
+        otra = HuellasConsumo()
+        otra.marcas = dict(self.marcas)
+        otra.limite = self.limite
+        return otra
+
+    @classmethod
+    def sin_marcas(cls, huellas, marca=SIN_MARCA):
+        """ Huellas guardadas antes de registrar su marca: todas toman 'marca'. """
+        return cls({huella: marca for huella in huellas})
@@ -0,0 +1,119 @@
+from utils import extraer_fecha, validar_nit
+
+# Lectura de un XML de configuración en tablas, sin tocar el Datalake.
+# Cada fila es el registro completo de una entidad (la misma forma que los registros del journal,
+# ver Datalake._datos_*) en orden de documento. Lo que depende del estado actual (IDs referenciados,
+# configuraciones de otra categoría, qué cambió) lo resuelve el Datalake al comparar con sus índices.
+
+SECCIONES = ('recursos', 'categorias', 'configuraciones', 'clientes', 'instancias')
+
+
+def fusionar(actual, nuevo, siempre=()):
+    """
+    Merge de un registro existente con el leído del XML: los campos vacíos del XML conservan el valor
+    actual, salvo los de 'siempre', que se sobrescriben tal cual (p. ej. valor_x_hora, que puede ser 0).
+    """
+    return {campo: valor if (valor or campo in siempre) else actual.get(campo) for campo, valor in nuevo.items()}
+
+
+def leer_configuracion(root, errores):
+    """
+    Devuelve {"recursos": [...], "categorias": [(categoria, [configuraciones])], "clientes": [(cliente, [instancias])]}.
+    Los elementos que no se pueden convertir se omiten y el motivo queda en errores (ErroresCarga),
+    con el elemento como ubicación.
+    """
+    return {
+        "recursos": _leer_recursos(root, errores),
+        "categorias": _leer_categorias(root, errores),
+        "clientes": _leer_clientes(root, errores),
+    }
+
+
+def _leer_recursos(root, errores):
+    recursos = []
+    for rec_elem in root.iterfind('.//listaRecursos/recurso'):
+        try:
+            recursos.append({
+                "id": int(rec_elem.attrib['id']),
+                "nombre": rec_elem.findtext('nombre'),
+                "abreviatura": rec_elem.findtext('abreviatura'),
+                "metrica": rec_elem.findtext('metrica'),
+                "tipo": (rec_elem.findtext('tipo') or '').strip().upper(),
+                "valor_x_hora": float(rec_elem.findtext('valorXhora'))
+            })
+        except (ValueError, KeyError, AttributeError, TypeError) as e:
+            errores.agregar("recurso_invalido", f"Error procesando recurso XML: {e}", nodo=rec_elem)
+    return recursos
+
+
+def _leer_categorias(root, errores):
+    categorias = []
+    ids_config_en_este_xml = set()
+    for cat_elem in root.iterfind('.//listaCategorias/categoria'):
+        try:
+            id_cat = int(cat_elem.attrib['id'])
+        except (ValueError, KeyError) as e:
+            errores.agregar("categoria_invalida", f"Error procesando categoría: {e}", nodo=cat_elem)
+            continue
+        categoria = {"id": id_cat, "nombre": cat_elem.findtext('nombre'),
+                     "descripcion": cat_elem.findtext('descripcion'), "carga_trabajo": cat_elem.findtext('cargaTrabajo')}
+        configuraciones = []
+        for conf_elem in cat_elem.iterfind('.//listaConfiguraciones/configuracion'):
+            try:
+                id_conf = int(conf_elem.attrib['id'])
+            except (ValueError, KeyError) as e:
+                errores.agregar("configuracion_invalida", f"Error proc. config en cat ID {id_cat}: {e}", nodo=conf_elem)
+                continue
+            # Evitar procesar el mismo ID de config dos veces DESDE ESTE XML
+            if id_conf in ids_config_en_este_xml:
+                errores.agregar("configuracion_duplicada", f"Configuración ID {id_conf} duplicada dentro del XML. Omitiendo segunda aparición.",
+                                nodo=conf_elem)
+                continue
+            ids_config_en_este_xml.add(id_conf)
+
+            recursos = [] # (id_recurso, cantidad); la existencia y los duplicados se validan al comparar
+            for rec_conf_elem in conf_elem.iterfind('.//recursosConfiguracion/recurso'):
+                try:
+                    recursos.append((int(rec_conf_elem.attrib['id']), float(rec_conf_elem.text)))
+                except (ValueError, KeyError, TypeError) as e:
+                    errores.agregar("recurso_configuracion_invalido", f"Error proc. recurso en config ID {id_conf}: {e}", nodo=rec_conf_elem)
+            configuraciones.append({"id_categoria": id_cat, "id": id_conf, "nombre": conf_elem.findtext('nombre'),
+                                    "descripcion": conf_elem.findtext('descripcion'), "recursos": recursos})
+        categorias.append((categoria, configuraciones))
+    return categorias
+
+
+def _leer_clientes(root, errores):
+    clientes = []
+    for cli_elem in root.iterfind('.//listaClientes/cliente'):
+        nit = cli_elem.attrib.get('nit')
+        if nit is None:
+            errores.agregar("cliente_invalido", "Error procesando cliente: falta el atributo nit", nodo=cli_elem)
+            continue
+        if not validar_nit(nit):
+            errores.agregar("nit_invalido", f"NIT '{nit}' inválido. Saltando cliente.", nodo=cli_elem)
+            continue
+        cliente = {"nit": nit, "nombre": cli_elem.findtext('nombre'), "usuario": cli_elem.findtext('usuario'),
+                   "clave": cli_elem.findtext('clave'), "direccion": cli_elem.findtext('direccion'),
+                   "correo": cli_elem.findtext('correoElectronico')}
+        instancias = []
+        for inst_elem in cli_elem.iterfind('.//listaInstancias/instancia'):
+            try:
+                id_inst = int(inst_elem.attrib['id'])
+                id_conf_str = inst_elem.findtext('idConfiguracion')
+                if not id_conf_str:
+                    errores.agregar("instancia_invalida", f"Cliente NIT {nit}, Instancia ID {id_inst}: Falta <idConfiguracion>. Saltando.",
+                                    nodo=inst_elem)
+                    continue
+                estado = (inst_elem.findtext('estado') or '').strip().upper()
+                instancias.append({
+                    "nit": nit, "id": id_inst, "id_configuracion": int(id_conf_str),
+                    "nombre": inst_elem.findtext('nombre'),
+                    "fecha_inicio": extraer_fecha(inst_elem.findtext('fechaInicio')),
+                    "estado": 'Cancelada' if estado == 'CANCELADA' else 'Vigente',
+                    "fecha_final": extraer_fecha(inst_elem.findtext('fechaFinal')) if estado == 'CANCELADA' else None
+                })
+            except (ValueError, KeyError, TypeError) as e:
+                errores.agregar("instancia_invalida", f"Error proc. instancia para cliente NIT {nit}: {e}", nodo=inst_elem)
+        clientes.append((cliente, instancias))
+    return clientes
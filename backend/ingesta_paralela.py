@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import mmap
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from utils import fecha_hora_a_epoch
+
+# Parseo de archivos de consumo en varios procesos.
+# El archivo se corta en trozos justo antes de un <consumo>, cada proceso parsea y valida su trozo
+# (conversiones y campos obligatorios, lo que no depende del Datalake) y devuelve los resultados en
+# orden de documento. La búsqueda de la instancia y el registro quedan para el Datalake, en un solo hilo.
+# Ante cualquier cosa que el corte no pueda reproducir exactamente (XML mal formado, DTD, otra
+# codificación) se devuelve None y el llamador usa el camino secuencial, que da el mismo resultado
+# y el mismo reporte de errores.
+
+MIN_BYTES_POR_TROZO = 1 << 20 # Por debajo de esto no compensa repartir
+ETIQUETA = b"<consumo"
+_ENCODING = re.compile(rb"""encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+
+
+def validar_consumo(consumo_elem):
+    """
+    Validación de un <consumo> que no depende del estado del Datalake.
+    Devuelve ("ok", nit, id_instancia, tiempo, marca) o ("error", categoria, mensaje); marca es la fechaHora
+    en segundos desde 1970 (SIN_MARCA si falta o no es válida, no es un error). La posición del
+    elemento no va en el mensaje: la agrega el colector de errores (errores_carga.py) solo a sus muestras.
+    """
+    # Usar .get() para evitar KeyError si falta el atributo; findtext es más seguro que .find().text
+    return _validar(consumo_elem.attrib.get('nitCliente'), consumo_elem.attrib.get('idInstancia'),
+                    consumo_elem.findtext('tiempo'), consumo_elem.findtext('fechaHora'))
+
+
+def validar_consumo_json(registro):
+    """ Lo mismo que validar_consumo para un registro NDJSON {"nitCliente", "idInstancia", "tiempo", "fechaHora"}. """
+    if not isinstance(registro, dict):
+        return ("error", "json_invalido", f"Consumo inválido (se esperaba un objeto JSON): {json.dumps(registro)[:100]}")
+    id_instancia = registro.get('idInstancia')
+    return _validar(registro.get('nitCliente'), None if id_instancia is None else str(id_instancia),
+                    registro.get('tiempo'), registro.get('fechaHora'))
+
+
+def _validar(nit_cliente, id_instancia_str, tiempo_str, fecha_hora):
+    try:
+        # Validaciones básicas
+        if not nit_cliente or not id_instancia_str or tiempo_str is None:
+            return ("error", "campos_faltantes", f"Consumo inválido (falta nitCliente, idInstancia o tiempo): "
+                                                 f"nitCliente={nit_cliente!r}, idInstancia={id_instancia_str!r}")
+
+        marca = fecha_hora_a_epoch(fecha_hora)
+        return ("ok", nit_cliente, int(id_instancia_str), float(tiempo_str), marca)
+    except (ValueError, TypeError) as e: # Captura errores de conversión int/float
+        return ("error", "valor_invalido", f"Error procesando valor en un consumo (NIT {nit_cliente}, "
+                                           f"instancia {id_instancia_str}): {e}")
+    except Exception as e: # Captura otros errores inesperados por elemento
+        return ("error", "error_inesperado", f"Error inesperado procesando un consumo (NIT {nit_cliente}, "
+                                             f"instancia {id_instancia_str}): {e}")
+
+
+def _es_inicio_consumo(datos, pos):
+    """ True si en pos empieza la etiqueta <consumo (y no p. ej. <consumosPendientes). """
+    siguiente = datos[pos + len(ETIQUETA):pos + len(ETIQUETA) + 1]
+    return siguiente in (b" ", b">", b"/", b"\t", b"\n", b"\r")
+
+
+def _buscar_consumo(datos, desde, hasta):
+    pos = datos.find(ETIQUETA, desde, hasta)
+    while pos != -1 and not _es_inicio_consumo(datos, pos):
+        pos = datos.find(ETIQUETA, pos + 1, hasta)
+    return pos
+
+
+def dividir_en_trozos(datos, procesos):
+    """
+    Rangos (inicio, fin) de bytes con los <consumo> del documento, cortados antes de un <consumo>.
+    El primero empieza en el primer <consumo> y el último termina donde cierra el elemento raíz.
+    Devuelve None si el documento no se puede repartir sin cambiar el resultado.
+    """
+    inicio = _buscar_consumo(datos, 0, len(datos))
+    fin = datos.rfind(b"</")
+    if inicio == -1 or fin < inicio:
+        return None
+    prefijo = bytes(datos[:inicio])
+    if b"<!DOCTYPE" in prefijo:
+        return None # Las entidades declaradas no existirían dentro de cada trozo
+    encoding = _ENCODING.search(prefijo)
+    if encoding and encoding.group(1).lower() not in (b"utf-8", b"utf8", b"us-ascii", b"ascii"):
+        return None # Los trozos se parsean como UTF-8
+    try:
+        ET.fromstring(prefijo + bytes(datos[fin:])) # Lo que rodea a los consumos debe ser XML válido
+    except ET.ParseError:
+        return None
+
+    cantidad = max(1, min(procesos, (fin - inicio) // MIN_BYTES_POR_TROZO))
+    cortes = [inicio]
+    for k in range(1, cantidad):
+        objetivo = max(inicio + (fin - inicio) * k // cantidad, cortes[-1] + 1)
+        pos = _buscar_consumo(datos, objetivo, fin)
+        if pos == -1:
+            break
+        cortes.append(pos)
+    cortes.append(fin)
+    return [(a, b) for a, b in zip(cortes, cortes[1:]) if a < b]
+
+
+def _parsear_trozo(ruta, inicio, fin):
+    """ Se ejecuta en un proceso del pool. Devuelve la lista de resultados de validar_consumo o None si el trozo no es XML válido. """
+    with open(ruta, "rb") as f:
+        f.seek(inicio)
+        datos = f.read(fin - inicio)
+    try:
+        raiz = ET.fromstring(b"<trozo>" + datos + b"</trozo>")
+    except ET.ParseError:
+        return None
+    return [validar_consumo(consumo_elem) for consumo_elem in raiz.iter('consumo')]
+
+
+def parsear_consumos(ruta, procesos):
+    """
+    Parsea y valida en paralelo los consumos del archivo 'ruta'.
+    Devuelve la lista de resultados en orden de documento, o None si hay que usar el camino secuencial.
+    """
+    if procesos < 2 or "fork" not in multiprocessing.get_all_start_methods():
+        return None # Con spawn cada proceso volvería a importar la aplicación completa
+    with open(ruta, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+            trozos = dividir_en_trozos(datos, procesos)
+    if not trozos or len(trozos) < 2:
+        return None
+
+    with ProcessPoolExecutor(max_workers=min(procesos, len(trozos)),
+                             mp_context=multiprocessing.get_context("fork")) as pool:
+        partes = list(pool.map(_parsear_trozo, [ruta] * len(trozos), *zip(*trozos)))
+    if any(parte is None for parte in partes):
+        return None # XML mal formado: el camino secuencial genera el mensaje exacto
+    return [resultado for parte in partes for resultado in parte]
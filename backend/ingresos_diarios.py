@@ -0,0 +1,70 @@
+import bisect
+from utils import fecha_a_ordinal, de_centavos
+
+# Rollups de ingresos por día para los reportes.
+# Cada factura suma sus subtotales (en centavos) al día de su fecha, por recurso, por configuración
+# y por categoría, en cuanto se registra. Un reporte suma solo los días del rango: su costo depende de
+# los días con facturas en el rango, no de cuántas facturas o líneas tuvieron. Los rollups se guardan
+# con el snapshot (ver persistencia_xml.escribir_ingresos_diarios); si no vienen en lo cargado se
+# reconstruyen una vez desde el historial de facturas.
+
+TIPOS = ("recurso", "configuracion", "categoria")
+
+
+class IngresosDiarios:
+    """
+    Centavos facturados por día: por_dia[ordinal][tipo][id] con tipo en TIPOS. 'dias' son los ordinales
+    (date.toordinal()) con facturas, ordenados. El id de categoría es el de la factura (None si no lo tenía).
+    """
+
+    def __init__(self):
+        self.dias = []
+        self.por_dia = {}
+
+    @classmethod
+    def desde_facturas(cls, facturas):
+        ingresos = cls()
+        for factura in facturas:
+            ingresos.agregar_factura(factura)
+        return ingresos
+
+    def agregar_factura(self, factura):
+        """ Suma la factura al día de su fecha. Las facturas con fecha inválida no entran en los reportes. """
+        ordinal = fecha_a_ordinal(factura.fecha_factura)
+        if ordinal is None:
+            return
+        for detalle_inst in factura.detalles_instancias:
+            self.agregar(ordinal, "configuracion", detalle_inst.id_configuracion, detalle_inst.subtotal_instancia_centavos)
+            self.agregar(ordinal, "categoria", detalle_inst.id_categoria, detalle_inst.subtotal_instancia_centavos)
+            for detalle_rec in detalle_inst.recursos_costo:
+                self.agregar(ordinal, "recurso", detalle_rec.id_recurso, detalle_rec.subtotal_centavos)
+
+    def agregar(self, ordinal, tipo, clave, centavos):
+        dia = self.por_dia.get(ordinal)
+        if dia is None:
+            dia = self.por_dia[ordinal] = {tipo: {} for tipo in TIPOS}
+            bisect.insort(self.dias, ordinal) # Casi siempre al final (fecha de hoy)
+        dia[tipo][clave] = dia[tipo].get(clave, 0) + centavos
+
+    def copia(self):
+        otra = IngresosDiarios()
+        otra.dias = list(self.dias)
+        otra.por_dia = {ordinal: {tipo: dict(totales) for tipo, totales in dia.items()} for ordinal, dia in self.por_dia.items()}
+        return otra
+
+    def combinar(self, otros):
+        """ Suma los rollups de 'otros' (p. ej. los de cada fragmento). """
+        for ordinal in otros.dias:
+            for tipo, totales in otros.por_dia[ordinal].items():
+                for clave, centavos in totales.items():
+                    self.agregar(ordinal, tipo, clave, centavos)
+
+    def totales(self, tipo, desde_ordinal, hasta_ordinal):
+        """ {id: total en quetzales} de 'tipo' entre los dos ordinales (ambos inclusive). """
+        desde = bisect.bisect_left(self.dias, desde_ordinal)
+        hasta = bisect.bisect_right(self.dias, hasta_ordinal)
+        centavos = {}
+        for ordinal in self.dias[desde:hasta]:
+            for clave, total in self.por_dia[ordinal][tipo].items():
+                centavos[clave] = centavos.get(clave, 0) + total
+        return {clave: de_centavos(total) for clave, total in centavos.items()}
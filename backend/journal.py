@@ -0,0 +1,73 @@
+import os
+import json
+
+
+class Journal:
+    """
+    Log de solo-anexado con las mutaciones del Datalake.
+    Cada registro es un objeto JSON en una línea: {"seq": n, "op": "...", "datos": {...}}.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.registros = 0 # Cantidad de registros válidos en el archivo
+        for _ in self.leer():
+            self.registros += 1
+        self.bytes = os.path.getsize(ruta) if os.path.exists(ruta) else 0 # Tamaño, ya sin un final incompleto
+
+    def agregar(self, registros):
+        """ Añade un lote de registros al final del log y fuerza su escritura a disco. """
+        if not registros:
+            return
+        dir_path = os.path.dirname(self.ruta)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        datos = "".join(json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + "\n"
+                        for registro in registros).encode('utf-8')
+        with open(self.ruta, "ab") as f:
+            inicio = f.tell()
+            try:
+                f.write(datos)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                # No dejar un lote a medias: los anexos siguientes quedarían detrás de una línea rota
+                try: os.truncate(self.ruta, inicio)
+                except OSError: pass
+                raise
+        self.registros += len(registros)
+        self.bytes += len(datos)
+
+    def leer(self):
+        """
+        Recorre los registros del log en orden.
+        Si la última línea quedó incompleta (caída durante una escritura) se recorta el archivo
+        hasta el último registro válido para que los siguientes anexos no queden detrás de basura.
+        """
+        if not os.path.exists(self.ruta):
+            return
+        offset_valido = 0
+        corrupto = False
+        with open(self.ruta, "rb") as f:
+            for linea in f:
+                if not linea.endswith(b"\n"):
+                    corrupto = True
+                    break
+                try:
+                    registro = json.loads(linea.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    corrupto = True
+                    break
+                offset_valido += len(linea)
+                yield registro
+        if corrupto:
+            print(f"Advertencia: {self.ruta} tiene un registro incompleto al final. Se descarta a partir del byte {offset_valido}.")
+            os.truncate(self.ruta, offset_valido)
+
+    def truncar(self):
+        """ Vacía el log (se llama después de compactar a un snapshot). """
+        with open(self.ruta, "w", encoding='utf-8') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.registros = 0
+        self.bytes = 0
@@ -1,5 +1,8 @@
+from array import array
 from dataclasses import dataclass, field, asdict
 from typing import List
+from utils import a_centavos, de_centavos
+from huellas_consumo import HuellasConsumo
 
 # --- Modelos de Configuración ---
 @dataclass
@@ -39,7 +42,14 @@ class Instancia:
     fecha_inicio: str # dd/mm/yyyy
     estado: str # Vigente | Cancelada
     fecha_final: str = None # dd/mm/yyyy
-    consumos: List[float] = field(default_factory=list) # Consumos pendientes en horas
+    # Acumulados de los consumos pendientes (se mantienen al ingerir y se ponen en 0 al facturar)
+    horas_pendientes: float = 0.0
+    cantidad_pendientes: int = 0
+    # Consumos pendientes en columnas compactas (8 bytes por valor, sin objetos float):
+    # horas de cada lectura y su fechaHora en segundos desde 1970 (0 = sin fecha). Siempre del mismo largo.
+    # Solo se llenan si el Datalake conserva las lecturas individuales (ver conservar_consumos).
+    consumos: array = field(default_factory=lambda: array('d'))
+    marcas: array = field(default_factory=lambda: array('q'))
 
 @dataclass
 class Cliente:
@@ -50,8 +60,12 @@ class Cliente:
     direccion: str
     correo: str
     instancias: List[Instancia] = field(default_factory=list)
+    # Huellas (utils.huella_consumo) de los consumos recientes, para omitir los repetidos (ver huellas_consumo.py)
+    huellas_consumo: HuellasConsumo = field(default_factory=HuellasConsumo)
 
 # --- Modelos de Facturación ---
+# Los montos se guardan en centavos (int, ver utils.a_centavos); las propiedades sin sufijo y
+# to_dict() los presentan en quetzales, con la misma forma de siempre.
 @dataclass
 class DetalleRecursoInstancia:
     id_recurso: int
@@ -59,10 +73,20 @@ class DetalleRecursoInstancia:
     cantidad: float
     metrica: str
     valor_x_hora: float
-    subtotal: float
+    subtotal_centavos: int
+
+    @property
+    def subtotal(self):
+        return de_centavos(self.subtotal_centavos)
 
     def to_dict(self):
-       return asdict(self)
+        return {"id_recurso": self.id_recurso, "nombre_recurso": self.nombre_recurso, "cantidad": self.cantidad,
+                "metrica": self.metrica, "valor_x_hora": self.valor_x_hora, "subtotal": self.subtotal}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id_recurso'], d['nombre_recurso'], d['cantidad'], d['metrica'], d['valor_x_hora'],
+                   a_centavos(d['subtotal']))
 
 
 @dataclass
@@ -74,17 +98,29 @@ class DetalleInstanciaFactura:
     id_configuracion: int
     nombre_configuracion: str
     horas_consumidas: float
-    subtotal_instancia: float
+    subtotal_instancia_centavos: int
     # Campos con valor por defecto después
     id_categoria: int = None
     recursos_costo: List[DetalleRecursoInstancia] = field(default_factory=list)
     # --- FIN CORRECCIÓN ---
 
+    @property
+    def subtotal_instancia(self):
+        return de_centavos(self.subtotal_instancia_centavos)
+
     def to_dict(self):
-        d = asdict(self)
-        # Asegurarse de que los objetos anidados también se conviertan
-        d['recursos_costo'] = [rc.to_dict() for rc in self.recursos_costo]
-        return d
+        return {"id_instancia": self.id_instancia, "nombre_instancia": self.nombre_instancia,
+                "id_configuracion": self.id_configuracion, "nombre_configuracion": self.nombre_configuracion,
+                "horas_consumidas": self.horas_consumidas, "subtotal_instancia": self.subtotal_instancia,
+                "id_categoria": self.id_categoria,
+                # Asegurarse de que los objetos anidados también se conviertan
+                "recursos_costo": [rc.to_dict() for rc in self.recursos_costo]}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id_instancia'], d['nombre_instancia'], d['id_configuracion'], d['nombre_configuracion'],
+                   d['horas_consumidas'], a_centavos(d['subtotal_instancia']), d.get('id_categoria'),
+                   [DetalleRecursoInstancia.from_dict(rc) for rc in d.get('recursos_costo', [])])
 
 @dataclass
 class Factura:
@@ -92,12 +128,54 @@ class Factura:
     nit_cliente: str
     nombre_cliente: str
     fecha_factura: str # dd/mm/yyyy
-    monto_total: float
+    monto_total_centavos: int
     detalles_instancias: List[DetalleInstanciaFactura] = field(default_factory=list)
 
+    @property
+    def monto_total(self):
+        return de_centavos(self.monto_total_centavos)
+
     def to_dict(self):
-       d = asdict(self)
-       # Asegurarse de que los objetos anidados también se conviertan
-       d['detalles_instancias'] = [di.to_dict() for di in self.detalles_instancias]
-       return d
+       return {"id": self.id, "nit_cliente": self.nit_cliente, "nombre_cliente": self.nombre_cliente,
+               "fecha_factura": self.fecha_factura, "monto_total": self.monto_total,
+               # Asegurarse de que los objetos anidados también se conviertan
+               "detalles_instancias": [di.to_dict() for di in self.detalles_instancias]}
+
+    @classmethod
+    def from_dict(cls, d):
+        # Inverso de to_dict(), usado al reproducir el journal
+        return cls(
+            id=d['id'], nit_cliente=d['nit_cliente'], nombre_cliente=d['nombre_cliente'],
+            fecha_factura=d['fecha_factura'], monto_total_centavos=a_centavos(d['monto_total']),
+            detalles_instancias=[DetalleInstanciaFactura.from_dict(di) for di in d.get('detalles_instancias', [])]
+        )
+
+
+
+# --- Caché de facturación (no se persiste) ---
+@dataclass
+class TarifaConfiguracion:
+    """ Tarifa precompilada de una configuración: lo que cuesta una hora y el desglose por recurso. """
+    id_configuracion: int
+    nombre_configuracion: str
+    id_categoria: int
+    tarifa_hora: float # Suma de cantidad * valor_x_hora de sus recursos
+    # Plantilla de líneas: (id_recurso, nombre, cantidad, metrica, valor_x_hora, tarifa_hora_linea)
+    lineas: list = field(default_factory=list)
+    ids_recursos: set = field(default_factory=set) # Recursos referenciados, existan o no
 
+    def detalle_instancia(self, instancia, horas):
+        """ Detalle de factura de una instancia por 'horas' de consumo. """
+        return DetalleInstanciaFactura(
+            id_instancia=instancia.id,
+            nombre_instancia=instancia.nombre,
+            id_configuracion=self.id_configuracion,
+            nombre_configuracion=self.nombre_configuracion,
+            horas_consumidas=round(horas, 2),
+            subtotal_instancia_centavos=a_centavos(self.tarifa_hora * horas),
+            id_categoria=self.id_categoria,
+            recursos_costo=[
+                DetalleRecursoInstancia(id_rec, nombre, cantidad, metrica, valor, a_centavos(tarifa_linea * horas))
+                for id_rec, nombre, cantidad, metrica, valor, tarifa_linea in self.lineas
+            ]
+        )
@@ -0,0 +1,422 @@
+import sys
+import base64
+import xml.etree.ElementTree as ET
+from array import array
+from xml.sax.saxutils import escape, quoteattr
+from models import (
+    Recurso, Categoria, Configuracion, RecursoConfiguracion,
+    Cliente, Instancia, Factura, DetalleInstanciaFactura, DetalleRecursoInstancia
+)
+from datetime import date
+from utils import a_centavos, fecha_a_ordinal, SIN_MARCA
+from ingresos_diarios import IngresosDiarios, TIPOS
+from huellas_consumo import HuellasConsumo
+
+class EscritorXML:
+    """
+    Escribe XML indentado directamente sobre un archivo de texto, elemento por elemento,
+    sin construir el árbol en memoria.
+    """
+
+    def __init__(self, archivo, indent="  "):
+        self.archivo = archivo
+        self.indent = indent
+        self.nivel = 0
+
+    def declaracion(self):
+        self.archivo.write('<?xml version="1.0" ?>\n')
+
+    def abrir(self, tag, **attrs):
+        self.archivo.write(f"{self.indent * self.nivel}<{tag}{self._attrs(attrs)}>\n")
+        self.nivel += 1
+
+    def cerrar(self, tag):
+        self.nivel -= 1
+        self.archivo.write(f"{self.indent * self.nivel}</{tag}>\n")
+
+    def elemento(self, tag, texto=None, **attrs):
+        """ Elemento hoja. Sin texto se escribe como <tag/>, igual que hacía minidom. """
+        if texto is None or texto == "":
+            self.archivo.write(f"{self.indent * self.nivel}<{tag}{self._attrs(attrs)}/>\n")
+        else:
+            self.archivo.write(f"{self.indent * self.nivel}<{tag}{self._attrs(attrs)}>{escape(str(texto))}</{tag}>\n")
+
+    def _attrs(self, attrs):
+        return "".join(f" {k}={quoteattr(str(v))}" for k, v in attrs.items())
+
+
+def columna_a_texto(columna):
+    """ array('d'/'q') -> base64 de sus bytes en little-endian. """
+    if sys.byteorder == 'big':
+        columna = array(columna.typecode, columna)
+        columna.byteswap()
+    return base64.b64encode(columna.tobytes()).decode('ascii')
+
+
+def columna_desde_texto(tipo, texto):
+    columna = array(tipo)
+    if texto:
+        columna.frombytes(base64.b64decode(texto))
+        if sys.byteorder == 'big':
+            columna.byteswap()
+    return columna
+
+
+# --- Secciones del snapshot ---
+# Cada función escribe una lista completa; una lista vacía queda como <lista/>.
+
+def escribir_recursos(w, recursos):
+    if not recursos:
+        w.elemento("listaRecursos")
+        return
+    w.abrir("listaRecursos")
+    for r in recursos:
+        w.abrir("recurso", id=r.id)
+        w.elemento("nombre", r.nombre)
+        w.elemento("abreviatura", r.abreviatura)
+        w.elemento("metrica", r.metrica)
+        w.elemento("tipo", r.tipo)
+        w.elemento("valorXhora", r.valor_x_hora)
+        w.cerrar("recurso")
+    w.cerrar("listaRecursos")
+
+
+def escribir_categorias(w, categorias):
+    if not categorias:
+        w.elemento("listaCategorias")
+        return
+    w.abrir("listaCategorias")
+    for c in categorias:
+        w.abrir("categoria", id=c.id)
+        w.elemento("nombre", c.nombre)
+        w.elemento("descripcion", c.descripcion)
+        w.elemento("cargaTrabajo", c.carga_trabajo)
+        if not c.configuraciones:
+            w.elemento("listaConfiguraciones")
+        else:
+            w.abrir("listaConfiguraciones")
+            for conf in c.configuraciones:
+                w.abrir("configuracion", id=conf.id)
+                w.elemento("nombre", conf.nombre)
+                w.elemento("descripcion", conf.descripcion)
+                if not conf.recursos:
+                    w.elemento("recursosConfiguracion")
+                else:
+                    w.abrir("recursosConfiguracion")
+                    for rc in conf.recursos:
+                        w.elemento("recurso", rc.cantidad, id=rc.id_recurso)
+                    w.cerrar("recursosConfiguracion")
+                w.cerrar("configuracion")
+            w.cerrar("listaConfiguraciones")
+        w.cerrar("categoria")
+    w.cerrar("listaCategorias")
+
+
+def escribir_clientes(w, clientes):
+    """ Clientes con sus instancias y consumos pendientes. """
+    if not clientes:
+        w.elemento("listaClientes")
+        return
+    w.abrir("listaClientes")
+    for cli in clientes:
+        w.abrir("cliente", nit=cli.nit)
+        w.elemento("nombre", cli.nombre)
+        w.elemento("usuario", cli.usuario)
+        w.elemento("clave", cli.clave) # ¡Ojo con guardar claves en texto plano!
+        w.elemento("direccion", cli.direccion)
+        w.elemento("correoElectronico", cli.correo)
+        if not cli.instancias:
+            w.elemento("listaInstancias")
+        else:
+            w.abrir("listaInstancias")
+            for inst in cli.instancias:
+                w.abrir("instancia", id=inst.id)
+                w.elemento("idConfiguracion", inst.id_configuracion)
+                w.elemento("nombre", inst.nombre)
+                w.elemento("fechaInicio", inst.fecha_inicio)
+                w.elemento("estado", inst.estado)
+                w.elemento("fechaFinal", inst.fecha_final)
+                if not inst.cantidad_pendientes and not inst.consumos:
+                    w.elemento("consumosPendientes")
+                elif not inst.consumos:
+                    # Solo los acumulados: el tamaño no depende de cuántas lecturas hubo
+                    w.elemento("consumosPendientes", horas=inst.horas_pendientes, total=inst.cantidad_pendientes)
+                else:
+                    # Las mismas columnas que en memoria, en base64 (little-endian), y los acumulados
+                    w.abrir("consumosPendientes", formato="columnas", cantidad=len(inst.consumos),
+                            horas=inst.horas_pendientes, total=inst.cantidad_pendientes)
+                    w.elemento("horas", columna_a_texto(inst.consumos))
+                    w.elemento("marcas", columna_a_texto(inst.marcas))
+                    w.cerrar("consumosPendientes")
+                w.cerrar("instancia")
+            w.cerrar("listaInstancias")
+        if cli.huellas_consumo:
+            # Columnas de huellas y de sus marcas, en el mismo orden
+            marcas = cli.huellas_consumo.marcas
+            w.abrir("huellasConsumo", formato="columnas", cantidad=len(marcas))
+            w.elemento("huellas", columna_a_texto(array('q', marcas.keys())))
+            w.elemento("marcas", columna_a_texto(array('q', marcas.values())))
+            w.cerrar("huellasConsumo")
+        w.cerrar("cliente")
+    w.cerrar("listaClientes")
+
+
+def escribir_archivos(w, huellas):
+    """ Huellas de los archivos de consumo ya cargados. """
+    if not huellas:
+        w.elemento("listaArchivosCargados")
+        return
+    w.abrir("listaArchivosCargados")
+    for huella in sorted(huellas):
+        w.elemento("archivo", huella=huella)
+    w.cerrar("listaArchivosCargados")
+
+
+def escribir_ingresos_diarios(w, ingresos):
+    """ Rollups de ingresos por día (ver ingresos_diarios.py), en centavos. Sin id: categoría desconocida. """
+    if not ingresos.dias:
+        w.elemento("listaIngresosDiarios")
+        return
+    w.abrir("listaIngresosDiarios")
+    for ordinal in ingresos.dias:
+        w.abrir("dia", fecha=date.fromordinal(ordinal).strftime('%d/%m/%Y'))
+        for tipo in TIPOS:
+            for clave, centavos in ingresos.por_dia[ordinal][tipo].items():
+                if clave is None:
+                    w.elemento(tipo, centavos)
+                else:
+                    w.elemento(tipo, centavos, id=clave)
+        w.cerrar("dia")
+    w.cerrar("listaIngresosDiarios")
+
+
+def escribir_facturas(w, facturas):
+    if not facturas:
+        w.elemento("listaFacturas")
+        return
+    w.abrir("listaFacturas")
+    for f in facturas:
+        w.abrir("factura", id=f.id, nitCliente=f.nit_cliente)
+        w.elemento("nombreCliente", f.nombre_cliente)
+        w.elemento("fechaFactura", f.fecha_factura)
+        w.elemento("montoTotal", f.monto_total)
+        w.abrir("detallesInstancias")
+        for det_inst in f.detalles_instancias:
+            w.abrir("detalleInstancia", idInstancia=det_inst.id_instancia)
+            w.elemento("nombreInstancia", det_inst.nombre_instancia)
+            w.elemento("idConfiguracion", det_inst.id_configuracion)
+            w.elemento("nombreConfiguracion", det_inst.nombre_configuracion)
+            w.elemento("idCategoria", det_inst.id_categoria) # None queda vacío
+            w.elemento("horasConsumidas", det_inst.horas_consumidas)
+            w.elemento("subtotalInstancia", det_inst.subtotal_instancia)
+            w.abrir("recursosCosto")
+            for det_rec in det_inst.recursos_costo:
+                w.abrir("detalleRecurso", idRecurso=det_rec.id_recurso)
+                w.elemento("nombreRecurso", det_rec.nombre_recurso)
+                w.elemento("cantidad", det_rec.cantidad)
+                w.elemento("metrica", det_rec.metrica)
+                w.elemento("valorXhora", det_rec.valor_x_hora)
+                w.elemento("subtotal", det_rec.subtotal)
+                w.cerrar("detalleRecurso")
+            w.cerrar("recursosCosto")
+            w.cerrar("detalleInstancia")
+        w.cerrar("detallesInstancias")
+        w.cerrar("factura")
+    w.cerrar("listaFacturas")
+
+
+def escribir_snapshot(estado, archivo):
+    """
+    Escribe el estado completo recorriendo los modelos en streaming. 'estado' es la copia que da
+    Datalake._estado_para_snapshot (se escribe sin el lock del Datalake).
+    'archivo' es cualquier objeto con write(str) (ver generaciones.ArchivoConHash).
+    """
+    w = EscritorXML(archivo)
+    w.declaracion()
+    # secuencia: última mutación incluida, para no reaplicarla desde el journal
+    w.abrir("sistemaTecnologiasChapinas", secuencia=estado.secuencia)
+    escribir_recursos(w, estado.recursos)
+    escribir_categorias(w, estado.categorias)
+    escribir_clientes(w, estado.clientes)
+    escribir_archivos(w, estado.huellas_archivos) # Antes de las facturas, que pueden leerse después
+    escribir_ingresos_diarios(w, estado.ingresos_diarios) # Con carga diferida los reportes no esperan a las facturas
+    escribir_facturas(w, estado.facturas)
+    w.cerrar("sistemaTecnologiasChapinas")
+
+
+# --- Lectura incremental del snapshot ---
+
+class LectorSnapshot:
+    """
+    Carga un snapshot con iterparse: cada recurso, categoría, cliente o factura se convierte
+    en modelo en cuanto se cierra su elemento y luego se descarta, así nunca está el árbol completo
+    en memoria. La lectura puede pausarse al inicio de una lista (p. ej. listaFacturas) y
+    continuarse después con otra llamada a leer().
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.secuencia = 0
+        self.recursos = []
+        self.categorias = []
+        self.clientes = []
+        self.archivos = set()
+        self.ingresos_diarios = None # Snapshots anteriores no traen los rollups
+        self.facturas = []
+        self._eventos = ET.iterparse(ruta, events=('start', 'end'))
+        self._profundidad = 0
+        self._lista = None # Elemento de la lista que se está recorriendo (nivel 1)
+
+    def leer(self, detener_en=None):
+        """
+        Consume el archivo. Devuelve True si se detuvo al abrir la lista 'detener_en'
+        (quedando lista para continuar) o False si llegó al final.
+        """
+        for evento, elem in self._eventos:
+            if evento == 'start':
+                self._profundidad += 1
+                if self._profundidad == 1:
+                    self.secuencia = int(elem.get('secuencia', 0))
+                elif self._profundidad == 2:
+                    self._lista = elem
+                    if elem.tag == 'listaIngresosDiarios':
+                        self.ingresos_diarios = IngresosDiarios()
+                    if elem.tag == detener_en:
+                        return True
+                continue
+
+            self._profundidad -= 1
+            if self._profundidad == 2: # Se cerró una entidad completa dentro de su lista
+                self._procesar(self._lista.tag, elem)
+                self._lista.clear() # Libera la entidad ya convertida
+        return False
+
+    def _procesar(self, tag_lista, elem):
+        try:
+            if tag_lista == 'listaRecursos':
+                self.recursos.append(recurso_desde_elem(elem))
+            elif tag_lista == 'listaCategorias':
+                self.categorias.append(categoria_desde_elem(elem))
+            elif tag_lista == 'listaClientes':
+                self.clientes.append(cliente_desde_elem(elem))
+            elif tag_lista == 'listaArchivosCargados':
+                self.archivos.add(elem.attrib['huella'])
+            elif tag_lista == 'listaIngresosDiarios':
+                ingresos_desde_elem(elem, self.ingresos_diarios)
+            elif tag_lista == 'listaFacturas':
+                self.facturas.append(factura_desde_elem(elem))
+        except (ValueError, KeyError, AttributeError, TypeError):
+            pass # Entidad inválida, se omite igual que en la carga anterior
+
+
+def recurso_desde_elem(rec_elem):
+    return Recurso(
+        id=int(rec_elem.attrib['id']), nombre=rec_elem.findtext('nombre', default=""),
+        abreviatura=rec_elem.findtext('abreviatura', default=""), metrica=rec_elem.findtext('metrica', default=""),
+        tipo=rec_elem.findtext('tipo', default="HARDWARE"), valor_x_hora=float(rec_elem.findtext('valorXhora', default=0.0))
+    )
+
+
+def categoria_desde_elem(cat_elem):
+    categoria = Categoria(
+        id=int(cat_elem.attrib['id']), nombre=cat_elem.findtext('nombre', default=""),
+        descripcion=cat_elem.findtext('descripcion', default=""), carga_trabajo=cat_elem.findtext('cargaTrabajo', default=""),
+        configuraciones=[] )
+    for conf_elem in cat_elem.findall('.//listaConfiguraciones/configuracion'):
+        try:
+            configuracion = Configuracion(
+                id=int(conf_elem.attrib['id']), nombre=conf_elem.findtext('nombre', default=""),
+                descripcion=conf_elem.findtext('descripcion', default=""), recursos=[] )
+            for rec_conf_elem in conf_elem.findall('.//recursosConfiguracion/recurso'):
+                try: configuracion.recursos.append(RecursoConfiguracion(
+                        id_recurso=int(rec_conf_elem.attrib['id']), cantidad=float(rec_conf_elem.text or 0.0) ))
+                except (ValueError, KeyError, AttributeError, TypeError): continue
+            categoria.configuraciones.append(configuracion)
+        except (ValueError, KeyError, AttributeError, TypeError): continue
+    return categoria
+
+
+def cliente_desde_elem(cli_elem):
+    cliente = Cliente(
+        nit=cli_elem.attrib['nit'], nombre=cli_elem.findtext('nombre', default=""),
+        usuario=cli_elem.findtext('usuario', default=""), clave=cli_elem.findtext('clave', default=""),
+        direccion=cli_elem.findtext('direccion', default=""), correo=cli_elem.findtext('correoElectronico', default=""),
+        instancias=[] )
+    for inst_elem in cli_elem.findall('.//listaInstancias/instancia'):
+        try:
+            instancia = Instancia(
+                id=int(inst_elem.attrib['id']), id_configuracion=int(inst_elem.findtext('idConfiguracion', default=0)),
+                nombre=inst_elem.findtext('nombre', default=""), fecha_inicio=inst_elem.findtext('fechaInicio', default=""),
+                estado=inst_elem.findtext('estado', default="Vigente"), fecha_final=inst_elem.findtext('fechaFinal') ) # None si no existe
+            consumos_elem = inst_elem.find('consumosPendientes')
+            if consumos_elem is not None and consumos_elem.get('formato') == 'columnas':
+                instancia.consumos = columna_desde_texto('d', consumos_elem.findtext('horas'))
+                instancia.marcas = columna_desde_texto('q', consumos_elem.findtext('marcas'))
+                # Las columnas deben tener el mismo largo; si no, se completan las marcas sin fecha
+                del instancia.marcas[len(instancia.consumos):]
+                instancia.marcas.extend([0] * (len(instancia.consumos) - len(instancia.marcas)))
+            elif consumos_elem is not None:
+                # Formato anterior: un <consumo> por lectura, con la marca opcional como atributo
+                for cons_elem in consumos_elem.findall('consumo'):
+                    try:
+                        instancia.consumos.append(float(cons_elem.text or 0.0))
+                        instancia.marcas.append(int(cons_elem.get('marca', 0)))
+                    except (ValueError, TypeError): continue
+            if consumos_elem is not None and consumos_elem.get('total') is not None:
+                instancia.horas_pendientes = float(consumos_elem.get('horas', 0.0))
+                instancia.cantidad_pendientes = int(consumos_elem.get('total'))
+            else:
+                # Snapshots sin acumulados: se calculan de las lecturas (en el orden en que se sumaron al ingerir)
+                for tiempo in instancia.consumos: instancia.horas_pendientes += tiempo
+                instancia.cantidad_pendientes = len(instancia.consumos)
+            cliente.instancias.append(instancia)
+        except (ValueError, KeyError, AttributeError, TypeError): continue
+    huellas_elem = cli_elem.find('huellasConsumo')
+    if huellas_elem is not None and huellas_elem.get('formato') == 'columnas':
+        huellas = columna_desde_texto('q', huellas_elem.findtext('huellas'))
+        marcas = columna_desde_texto('q', huellas_elem.findtext('marcas'))
+        cliente.huellas_consumo = HuellasConsumo(zip(huellas, marcas))
+    elif huellas_elem is not None:
+        # Formato anterior, sin marcas: toman la del consumo pendiente más reciente del cliente
+        marca = max((max(inst.marcas) for inst in cliente.instancias if inst.marcas), default=SIN_MARCA)
+        cliente.huellas_consumo = HuellasConsumo.sin_marcas(columna_desde_texto('q', huellas_elem.text), marca)
+    return cliente
+
+
+def ingresos_desde_elem(dia_elem, ingresos):
+    ordinal = fecha_a_ordinal(dia_elem.attrib['fecha'])
+    if ordinal is None:
+        return
+    for elem in dia_elem:
+        if elem.tag in TIPOS:
+            clave = int(elem.attrib['id']) if 'id' in elem.attrib else None
+            ingresos.agregar(ordinal, elem.tag, clave, int(elem.text))
+
+
+def factura_desde_elem(fac_elem):
+    id_factura = fac_elem.attrib['id'] # Los IDs generados tienen forma F-YYYYMMDD-N
+    factura = Factura(
+        id=int(id_factura) if id_factura.isdigit() else id_factura, nit_cliente=fac_elem.attrib['nitCliente'],
+        nombre_cliente=fac_elem.findtext('nombreCliente', default=""), fecha_factura=fac_elem.findtext('fechaFactura', default=""),
+        monto_total_centavos=a_centavos(float(fac_elem.findtext('montoTotal', default=0.0))), detalles_instancias=[] )
+    for det_inst_elem in fac_elem.findall('.//detallesInstancias/detalleInstancia'):
+         try:
+            id_cat_text = det_inst_elem.findtext('idCategoria')
+            id_categoria = int(id_cat_text) if id_cat_text and id_cat_text.isdigit() else None # Asegurar que sea numérico
+
+            detalle_inst = DetalleInstanciaFactura(
+                id_instancia=int(det_inst_elem.attrib['idInstancia']), nombre_instancia=det_inst_elem.findtext('nombreInstancia', default=""),
+                id_configuracion=int(det_inst_elem.findtext('idConfiguracion', default=0)), nombre_configuracion=det_inst_elem.findtext('nombreConfiguracion', default=""),
+                horas_consumidas=float(det_inst_elem.findtext('horasConsumidas', default=0.0)),
+                subtotal_instancia_centavos=a_centavos(float(det_inst_elem.findtext('subtotalInstancia', default=0.0))),
+                id_categoria=id_categoria, # Mover aquí después de los no-default
+                recursos_costo=[] )
+            for det_rec_elem in det_inst_elem.findall('.//recursosCosto/detalleRecurso'):
+                try: detalle_inst.recursos_costo.append(DetalleRecursoInstancia(
+                        id_recurso=int(det_rec_elem.attrib['idRecurso']), nombre_recurso=det_rec_elem.findtext('nombreRecurso', default=""),
+                        cantidad=float(det_rec_elem.findtext('cantidad', default=0.0)), metrica=det_rec_elem.findtext('metrica', default=""),
+                        valor_x_hora=float(det_rec_elem.findtext('valorXhora', default=0.0)), subtotal_centavos=a_centavos(float(det_rec_elem.findtext('subtotal', default=0.0))) ))
+                except (ValueError, KeyError, AttributeError, TypeError): continue
+            factura.detalles_instancias.append(detalle_inst)
+         except (ValueError, KeyError, AttributeError, TypeError): continue
+    return factura
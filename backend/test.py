@@ -1,9 +1,22 @@
+import io
+import os
+import time
+import shutil
+import threading
+import tempfile
 import unittest
+import importlib
+from datetime import datetime, date
 import requests
 
 BASE_URL = "http://127.0.0.1:5000"  # Asegúrate que Flask esté corriendo en este puerto
 
+def centavos(monto):
+    """ Monto en quetzales (dos decimales) como centavos enteros """
+    return round(monto * 100)
+
 class TestFlaskAPI(unittest.TestCase):
+    facturas_generadas = [] # IDs de las facturas que generan estas pruebas (para test_9_reportes)
 
     def test_1_reset_sistema(self):
         """Probar el endpoint /reset"""
@@ -81,5 +94,694 @@ class TestFlaskAPI(unittest.TestCase):
         self.assertGreaterEqual(len(data.get("categorias", [])), 1)
         self.assertGreaterEqual(len(data.get("clientes", [])), 1)
 
+    def test_4_carga_asincrona(self):
+        """Probar /cargar-consumo?asincrono=1 y el seguimiento en /jobs/<id>"""
+        xml = """<?xml version="1.0"?>
+<listadoConsumos>
+    <consumo nitCliente="1234567-8" idInstancia="1">
+        <tiempo>1.5</tiempo>
+        <fechaHora>15/10/2025 10:00</fechaHora>
+    </consumo>
+</listadoConsumos>"""
+
+        files = {'archivo': ('consumo.xml', xml, 'text/xml')}
+        response = requests.post(f"{BASE_URL}/cargar-consumo?asincrono=1", files=files)
+        print("\n/cargar-consumo?asincrono=1 =>", response.json())
+        self.assertEqual(response.status_code, 202)
+        id_trabajo = response.json()["id_trabajo"]
+
+        for _ in range(50):
+            trabajo = requests.get(f"{BASE_URL}/jobs/{id_trabajo}").json()["trabajo"]
+            if trabajo["estado"] not in ("en_cola", "en_proceso"):
+                break
+            time.sleep(0.1)
+        print("\n/jobs/<id> =>", trabajo)
+        self.assertEqual(trabajo["estado"], "completado")
+        self.assertEqual(trabajo["progreso"]["procesados"], 1)
+
+        response = requests.get(f"{BASE_URL}/jobs/no-existe")
+        self.assertEqual(response.status_code, 404)
+
+    def test_5_consumos_bulk(self):
+        """Probar /consumos/bulk con NDJSON: registrados, repetidos y rechazados en un solo resumen"""
+        lineas = [
+            '{"nitCliente": "1234567-8", "idInstancia": 1, "tiempo": 2.0, "fechaHora": "16/10/2025 08:00"}',
+            '{"nitCliente": "1234567-8", "idInstancia": 1, "tiempo": 2.0, "fechaHora": "16/10/2025 08:00"}',
+            '{"nitCliente": "1234567-8", "idInstancia": 99, "tiempo": 1.0}',
+            'no es json',
+        ]
+        # Un generador hace que requests envíe el cuerpo con Transfer-Encoding: chunked
+        cuerpo = (f"{linea}\n".encode() for linea in lineas)
+        response = requests.post(f"{BASE_URL}/consumos/bulk", data=cuerpo,
+                                 headers={'Content-Type': 'application/x-ndjson'})
+        print("\n/consumos/bulk =>", response.json())
+        self.assertEqual(response.status_code, 200)
+        resumen = response.json()["resumen"]
+        self.assertEqual(resumen["recibidos"], 4)
+        self.assertEqual(resumen["registrados"], 1)
+        self.assertEqual(resumen["duplicados"], 1)
+        self.assertEqual(resumen["rechazados"], 2)
+        errores = response.json()["errores"]
+        self.assertEqual(errores["total"], 2)
+        self.assertEqual(errores["por_categoria"], {"instancia_no_encontrada": 1, "json_invalido": 1})
+        self.assertEqual([m["linea"] for m in errores["muestras"]], [3, 4])
+
+    def test_6_dry_run(self):
+        """Probar /cargar-consumo?dry_run=1: informa lo que se registraría sin registrarlo"""
+        xml = """<?xml version="1.0"?>
+<listadoConsumos>
+    <consumo nitCliente="1234567-8" idInstancia="1">
+        <tiempo>3.0</tiempo>
+        <fechaHora>17/10/2025 09:00</fechaHora>
+    </consumo>
+    <consumo nitCliente="1234567-8" idInstancia="99">
+        <tiempo>1.0</tiempo>
+    </consumo>
+</listadoConsumos>"""
+        for _ in range(2): # La segunda vez el consumo sigue siendo nuevo: la primera no lo registró
+            files = {'archivo': ('consumo.xml', xml, 'text/xml')}
+            response = requests.post(f"{BASE_URL}/cargar-consumo?dry_run=1", files=files)
+            print("\n/cargar-consumo?dry_run=1 =>", response.json())
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertTrue(data["dry_run"])
+            self.assertEqual(data["resumen"], {"recibidos": 2, "registrados": 1, "duplicados": 0, "rechazados": 1})
+            self.assertEqual(data["errores"]["muestras"][0]["linea"], 7)
+
+    def test_7_facturacion_masiva(self):
+        """Probar /facturacion/masiva filtrando por NIT: una factura por cliente con consumos pendientes"""
+        response = requests.post(f"{BASE_URL}/facturacion/masiva", json={"nits": ["1234567-8", "0000000-0"]})
+        print("\n/facturacion/masiva =>", response.json())
+        self.assertEqual(response.status_code, 201)
+        resumen = response.json()["resumen"]
+        self.assertEqual(resumen["facturas_generadas"], 1)
+        self.assertEqual(resumen["clientes"][0]["nit"], "1234567-8")
+        self.assertEqual(resumen["no_encontrados"], ["0000000-0"])
+        TestFlaskAPI.facturas_generadas += [cliente["id_factura"] for cliente in resumen["clientes"]]
+
+        # Ya no quedan consumos pendientes
+        response = requests.post(f"{BASE_URL}/facturacion/masiva", json={"nits": ["1234567-8"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "info")
+
+    def test_8_factura_preview(self):
+        """Probar /factura/preview: cotiza sin facturar, reutiliza la cotización y la recalcula al llegar consumos"""
+        def cargar(linea):
+            response = requests.post(f"{BASE_URL}/consumos/bulk", data=f"{linea}\n".encode(),
+                                     headers={'Content-Type': 'application/x-ndjson'})
+            self.assertEqual(response.json()["resumen"]["registrados"], 1)
+
+        cargar('{"nitCliente": "1234567-8", "idInstancia": 1, "tiempo": 1.0, "fechaHora": "18/10/2025 08:00"}')
+        response = requests.get(f"{BASE_URL}/factura/preview", params={"nit": "1234567-8"})
+        print("\n/factura/preview =>", response.json())
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()["en_cache"])
+        primera = response.json()["cotizacion"]
+
+        response = requests.get(f"{BASE_URL}/factura/preview", params={"nit": "1234567-8"})
+        self.assertTrue(response.json()["en_cache"])
+        self.assertEqual(response.json()["cotizacion"], primera)
+
+        # Un consumo nuevo invalida la cotización guardada
+        cargar('{"nitCliente": "1234567-8", "idInstancia": 1, "tiempo": 0.5, "fechaHora": "18/10/2025 09:00"}')
+        response = requests.get(f"{BASE_URL}/factura/preview", params={"nit": "1234567-8"})
+        self.assertFalse(response.json()["en_cache"])
+        cotizacion = response.json()["cotizacion"]
+        self.assertGreater(cotizacion["monto_total"], primera["monto_total"])
+
+        # La vista previa no facturó nada: la factura real cobra exactamente lo cotizado
+        response = requests.post(f"{BASE_URL}/generar-factura", json={"nit": "1234567-8"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["factura"]["monto_total"], cotizacion["monto_total"])
+        TestFlaskAPI.facturas_generadas.append(response.json()["factura"]["id"])
+        response = requests.get(f"{BASE_URL}/factura/preview", params={"nit": "1234567-8"})
+        self.assertEqual(response.json()["status"], "info")
+
+        response = requests.get(f"{BASE_URL}/factura/preview", params={"nit": "0000000-0"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_9_reportes(self):
+        """Probar los reportes de ingresos del día contra las facturas generadas por las pruebas, en centavos"""
+        # Desde /reset las únicas facturas son las de test_7 y test_8, todas con fecha de hoy
+        facturas = [f for f in requests.get(f"{BASE_URL}/consultar-datos").json()["facturas"]
+                    if f["id"] in TestFlaskAPI.facturas_generadas]
+        self.assertEqual(len(facturas), len(TestFlaskAPI.facturas_generadas))
+        self.assertGreater(len(facturas), 0)
+        total = sum(centavos(f["monto_total"]) for f in facturas)
+        # Cada línea de recurso se redondea por separado: su suma puede diferir del total por centavos
+        total_recursos = sum(centavos(rc["subtotal"]) for f in facturas
+                             for di in f["detalles_instancias"] for rc in di["recursos_costo"])
+
+        hoy = time.strftime('%Y-%m-%d')
+        rango = {"fecha_inicio": hoy, "fecha_fin": hoy}
+        por_recurso = requests.get(f"{BASE_URL}/reporte/ventas-recurso", params=rango).json()
+        por_config = requests.get(f"{BASE_URL}/reporte/ventas-categoria", params=rango).json()
+        print("\n/reporte/ventas-categoria =>", por_config)
+        self.assertEqual(por_config["status"], "success")
+        self.assertEqual(sum(centavos(monto) for monto in por_config["data"].values()), total)
+        self.assertEqual(sum(centavos(monto) for monto in por_config["por_categoria"].values()), total)
+        self.assertEqual(sum(centavos(monto) for monto in por_recurso["data"].values()), total_recursos)
+
+class TestPersistencia(unittest.TestCase):
+    """Pruebas del Datalake sin servidor: cada prueba usa sus propios archivos en un directorio temporal"""
+
+    CONFIGURACION = """<?xml version="1.0"?>
+<configuracion>
+    <listaRecursos>
+        <recurso id="1"><nombre>Servidor</nombre><metrica>GB</metrica><valorXhora>5.0</valorXhora></recurso>
+    </listaRecursos>
+    <listaCategorias>
+        <categoria id="1"><nombre>Pequeña</nombre><listaConfiguraciones>
+            <configuracion id="101"><nombre>Config A</nombre>
+                <recursosConfiguracion><recurso id="1">2</recurso></recursosConfiguracion>
+            </configuracion>
+        </listaConfiguraciones></categoria>
+    </listaCategorias>
+    <listaClientes>
+        <cliente nit="1234567-8"><nombre>Juan Pérez</nombre><listaInstancias>
+            <instancia id="1"><idConfiguracion>101</idConfiguracion><nombre>MiServidor</nombre>
+                <fechaInicio>15/10/2025</fechaInicio><estado>Vigente</estado></instancia>
+        </listaInstancias></cliente>
+    </listaClientes>
+</configuracion>"""
+
+    @classmethod
+    def setUpClass(cls):
+        # database.py crea su instancia global en el directorio actual: se importa dentro del temporal
+        cls.directorio = tempfile.mkdtemp()
+        anterior = os.getcwd()
+        os.chdir(cls.directorio)
+        try:
+            cls.database = importlib.import_module("database")
+            cls.facturacion = importlib.import_module("facturacion")
+        finally:
+            os.chdir(anterior)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directorio, ignore_errors=True)
+
+    def setUp(self):
+        self.ruta = tempfile.mkdtemp(dir=self.directorio)
+
+    def consumos(self, nit, cantidad, dia=17, mes=10):
+        return "<listadoConsumos>" + "".join(
+            f'<consumo nitCliente="{nit}" idInstancia="1"><tiempo>1.25</tiempo>'
+            f'<fechaHora>{dia + i // 1440:02d}/{mes:02d}/2025 {i // 60 % 24:02d}:{i % 60:02d}</fechaHora></consumo>'
+            for i in range(cantidad)) + "</listadoConsumos>"
+
+    def assertMismoEstado(self, reabierto, datalake):
+        self.assertEqual(reabierto.secuencia, datalake.secuencia)
+        self.assertEqual(reabierto.recursos, datalake.recursos)
+        self.assertEqual(reabierto.categorias, datalake.categorias)
+        self.assertEqual(reabierto.clientes, datalake.clientes)
+        self.assertEqual(reabierto.huellas_archivos, datalake.huellas_archivos)
+        self.assertEqual(reabierto.facturas, datalake.facturas)
+
+    def test_snapshot_en_streaming_y_journal_tras_una_caida(self):
+        """Lo que solo quedó en el journal se reaplica al reabrir, y el snapshot escrito en streaming se relee igual"""
+        ruta = os.path.join(self.ruta, "db.xml")
+        datalake = self.database.Datalake(ruta, modo_journal=True)
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.compactar()
+        # El snapshot guarda los campos opcionales ausentes como texto vacío: se sigue desde lo releído
+        datalake = self.database.Datalake(ruta, modo_journal=True)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3, dia=16))
+        self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 16))
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2))
+
+        # Sin compactar: es como si el proceso se hubiera caído con lo último solo en el journal
+        self.assertGreater(datalake.almacenamiento.journal.bytes, 0)
+        self.assertMismoEstado(self.database.Datalake(ruta, modo_journal=True), datalake)
+
+        datalake.compactar()
+        self.assertEqual(datalake.almacenamiento.journal.bytes, 0)
+        self.assertMismoEstado(self.database.Datalake(ruta), datalake)
+
+    def test_factura_en_journal_no_fuerza_carga_diferida(self):
+        """Reaplicar una factura del journal al iniciar deja pendiente la carga diferida de facturas"""
+        ruta = os.path.join(self.ruta, "db.xml")
+        datalake = self.database.Datalake(ruta, modo_journal=True)
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.compactar() # El snapshot tiene una factura y el journal otra
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2, dia=16))
+        self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 16))
+        datalake.compactar()
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2))
+        factura = self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 17))
+
+        reabierto = self.database.Datalake(ruta, modo_journal=True, carga_facturas='diferida')
+        self.assertIsNotNone(reabierto._carga_facturas)
+        # Al completarse la carga, la del journal queda después de la del snapshot
+        self.assertEqual([f.id for f in reabierto.facturas], [f.id for f in datalake.facturas])
+        self.assertEqual(reabierto.facturas[-1].id, factura.id)
+
+    def test_carga_por_lotes_no_compacta_en_cada_lote(self):
+        """Una carga en streaming de varios lotes se anexa al journal sin reescribir el snapshot en cada lote"""
+        ruta = os.path.join(self.ruta, "db.xml")
+        datalake = self.database.Datalake(ruta, modo_journal=True)
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        almacenamiento = datalake.almacenamiento
+        compactaciones = []
+        compactar = almacenamiento.compactar
+        almacenamiento.compactar = lambda dl: (compactaciones.append(almacenamiento.journal.bytes), compactar(dl))
+
+        ruta_consumos = os.path.join(self.ruta, "consumos.xml")
+        with open(ruta_consumos, "w", encoding="utf-8") as f:
+            f.write(self.consumos("1234567-8", 3000))
+        resultado = datalake.cargar_consumo_desde_xml(ruta_consumos, lote=500) # 6 lotes
+        self.assertIn("3000 consumos procesados", resultado["message"])
+        self.assertEqual(compactaciones, [])
+        self.assertEqual(almacenamiento.journal.bytes, os.path.getsize(almacenamiento.journal.ruta))
+
+        # Con el journal más pesado que el snapshot (y sobre el mínimo) sí se compacta, una vez
+        almacenamiento.umbral_compactacion = 1
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 10, dia=25))
+        self.assertEqual(len(compactaciones), 1)
+        self.assertEqual(almacenamiento.journal.bytes, 0)
+
+    def test_generacion_corrupta_carga_la_anterior(self):
+        """Las generaciones se verifican de la más reciente a la más antigua, y solo hasta la primera válida"""
+        ruta = os.path.join(self.ruta, "db.xml")
+        datalake = self.database.Datalake(ruta)
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2))
+        datalake.esperar_persistencia()
+        generaciones = datalake.almacenamiento.generaciones
+        reciente = generaciones.ruta_generacion(generaciones.entradas[0]["generacion"])
+
+        verificadas = []
+        es_valida = generaciones._es_valida
+        generaciones._es_valida = lambda entrada: verificadas.append(entrada["generacion"]) or es_valida(entrada)
+        self.assertEqual(next(generaciones.candidatos()), reciente)
+        self.assertEqual(verificadas, [generaciones.entradas[0]["generacion"]])
+
+        # db.xml es la misma generación: también queda cortado
+        os.truncate(reciente, os.path.getsize(reciente) // 2)
+        recuperado = self.database.Datalake(ruta)
+        self.assertEqual(recuperado.find_instancia("1234567-8", 1).cantidad_pendientes, 0)
+
+    def test_snapshot_se_escribe_sin_el_lock(self):
+        """Mientras se escribe el snapshot otro hilo puede modificar el Datalake; el snapshot no incluye ese cambio"""
+        ruta = os.path.join(self.ruta, "db.xml")
+        datalake = self.database.Datalake(ruta)
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3))
+        secuencia = datalake.secuencia
+
+        def modificar():
+            with datalake.lock:
+                datalake._registrar_consumo("1234567-8", 1, 9.0, 0, self.database.ErroresCarga())
+
+        generaciones = datalake.almacenamiento.generaciones
+        escribir = generaciones.escribir
+        def escribir_con_otro_hilo(escritor, seq):
+            hilo = threading.Thread(target=modificar)
+            hilo.start()
+            hilo.join(timeout=5)
+            self.assertFalse(hilo.is_alive(), "el lock del Datalake sigue tomado durante la escritura")
+            return escribir(escritor, seq)
+        generaciones.escribir = escribir_con_otro_hilo
+        datalake.guardar_completo()
+
+        self.assertEqual(datalake.find_instancia("1234567-8", 1).cantidad_pendientes, 4)
+        reabierto = self.database.Datalake(ruta)
+        self.assertEqual(reabierto.secuencia, secuencia)
+        self.assertEqual(reabierto.find_instancia("1234567-8", 1).cantidad_pendientes, 3)
+        self.assertEqual(len(reabierto.find_instancia("1234567-8", 1).consumos), 3)
+
+    def test_fragmento_se_escribe_sin_el_lock(self):
+        """El almacenamiento fragmentado copia el fragmento bajo el lock y lo escribe fuera de él"""
+        from almacenamiento_fragmentado import AlmacenamientoFragmentado
+        directorio = os.path.join(self.ruta, "frag")
+        datalake = self.database.Datalake(almacenamiento=AlmacenamientoFragmentado(directorio, fragmentos=4))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2, dia=16))
+        self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 16))
+
+        almacenamiento = datalake.almacenamiento
+        escribir_fragmento = almacenamiento._escribir_fragmento
+        libre = []
+        def tomar_lock():
+            tomado = datalake.lock.acquire(timeout=5)
+            libre.append(tomado)
+            if tomado:
+                datalake.lock.release()
+
+        def escribir_con_otro_hilo(*args):
+            hilo = threading.Thread(target=tomar_lock)
+            hilo.start()
+            hilo.join()
+            escribir_fragmento(*args)
+        almacenamiento._escribir_fragmento = escribir_con_otro_hilo
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3))
+        factura = self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 17))
+        self.assertTrue(libre and all(libre))
+
+        # Los índices por fragmento se actualizaron con lo nuevo: el fragmento tiene las dos facturas
+        reabierto = self.database.Datalake(almacenamiento=AlmacenamientoFragmentado(directorio, fragmentos=4))
+        self.assertEqual([f.id for f in reabierto.facturas], [f.id for f in datalake.facturas])
+        self.assertEqual(reabierto.facturas[-1].id, factura.id)
+        self.assertEqual(reabierto.find_instancia("1234567-8", 1).cantidad_pendientes, 0)
+        self.assertEqual(reabierto.ingresos_diarios.por_dia,
+                         self.database.IngresosDiarios.desde_facturas(datalake.facturas).por_dia)
+
+    def test_fragmentado_recupera_un_lote_cortado(self):
+        """Un lote que alcanzó a escribir el catálogo pero no el fragmento se completa desde el journal al reabrir"""
+        from almacenamiento import ErrorPersistencia
+        from almacenamiento_fragmentado import AlmacenamientoFragmentado
+        directorio = os.path.join(self.ruta, "frag")
+        abrir = lambda: self.database.Datalake(almacenamiento=AlmacenamientoFragmentado(directorio, fragmentos=4))
+        datalake = abrir()
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2))
+
+        def caida(*args):
+            raise OSError("No queda espacio en el dispositivo")
+        datalake.almacenamiento._escribir_fragmento = caida
+        nuevos = self.CONFIGURACION.replace('<recurso id="1">', '<recurso id="2"><nombre>Disco</nombre><valorXhora>1.0</valorXhora></recurso><recurso id="1">', 1) \
+            .replace('<cliente nit="1234567-8">', '<cliente nit="7654321-0"><nombre>Ana</nombre><listaInstancias><instancia id="1">'
+                     '<idConfiguracion>101</idConfiguracion><nombre>Otra</nombre><fechaInicio>15/10/2025</fechaInicio>'
+                     '<estado>Vigente</estado></instancia></listaInstancias></cliente><cliente nit="1234567-8">')
+        with self.assertRaises(ErrorPersistencia):
+            datalake.cargar_desde_xml_string(nuevos)
+
+        reabierto = abrir()
+        self.assertIsNotNone(reabierto.find_recurso(2))
+        self.assertEqual(len(reabierto.recursos), 2)
+        self.assertEqual(reabierto.find_instancia("7654321-0", 1).nombre, "Otra")
+        self.assertEqual(reabierto.find_instancia("1234567-8", 1).cantidad_pendientes, 2)
+        self.assertEqual(reabierto.secuencia, datalake.secuencia)
+
+        # El siguiente guardado escribe también el fragmento recuperado y vacía el journal
+        reabierto.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 1, dia=18))
+        self.assertEqual(reabierto.almacenamiento.journal.bytes, 0)
+        self.assertEqual(abrir().find_instancia("7654321-0", 1).nombre, "Otra")
+
+    def test_huellas_de_consumo_se_podan_fuera_de_la_ventana(self):
+        """Las huellas de consumo se recuerdan por una ventana de fechaHora; lo anterior se rechaza, no se cobra dos veces"""
+        from almacenamiento_sqlite import AlmacenamientoSQLite
+        for nombre, almacenamiento in (("xml", None), ("sqlite", lambda: AlmacenamientoSQLite(os.path.join(self.ruta, "db.sqlite3")))):
+            with self.subTest(almacenamiento=nombre):
+                ruta = os.path.join(self.ruta, f"db_{nombre}.xml")
+                abrir = lambda: self.database.Datalake(ruta, almacenamiento=almacenamiento and almacenamiento())
+                datalake = abrir()
+                datalake.cargar_desde_xml_string(self.CONFIGURACION)
+                datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3))
+                # Reintento dentro de la ventana (con una lectura nueva): las tres primeras se omiten
+                resultado = datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 4))
+                self.assertEqual((resultado["resumen"]["registrados"], resultado["resumen"]["duplicados"]), (1, 3))
+                cliente = datalake.find_cliente("1234567-8")
+                self.assertEqual(len(cliente.huellas_consumo), 4)
+
+                # Lecturas dos meses después: las huellas de octubre se podan
+                datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2, mes=12))
+                self.assertEqual(len(cliente.huellas_consumo), 2)
+                self.assertEqual(datalake.find_instancia("1234567-8", 1).cantidad_pendientes, 6)
+
+                # Lo persistido conserva las mismas huellas y el mismo límite
+                reabierto = abrir()
+                huellas = reabierto.find_cliente("1234567-8").huellas_consumo
+                self.assertEqual(huellas.marcas, cliente.huellas_consumo.marcas)
+                self.assertEqual(huellas.limite, cliente.huellas_consumo.limite)
+
+    def test_sqlite_guarda_los_rollups_de_ingresos(self):
+        """SQLite guarda los rollups por día: los reportes no esperan la carga diferida de las facturas"""
+        from almacenamiento_sqlite import AlmacenamientoSQLite
+        from ingresos_diarios import IngresosDiarios
+        ruta = os.path.join(self.ruta, "db.sqlite3")
+        datalake = self.database.Datalake(almacenamiento=AlmacenamientoSQLite(ruta))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        for dia in (16, 17):
+            datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3, dia=dia))
+            self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, dia))
+
+        reabierto = self.database.Datalake(almacenamiento=AlmacenamientoSQLite(ruta), carga_facturas='diferida')
+        self.assertEqual(reabierto.ingresos_diarios.por_dia, IngresosDiarios.desde_facturas(datalake.facturas).por_dia)
+        self.assertEqual(reabierto.ingresos_por_recurso(date(2025, 10, 1), date(2025, 10, 31)),
+                         datalake.ingresos_por_recurso(date(2025, 10, 1), date(2025, 10, 31)))
+        self.assertIsNotNone(reabierto._carga_facturas)
+
+    def test_sqlite_ida_y_vuelta(self):
+        """Lo guardado en SQLite por lotes y reescrito completo se vuelve a cargar igual que en memoria"""
+        from almacenamiento_sqlite import AlmacenamientoSQLite
+        ruta = os.path.join(self.ruta, "db.sqlite3")
+        datalake = self.database.Datalake(almacenamiento=AlmacenamientoSQLite(ruta))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3, dia=16))
+        self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 16))
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2))
+
+        self.assertMismoEstado(self.database.Datalake(almacenamiento=AlmacenamientoSQLite(ruta)), datalake)
+        datalake.guardar_completo()
+        self.assertMismoEstado(self.database.Datalake(almacenamiento=AlmacenamientoSQLite(ruta)), datalake)
+
+    def test_motores_de_facturacion_dan_los_mismos_montos(self):
+        """El motor numpy y el escalar calculan los mismos detalles y totales, por encima y por debajo del umbral"""
+        if self.facturacion.np is None:
+            self.skipTest("numpy no está instalado")
+        from benchmark_facturacion import generar_lote
+        for tamano in (1, self.facturacion.UMBRAL_NUMPY - 1, self.facturacion.UMBRAL_NUMPY, 1000):
+            with self.subTest(instancias=tamano):
+                pares = generar_lote(tamano, 20, 10, semilla=tamano)
+                escalar = self.facturacion.detalles_instancias(pares, 'escalar')
+                vectorizado = self.facturacion.detalles_instancias(pares, 'numpy')
+                self.assertEqual(vectorizado, escalar)
+                self.assertEqual(sum(d.subtotal_instancia_centavos for d in vectorizado),
+                                 sum(d.subtotal_instancia_centavos for d in escalar))
+
+    def test_consumo_con_fecha_futura_no_mueve_la_ventana(self):
+        """Una fechaHora muy posterior a la carga se rechaza sola; las lecturas reales siguen entrando y deduplicándose"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        futura = self.consumos("1234567-8", 1).replace("/10/2025", "/10/2205")
+        resultado = datalake.cargar_consumo_desde_xml_string(futura)
+        self.assertEqual(resultado["errores"]["por_categoria"], {"fecha_futura": 1})
+        self.assertIsNone(datalake.find_cliente("1234567-8").huellas_consumo.limite)
+
+        resultado = datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2, dia=18))
+        self.assertEqual(resultado["resumen"]["registrados"], 2)
+        self.assertEqual(resultado["errores"]["total"], 0)
+        resultado = datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3, dia=18))
+        self.assertEqual((resultado["resumen"]["registrados"], resultado["resumen"]["duplicados"]), (1, 2))
+
+    def test_consumo_tardio_se_registra_con_advertencia(self):
+        """Una lectura anterior a la ventana se cobra con una advertencia, y su reintento inmediato se omite"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 1, mes=12))
+        tardio = self.consumos("1234567-8", 2)
+        resultado = datalake.cargar_consumo_desde_xml_string(tardio)
+        self.assertEqual(resultado["resumen"]["registrados"], 2)
+        self.assertEqual(resultado["errores"]["por_categoria"], {"consumo_fuera_de_ventana": 2})
+        self.assertEqual(datalake.find_instancia("1234567-8", 1).cantidad_pendientes, 3)
+
+        # La advertencia no impide recordar el archivo, y las huellas tardías se conservan hasta la próxima poda
+        self.assertIn("ya había sido cargado", datalake.cargar_consumo_desde_xml_string(tardio)["message"])
+        resultado = datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 3))
+        self.assertEqual((resultado["resumen"]["registrados"], resultado["resumen"]["duplicados"]), (1, 2))
+        self.assertEqual(datalake.find_instancia("1234567-8", 1).cantidad_pendientes, 4)
+
+    def test_subidas_simultaneas_del_mismo_archivo(self):
+        """Dos cargas en streaming del mismo archivo a la vez registran sus consumos sin fechaHora una sola vez"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        xml = ("<listadoConsumos>" + '<consumo nitCliente="1234567-8" idInstancia="1"><tiempo>1.25</tiempo></consumo>' * 3
+               + "</listadoConsumos>").encode()
+        barrera = threading.Barrier(2)
+        resultados = []
+
+        def cargar():
+            barrera.wait()
+            resultados.append(datalake.cargar_consumo_desde_xml(io.BytesIO(xml), lote=1, progreso=lambda *_: time.sleep(0.05)))
+
+        hilos = [threading.Thread(target=cargar) for _ in range(2)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        self.assertEqual(sum("ya había sido cargado" in r["message"] for r in resultados), 1)
+        self.assertEqual(datalake.find_instancia("1234567-8", 1).cantidad_pendientes, 3)
+        self.assertIn("ya había sido cargado", datalake.cargar_consumo_desde_xml_string(xml.decode())["message"])
+
+    def test_busquedas_por_indice(self):
+        """Los find_* responden desde los índices, normalizan los IDs y siguen las altas y el reset"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        self.assertEqual(datalake.find_cliente("1234567-8").nombre, "Juan Pérez")
+        self.assertEqual(datalake.find_recurso("1").nombre, "Servidor")
+        self.assertEqual(datalake.find_categoria(1).nombre, "Pequeña")
+        self.assertEqual(datalake.find_configuracion("101").nombre, "Config A")
+        self.assertEqual(datalake.find_categoria_por_config(101).id, 1)
+        self.assertIs(datalake.find_instancia("1234567-8", "1"), datalake.clientes[0].instancias[0])
+        self.assertIsNone(datalake.find_recurso("x"))
+        self.assertIsNone(datalake.find_instancia("0000000-0", 1))
+
+        datalake.cargar_desde_xml_string(self.CONFIGURACION.replace(
+            '<instancia id="1">', '<instancia id="2"><idConfiguracion>101</idConfiguracion><nombre>Otra</nombre>'
+            '<fechaInicio>16/10/2025</fechaInicio><estado>Vigente</estado></instancia><instancia id="1">'))
+        self.assertEqual(datalake.find_instancia("1234567-8", 2).nombre, "Otra")
+
+        datalake.reset_datos()
+        self.assertIsNone(datalake.find_cliente("1234567-8"))
+        self.assertIsNone(datalake.find_configuracion(101))
+
+    def test_tarifa_compilada_se_invalida_al_cambiar_el_precio(self):
+        """La tarifa por configuración se compila una vez y se recalcula solo cuando cambia un recurso suyo"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        tarifa = datalake.tarifa_configuracion(101)
+        self.assertEqual(tarifa.tarifa_hora, 10.0) # 2 x 5.0
+        self.assertIs(datalake.tarifa_configuracion("101"), tarifa)
+        datalake.cargar_desde_xml_string(self.CONFIGURACION) # Sin cambios: la tarifa sigue en caché
+        self.assertIs(datalake.tarifa_configuracion(101), tarifa)
+
+        datalake.cargar_desde_xml_string(self.CONFIGURACION.replace("<valorXhora>5.0<", "<valorXhora>7.5<"))
+        self.assertEqual(datalake.tarifa_configuracion(101).tarifa_hora, 15.0)
+        datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2))
+        factura = self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 17))
+        self.assertEqual(factura.detalles_instancias[0].recursos_costo[0].valor_x_hora, 7.5)
+        self.assertEqual(factura.monto_total_centavos, 3750) # 2.5 horas x 15.0
+
+    def test_facturas_en_rango_por_fecha(self):
+        """El índice por fecha devuelve las facturas del rango en orden de fecha, aunque se emitan desordenadas"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        facturas = {}
+        for dia in (20, 16, 18):
+            datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 1, dia=dia))
+            facturas[dia] = self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, dia))
+
+        self.assertEqual([f.id for f in datalake.facturas_en_rango(date(2025, 10, 1), date(2025, 10, 31))],
+                         [facturas[dia].id for dia in (16, 18, 20)])
+        self.assertEqual(datalake.facturas_en_rango(date(2025, 10, 18), date(2025, 10, 18)), [facturas[18]])
+        self.assertEqual(datalake.facturas_en_rango(date(2025, 10, 17), date(2025, 10, 19)), [facturas[18]])
+        self.assertEqual(datalake.facturas_en_rango(date(2025, 11, 1), date(2025, 11, 30)), [])
+
+    def test_carga_en_streaming_igual_a_la_carga_en_memoria(self):
+        """Cargar el archivo en streaming por lotes deja el mismo estado y el mismo resumen que cargarlo entero"""
+        xml = self.consumos("1234567-8", 7).replace(
+            "</listadoConsumos>", '<consumo nitCliente="1234567-8" idInstancia="1"><tiempo>abc</tiempo></consumo></listadoConsumos>')
+        en_memoria = self.database.Datalake(os.path.join(self.ruta, "memoria.xml"))
+        en_streaming = self.database.Datalake(os.path.join(self.ruta, "streaming.xml"))
+        for datalake in (en_memoria, en_streaming):
+            datalake.cargar_desde_xml_string(self.CONFIGURACION)
+
+        esperado = en_memoria.cargar_consumo_desde_xml_string(xml)
+        resultado = en_streaming.cargar_consumo_desde_xml(io.BytesIO(xml.encode()), lote=3)
+        self.assertEqual(esperado["resumen"]["registrados"], 7)
+        self.assertEqual(resultado["resumen"], esperado["resumen"])
+        self.assertEqual(resultado["errores"]["por_categoria"], esperado["errores"]["por_categoria"])
+        self.assertEqual(en_streaming.clientes, en_memoria.clientes)
+        self.assertEqual(en_streaming.huellas_archivos, en_memoria.huellas_archivos)
+
+    def test_parseo_en_paralelo_igual_al_secuencial(self):
+        """Repartir el archivo entre procesos da los mismos consumos, errores y orden que el camino secuencial"""
+        import multiprocessing
+        import ingesta_paralela
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self.skipTest("el parseo en paralelo necesita fork")
+        ruta_consumos = os.path.join(self.ruta, "consumos.xml")
+        with open(ruta_consumos, "w", encoding="utf-8") as f:
+            f.write(self.consumos("1234567-8", 300).replace(
+                '<consumo nitCliente="1234567-8" idInstancia="1"><tiempo>1.25</tiempo><fechaHora>17/10/2025 02:00',
+                '<consumo nitCliente="1234567-8" idInstancia="9"><tiempo>1.25</tiempo><fechaHora>17/10/2025 02:00'))
+        secuencial = self.database.Datalake(os.path.join(self.ruta, "secuencial.xml"))
+        paralelo = self.database.Datalake(os.path.join(self.ruta, "paralelo.xml"))
+        for datalake in (secuencial, paralelo):
+            datalake.cargar_desde_xml_string(self.CONFIGURACION)
+
+        minimo = ingesta_paralela.MIN_BYTES_POR_TROZO
+        ingesta_paralela.MIN_BYTES_POR_TROZO = 1024 # Varios trozos con un archivo pequeño
+        try:
+            self.assertIsNotNone(ingesta_paralela.parsear_consumos(ruta_consumos, 4)) # None: no se repartió
+            resultado = paralelo.cargar_consumo_paralelo(ruta_consumos, procesos=4)
+        finally:
+            ingesta_paralela.MIN_BYTES_POR_TROZO = minimo
+        esperado = secuencial.cargar_consumo_desde_xml(ruta_consumos)
+        self.assertEqual(esperado["resumen"]["registrados"], 299)
+        self.assertEqual(resultado["resumen"], esperado["resumen"])
+        self.assertEqual(resultado["errores"]["muestras"], esperado["errores"]["muestras"])
+        self.assertEqual(paralelo.clientes, secuencial.clientes)
+
+    def test_consumos_en_columnas_compactas(self):
+        """Los consumos pendientes se guardan en columnas array('d')/array('q') con su fechaHora y se releen iguales"""
+        from almacenamiento_sqlite import AlmacenamientoSQLite
+        from utils import SIN_MARCA, fecha_hora_a_epoch
+        abrir = {"xml": lambda: self.database.Datalake(os.path.join(self.ruta, "db.xml")),
+                 "sqlite": lambda: self.database.Datalake(almacenamiento=AlmacenamientoSQLite(os.path.join(self.ruta, "db.sqlite3")))}
+        for nombre, abrir_datalake in abrir.items():
+            with self.subTest(almacenamiento=nombre):
+                datalake = abrir_datalake()
+                datalake.cargar_desde_xml_string(self.CONFIGURACION)
+                datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 2).replace(
+                    "</listadoConsumos>", '<consumo nitCliente="1234567-8" idInstancia="1"><tiempo>0.5</tiempo></consumo></listadoConsumos>'))
+                instancia = datalake.find_instancia("1234567-8", 1)
+                self.assertEqual((instancia.consumos.typecode, instancia.marcas.typecode), ("d", "q"))
+                self.assertEqual(list(instancia.consumos), [1.25, 1.25, 0.5])
+                self.assertEqual(list(instancia.marcas), [fecha_hora_a_epoch("17/10/2025 00:00"),
+                                                          fecha_hora_a_epoch("17/10/2025 00:01"), SIN_MARCA])
+                datalake.guardar_completo()
+                releida = abrir_datalake().find_instancia("1234567-8", 1)
+                self.assertEqual((releida.consumos, releida.marcas), (instancia.consumos, instancia.marcas))
+
+    def test_acumulados_por_instancia(self):
+        """Facturar usa los acumulados de la instancia: con o sin las lecturas individuales el monto es el mismo"""
+        montos = []
+        for conservar in (True, False):
+            with self.subTest(conservar_consumos=conservar):
+                datalake = self.database.Datalake(os.path.join(self.ruta, f"db_{conservar}.xml"), conservar_consumos=conservar)
+                datalake.cargar_desde_xml_string(self.CONFIGURACION)
+                datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 4))
+                instancia = datalake.find_instancia("1234567-8", 1)
+                self.assertEqual((instancia.horas_pendientes, instancia.cantidad_pendientes), (5.0, 4))
+                self.assertEqual(len(instancia.consumos), 4 if conservar else 0)
+
+                factura = self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, 17))
+                montos.append(factura.monto_total_centavos)
+                self.assertEqual((instancia.horas_pendientes, instancia.cantidad_pendientes, len(instancia.consumos)), (0.0, 0, 0))
+        self.assertEqual(montos, [5000, 5000]) # 5 horas x 10.0
+
+    def test_merge_de_configuracion_por_diferencias(self):
+        """El merge solo aplica lo nuevo o cambiado: resubir el mismo archivo no registra mutaciones"""
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        resultado = datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        self.assertEqual({seccion: r["nuevos"] for seccion, r in resultado["resumen"].items()},
+                         {"recursos": 1, "categorias": 1, "configuraciones": 1, "clientes": 1, "instancias": 1})
+        secuencia = datalake.secuencia
+
+        resultado = datalake.cargar_desde_xml_string(self.CONFIGURACION)
+        self.assertEqual(sum(r["sin_cambios"] for r in resultado["resumen"].values()), 5)
+        self.assertEqual(datalake.secuencia, secuencia)
+
+        # Un recurso cambiado y una referencia repetida dentro de la configuración
+        resultado = datalake.cargar_desde_xml_string(self.CONFIGURACION.replace("<valorXhora>5.0<", "<valorXhora>6.0<")
+                                                     .replace('<recurso id="1">2</recurso>', '<recurso id="1">2</recurso><recurso id="1">3</recurso>'))
+        self.assertEqual(resultado["resumen"]["recursos"]["actualizados"], 1)
+        self.assertEqual(resultado["resumen"]["configuraciones"]["sin_cambios"], 1)
+        self.assertEqual(resultado["errores"]["por_categoria"], {"recurso_duplicado": 1})
+        self.assertEqual(datalake.secuencia, secuencia + 1)
+        self.assertEqual(datalake.find_recurso(1).valor_x_hora, 6.0)
+        self.assertEqual(len(datalake.recursos), 1)
+
+    def test_montos_en_centavos_enteros(self):
+        """Los montos se redondean una vez a centavos enteros (como round(x, 2)) y los reportes suman sin deriva"""
+        from utils import a_centavos
+        for milesimas in range(200001):
+            valor = milesimas / 1000
+            self.assertEqual(a_centavos(valor), round(round(valor, 2) * 100), valor)
+        self.assertEqual((a_centavos(2.675), a_centavos(0.125), a_centavos(0.375)), (267, 12, 38))
+
+        datalake = self.database.Datalake(os.path.join(self.ruta, "db.xml"))
+        datalake.cargar_desde_xml_string(self.CONFIGURACION.replace("<valorXhora>5.0<", "<valorXhora>0.08<"))
+        for dia in range(1, 11):
+            datalake.cargar_consumo_desde_xml_string(self.consumos("1234567-8", 1, dia=dia))
+            factura = self.facturacion.facturar_cliente(datalake, datalake.find_cliente("1234567-8"), datetime(2025, 10, dia))
+            self.assertEqual(factura.monto_total_centavos, 20) # 1.25 horas x 0.16
+            self.assertIsInstance(factura.monto_total_centavos, int)
+        # Diez veces 0.2 en float no suma 2.0; en centavos sí
+        self.assertEqual(datalake.ingresos_por_recurso(date(2025, 10, 1), date(2025, 10, 31)), {1: 2.0})
+        self.assertEqual(datalake.ingresos_por_configuracion(date(2025, 10, 1), date(2025, 10, 31)), {101: 2.0})
+
 if __name__ == "__main__":
     unittest.main()
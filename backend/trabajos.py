@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_ERRORES_RESUMEN = 20 # Errores que se devuelven en /jobs/<id>; el resto solo se cuenta
+
+
+class ArchivoConProgreso:
+    """ Envuelve un archivo binario y cuenta los bytes leídos, para reportar el avance de una carga. """
+
+    def __init__(self, archivo, trabajo):
+        self._archivo = archivo
+        self._trabajo = trabajo
+
+    def read(self, n=-1):
+        datos = self._archivo.read(n)
+        self._trabajo.progreso["bytes_leidos"] += len(datos)
+        return datos
+
+    # Para calcular la huella del archivo antes de cargarlo (utils.huella_archivo lo lee y rebobina)
+    def seekable(self):
+        return self._archivo.seekable()
+
+    def tell(self):
+        return self._archivo.tell()
+
+    def seek(self, posicion, desde=0):
+        posicion = self._archivo.seek(posicion, desde)
+        self._trabajo.progreso["bytes_leidos"] = posicion
+        return posicion
+
+
+class Trabajo:
+    """ Una carga en segundo plano. Su estado se consulta con a_dict() desde /jobs/<id>. """
+
+    def __init__(self, tipo, bytes_totales=0):
+        self.id = uuid.uuid4().hex
+        self.tipo = tipo
+        self.estado = "en_cola" # en_cola | en_proceso | completado | error
+        self.creado = time.time()
+        self.iniciado = None
+        self.terminado = None
+        self.progreso = {"procesados": 0, "errores": 0, "errores_por_categoria": {},
+                         "bytes_leidos": 0, "bytes_totales": bytes_totales}
+        self.errores = [] # Primeras MAX_ERRORES_RESUMEN muestras del colector de errores
+        self.resultado = None # {"status", "message"} devuelto por el Datalake
+
+    def avance(self, procesados, errores):
+        """ Callback de progreso para los cargadores del Datalake (errores: ErroresCarga de la carga). """
+        self.progreso["procesados"] = procesados
+        self.progreso["errores"] = errores.total
+        self.progreso["errores_por_categoria"] = dict(errores.por_categoria)
+        if len(self.errores) < MAX_ERRORES_RESUMEN:
+            self.errores = [{k: v for k, v in m.items() if k != "nodo"} for m in errores.muestras[:MAX_ERRORES_RESUMEN]]
+
+    def a_dict(self):
+        return {
+            "id": self.id, "tipo": self.tipo, "estado": self.estado,
+            "creado": self.creado, "iniciado": self.iniciado, "terminado": self.terminado,
+            "progreso": dict(self.progreso), "errores": list(self.errores), "resultado": self.resultado
+        }
+
+
+class GestorTrabajos:
+    """
+    Cola de cargas asíncronas atendida por un pool de hilos.
+    Los cargadores del Datalake ya toman el lock por lote, así que varios trabajos pueden
+    avanzar a la vez sin bloquear las peticiones normales más de lo que dura un lote.
+    """
+
+    def __init__(self, trabajadores=2, conservar=200):
+        self._pool = ThreadPoolExecutor(max_workers=trabajadores, thread_name_prefix="trabajo")
+        self._trabajos = OrderedDict() # id -> Trabajo, del más antiguo al más reciente
+        self._lock = threading.Lock()
+        self.conservar = conservar # Trabajos terminados que se recuerdan
+
+    def enviar(self, tipo, funcion, ruta_tmp=None, bytes_totales=0):
+        """
+        Encola funcion(trabajo), que debe devolver el resultado {"status", "message"}.
+        Si se indica ruta_tmp, ese archivo temporal se borra al terminar.
+        """
+        trabajo = Trabajo(tipo, bytes_totales)
+        with self._lock:
+            self._trabajos[trabajo.id] = trabajo
+            self._purgar()
+        self._pool.submit(self._ejecutar, trabajo, funcion, ruta_tmp)
+        return trabajo
+
+    def obtener(self, id_trabajo):
+        with self._lock:
+            return self._trabajos.get(id_trabajo)
+
+    def _ejecutar(self, trabajo, funcion, ruta_tmp):
+        trabajo.estado = "en_proceso"
+        trabajo.iniciado = time.time()
+        try:
+            trabajo.resultado = funcion(trabajo)
+            trabajo.estado = "completado" if trabajo.resultado.get("status") == "success" else "error"
+        except Exception as e:
+            print(f"Error inesperado en el trabajo {trabajo.id} ({trabajo.tipo}): {e}")
+            import traceback
+            traceback.print_exc()
+            trabajo.resultado = {"status": "error", "message": f"Error inesperado al procesar el archivo: {e}"}
+            trabajo.estado = "error"
+        finally:
+            trabajo.terminado = time.time()
+            if ruta_tmp:
+                try: os.remove(ruta_tmp)
+                except OSError: pass
+
+    def _purgar(self):
+        terminados = [t.id for t in self._trabajos.values() if t.terminado is not None]
+        for id_trabajo in terminados[:max(0, len(terminados) - self.conservar)]:
+            del self._trabajos[id_trabajo]
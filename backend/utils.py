@@ -1,4 +1,11 @@
+import os
 import re
+import math
+import calendar
+import hashlib
+from datetime import datetime
+
+SIN_MARCA = 0 # Marca de tiempo de un consumo sin fechaHora válida
 
 def extraer_fecha(texto):
     """ Extrae la primera fecha válida (dd/mm/yyyy) de una cadena. """
@@ -15,3 +22,85 @@ def validar_nit(nit):
     # Expresión regular para números, guion y un número o 'K' al final
     return re.fullmatch(r'(\d+-[\dkK])', nit) is not None
 
+
+def fecha_a_ordinal(texto):
+    """ Convierte una fecha dd/mm/yyyy en su ordinal (date.toordinal()), o None si no es válida. """
+    try:
+        return datetime.strptime(texto, '%d/%m/%Y').date().toordinal()
+    except (ValueError, TypeError):
+        return None
+
+
+def fecha_hora_a_epoch(texto):
+    """
+    Convierte una fechaHora 'dd/mm/yyyy hh:mm' (la hora es opcional) en segundos desde 1970.
+    La hora del archivo se toma tal cual, sin zona horaria. Devuelve SIN_MARCA si no es válida.
+    """
+    match = re.search(r'\b(\d{2})/(\d{2})/(\d{4})(?:\s+(\d{1,2}):(\d{2}))?', texto or '')
+    if not match:
+        return SIN_MARCA
+    dia, mes, anio, hora, minuto = match.groups()
+    try:
+        fecha = datetime(int(anio), int(mes), int(dia), int(hora or 0), int(minuto or 0))
+    except ValueError:
+        return SIN_MARCA
+    return calendar.timegm(fecha.timetuple())
+
+
+def marca_actual():
+    """ La hora actual como marca, con el mismo criterio que fecha_hora_a_epoch (hora local sin zona). """
+    return calendar.timegm(datetime.now().timetuple())
+
+
+# --- Dinero en centavos ---
+# Los montos de facturas y reportes se guardan como enteros de centavos: sumar no acumula error y
+# solo se redondea una vez, al pasar de horas x tarifa (float) a centavos. Hacia afuera (JSON, XML,
+# SQLite) se siguen mostrando en quetzales con dos decimales.
+
+def a_centavos(valor):
+    """ Centavos de un monto en quetzales, redondeado como round(valor, 2) (mitad al par sobre el valor exacto). """
+    escalado = valor * 100
+    centavos = round(escalado)
+    if abs(escalado - math.floor(escalado) - 0.5) < 1e-6:
+        # valor * 100 pudo cruzar la mitad al multiplicar: se decide sobre el valor original
+        centavos = round(round(valor, 2) * 100)
+    return centavos
+
+
+def de_centavos(centavos):
+    """ Monto en quetzales (float con dos decimales exactos al mostrarse) de una cantidad de centavos. """
+    return centavos / 100
+
+
+# --- Huellas para cargas idempotentes ---
+
+def huella_consumo(nit, id_instancia, marca, tiempo):
+    """ Huella de 64 bits (entero con signo, cabe en array('q') y en SQLite) de un consumo. """
+    clave = f"{nit}|{id_instancia}|{marca}|{tiempo!r}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(clave, digest_size=8).digest(), 'little', signed=True)
+
+
+def huella_contenido(datos):
+    """ Huella (hex) del contenido completo de un archivo ya en memoria (str o bytes). """
+    if isinstance(datos, str):
+        datos = datos.encode('utf-8')
+    return hashlib.blake2b(datos, digest_size=16).hexdigest()
+
+
+def huella_archivo(fuente):
+    """
+    Huella (hex) de un archivo dado por ruta o como archivo binario abierto. Un archivo abierto
+    se lee completo y se rebobina; si no admite seek no se puede releer y se devuelve None.
+    """
+    if isinstance(fuente, (str, os.PathLike)):
+        with open(fuente, 'rb') as f:
+            return huella_archivo(f)
+    seekable = getattr(fuente, 'seekable', None)
+    if not seekable or not seekable():
+        return None
+    inicio = fuente.tell()
+    h = hashlib.blake2b(digest_size=16)
+    for bloque in iter(lambda: fuente.read(1 << 20), b''):
+        h.update(bloque)
+    fuente.seek(inicio)
+    return h.hexdigest()
@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('', views.home, name='home'),
+    path('trabajos/<str:id_trabajo>/', views.estado_trabajo_view, name='estado_trabajo'),
     # --- CORRECCIÓN: Usar el nombre de función correcto de views.py ---
     path('reset/', views.reset_data_view, name='reset_data'),
     path('creacion-datos/', views.creacion_datos_view, name='creacion_datos'),
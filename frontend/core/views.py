@@ -46,6 +46,9 @@ def home(request):
     # Usar sessions para mostrar mensajes después de redireccionar
     if 'message' in request.session:
         context['message'] = request.session.pop('message')
+    # Carga en segundo plano recién enviada: la plantilla consulta su avance
+    if 'id_trabajo' in request.session:
+        context['id_trabajo'] = request.session.pop('id_trabajo')
 
     api_data = get_api_data() # Obtener datos frescos en cada carga GET
 
@@ -60,20 +63,25 @@ def home(request):
                 if not archivo.name.lower().endswith('.xml'):
                      raise ValueError("El archivo de configuración debe ser .xml")
                 files = {'archivo': archivo}
-                response = requests.post(f"{API_URL}/cargar-configuracion", files=files, timeout=10) # Timeout
+                # Asíncrono: el API responde al recibir el archivo y lo procesa en segundo plano
+                response = requests.post(f"{API_URL}/cargar-configuracion", files=files, data={'asincrono': '1'}, timeout=30) # Timeout
                 response.raise_for_status()
                 message_text = response.json().get('message', 'Archivo de configuración enviado.')
                 message_type = response.json().get('status', 'success') # 'success', 'error', 'warning'
+                if response.json().get('id_trabajo'):
+                    request.session['id_trabajo'] = response.json()['id_trabajo']
 
             elif 'consumo_file' in request.FILES:
                 archivo = request.FILES['consumo_file']
                 if not archivo.name.lower().endswith('.xml'):
                      raise ValueError("El archivo de consumo debe ser .xml")
                 files = {'archivo': archivo}
-                response = requests.post(f"{API_URL}/cargar-consumo", files=files, timeout=10) # Timeout
+                response = requests.post(f"{API_URL}/cargar-consumo", files=files, data={'asincrono': '1'}, timeout=30) # Timeout
                 response.raise_for_status()
                 message_text = response.json().get('message', 'Archivo de consumo enviado.')
                 message_type = response.json().get('status', 'success')
+                if response.json().get('id_trabajo'):
+                    request.session['id_trabajo'] = response.json()['id_trabajo']
 
             # Guardar mensaje en sesión y redireccionar para evitar reenvío de form
             request.session['message'] = (message_text, message_type)
@@ -107,6 +115,16 @@ def home(request):
 
     return render(request, 'core/home.html', context)
 
+def estado_trabajo_view(request, id_trabajo):
+    """ Proxy JSON hacia /jobs/<id> del API, usado por home.html para mostrar el avance de una carga. """
+    try:
+        response = requests.get(f"{API_URL}/jobs/{id_trabajo}", timeout=5)
+        return JsonResponse(response.json(), status=response.status_code)
+    except requests.exceptions.Timeout:
+        return JsonResponse({"status": "error", "message": "Timeout consultando el estado de la carga."}, status=504)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return JsonResponse({"status": "error", "message": f"Error de conexión o del API: {e}"}, status=502)
+
 def reset_data_view(request):
     """ Vista para llamar al endpoint de reset del backend. """
     context = {'message': None}